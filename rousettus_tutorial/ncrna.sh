@@ -42,7 +42,8 @@ singularity exec \
     -transcriptome rousettus
 
 # Remove ncrna candidates that map to core cds (via CD-HIT-EST-2D)
-# and then remove ncrna sequence duplicates/fragments (via CD-HIT-EST)
+# and then remove ncrna sequence duplicates/fragments (via CD-HIT-EST).
+# Candidates that are exact substrings of core cds or longer candidates are removed first (-prefilter)
 singularity exec \
     --pwd /src \
     --no-home \
@@ -56,7 +57,7 @@ singularity exec \
     -transcripts_fasta /src/transcriptome_data/raw_transcriptome.fna \
     -ncrna /src/ncrna \
     -cds_fasta /src/transcriptome_data/rousettus_cds_core.fna \
-    -cpus $SLURM_CPUS_PER_TASK -memory $SLURM_MEM_PER_NODE
+    -cpus $SLURM_CPUS_PER_TASK -memory $SLURM_MEM_PER_NODE -prefilter
 
 # Extract ncRNA for BLAST search
 singularity exec \
@@ -79,7 +80,10 @@ singularity exec \
     --bind $TATAT_BLASTDB_DIR:/src/blastdb \
     --bind $NCRNA_DIR:/src/ncrna \
     --bind $BLAST_HITS_DIR:/src/blast_hits \
+    --bind $SQLITE_DB_DIR:/src/sqlite_db \
     $SINGULARITY_IMAGE \
+    python3 -u /src/app/stage_metrics.py \
+    -sqlite_db /src/sqlite_db/tatat.db -stage blastn_ncrna -sample_uid rousettus \
     blastn -db /src/blastdb/vertebrata_core_nt \
     -query /src/ncrna/blast_ncrna.fna \
     -out /src/blast_hits/ncrna_hits.tsv \
@@ -37,10 +37,12 @@ singularity exec \
     --bind $FASTQ_TRIMMED_DIR:/src/fastq_trimmed \
     --bind $SALMON_COUNTS_DIR:/src/salmon_counts \
     --bind $SALMON_COUNTS_COLLATED_DIR:/src/salmon_counts_collated \
+    --bind $SQLITE_DB_DIR:/src/sqlite_db \
     $SINGULARITY_IMAGE \
     python3 -u /src/app/post_annotation_qc/salmon_orchestration.py \
     -fastq_dir /src/fastq_trimmed \
     -sra $SRA_NUMBER -cpus $SLURM_CPUS_PER_TASK \
     -salmon_index /src/salmon_index/rousettus_core \
     -outdir /src/salmon_counts \
-    -collated_dir /src/salmon_counts_collated
\ No newline at end of file
+    -collated_dir /src/salmon_counts_collated \
+    -sqlite_db /src/sqlite_db/tatat.db
\ No newline at end of file
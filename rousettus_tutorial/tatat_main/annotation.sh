@@ -29,7 +29,7 @@ singularity exec \
     -assembly_fasta /src/transcriptome_data/raw_transcriptome.fna \
     -sqlite_db /src/sqlite_db/tatat.db \
     -sql_queries /src/app/example_sql_queries/cds_for_blastn_sql_queries.json \
-    -cds_fasta /src/transcriptome_data/cds.fna
+    -cds_fasta /src/transcriptome_data/cds.fna -workers $SLURM_CPUS_PER_TASK
 
 # Perform blastn search with candidate cds as queries
 # and vertebrata core nt database for subject matches
@@ -39,7 +39,10 @@ singularity exec \
     --bind $TATAT_BLASTDB_DIR:/src/blastdb \
     --bind $TRANSCRIPTOME_DATA_DIR:/src/transcriptome_data \
     --bind $BLAST_HITS_DIR:/src/blast_hits \
+    --bind $SQLITE_DB_DIR:/src/sqlite_db \
     $SINGULARITY_IMAGE \
+    python3 -u /src/app/stage_metrics.py \
+    -sqlite_db /src/sqlite_db/tatat.db -stage blastn_cds -sample_uid rousettus \
     blastn -db /src/blastdb/vertebrata_core_nt \
     -query /src/transcriptome_data/cds.fna \
     -out /src/blast_hits/cds_hits.tsv \
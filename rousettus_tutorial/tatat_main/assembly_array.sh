@@ -67,9 +67,11 @@ singularity exec \
     --bind $FASTQ_TRIMMED_DIR:/src/data/trimmed \
     --bind $RNASPADES_ASSEMBLY_DIR:/src/data/assembly \
     --bind $RNASPADES_COLLATED_ASSEMBLY_DIR:/src/data/collated \
+    --bind $SQLITE_DB_DIR:/src/sqlite_db \
     $SINGULARITY_IMAGE \
     python3 -u /src/app/assembly/rnaspades_orchestration.py \
     -fastq_dir /src/data/trimmed \
     -assembly_dir /src/data/assembly \
     -collated_dir /src/data/collated \
+    -sqlite_db /src/sqlite_db/tatat.db \
     -unique_identifier $SRA_NUMBER -cpus $SLURM_CPUS_PER_TASK -memory $MEM_IN_GB
\ No newline at end of file
@@ -18,6 +18,16 @@ mkdir $EVIGENE_OUTPUT_DIR
 
 module load singularity
 
+# Set APPEND_SAMPLES=true in the .env file to add new assemblies to an existing transcriptome,
+# keeping the "transcripts" table and merged fasta instead of recreating them from scratch
+if [ "$APPEND_SAMPLES" = "true" ]; then
+    CREATE_TRANSCRIPTS_TABLE=""
+    APPEND=-append
+else
+    CREATE_TRANSCRIPTS_TABLE=-create_transcripts_table
+    APPEND=""
+fi
+
 # Generate sqlite db tables
 singularity exec \
     --pwd /src \
@@ -26,7 +36,7 @@ singularity exec \
     $SINGULARITY_IMAGE \
     python3 -u /src/app/sqlite_db_prep.py \
     -sqlite_db_dir /src/sqlite_db \
-    -create_transcripts_table \
+    $CREATE_TRANSCRIPTS_TABLE \
     -create_cds_table
 
 # To merge assemblies into single file
@@ -41,7 +51,7 @@ singularity exec \
     python3 -u /src/app/thinning/merge_fastas_and_set_metadata.py \
     -assembly_fasta_dir /src/data/collated \
     -merged_path /src/transcriptome_data/raw_transcriptome.fna \
-    -sqlite_db /src/sqlite_db/tatat.db
+    -sqlite_db /src/sqlite_db/tatat.db $APPEND
 
 # Use evigene to calculate candidate cds regions in assemblies,
 # classify them as coding, noncoding, etc.,
@@ -60,15 +70,4 @@ singularity exec \
     -sqlite_db /src/sqlite_db/tatat.db \
     -transcriptome rousettus -prefix_column sample_uid \
     -run_evigene -cpus $SLURM_CPUS_PER_TASK -mem $SLURM_MEM_PER_NODE -phetero 2 -minaa 99 \
-    -run_transcript_metadata_appender -run_cds_and_metadata
-
-singularity exec \
-    --pwd /src \
-    --no-home \
-    --bind $SQLITE_DB_DIR:/src/sqlite_db \
-    $SINGULARITY_IMAGE \
-    python3 -u /src/app/thinning/evigene_orchestration.py \
-    -assembly_fasta holder -outdir holder \
-    -sqlite_db /src/sqlite_db/tatat.db \
-    -transcriptome holder -prefix_column holder \
-    -update_transcript_cds_ids
\ No newline at end of file
+    -ingest_evigene_outputs
@@ -0,0 +1,89 @@
+from json import dumps, loads
+from pathlib import Path
+import sqlite3
+from sqlite_tools import SqliteConnectionManager
+from time import time
+from typing import Iterable, Union
+
+class AccessionGeneCache:
+    # Persistent cache of the NCBI gene fields of each accession number, shared by every run and rna_type, so only
+    # accessions that are new or older than the ttl are submitted to NCBI again. Accessions NCBI found no gene for are
+    # cached as None, so they are not resubmitted either. Once over max_entries, the least recently used are evicted.
+    # The cache is its own sqlite db rather than part of tatat.db, so it can be shared between projects
+    GENE_FIELDS = ["symbol", "synonyms", "type", "chromosomes"]
+
+    def __init__(self, cache_db: Path, ttl_days: float=30, max_entries: int=2_000_000) -> None:
+        self.ttl_seconds = ttl_days * 86_400
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(cache_db, timeout=SqliteConnectionManager.TIMEOUT)
+        self.connection.execute(f"PRAGMA journal_mode = {SqliteConnectionManager.select_journal_mode(cache_db)}")
+        with self.connection:
+            self.create_accession_genes_table(self.connection)
+
+    @staticmethod
+    def create_accession_genes_table(connection: sqlite3.Connection) -> None:
+        # synonyms and chromosomes are json lists, fetched and last_used are unix times
+        connection.execute('''CREATE TABLE IF NOT EXISTS accession_genes
+                           (accession_number TEXT NOT NULL PRIMARY KEY,
+                           found INTEGER NOT NULL,
+                           symbol TEXT,
+                           synonyms TEXT,
+                           type TEXT,
+                           chromosomes TEXT,
+                           fetched REAL NOT NULL,
+                           last_used REAL NOT NULL)''')
+        connection.execute("CREATE INDEX IF NOT EXISTS idx_accession_genes_last_used ON accession_genes (last_used)")
+
+    def fetch(self, accession_numbers: Iterable[str]) -> dict[str, Union[None, dict[str]]]:
+        # Returns the cached genes within the ttl, and marks every requested accession as used
+        now = time()
+        with self.connection:
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS requested_accessions (accession_number TEXT NOT NULL PRIMARY KEY)")
+            self.connection.execute("DELETE FROM requested_accessions")
+            self.connection.executemany("INSERT OR IGNORE INTO requested_accessions VALUES (?)",
+                                        ((accession_number,) for accession_number in accession_numbers))
+            sql_query = ("SELECT a.accession_number, a.found, a.symbol, a.synonyms, a.type, a.chromosomes "
+                         "FROM accession_genes a JOIN requested_accessions r ON a.accession_number = r.accession_number "
+                         "WHERE a.fetched >= ?")
+            genes = {row[0]: self.make_gene(row[2:]) if row[1] else None
+                     for row in self.connection.execute(sql_query, (now - self.ttl_seconds,))}
+            self.connection.execute("UPDATE accession_genes SET last_used = ? "
+                                    "WHERE accession_number IN (SELECT accession_number FROM requested_accessions)", (now,))
+        return genes
+
+    @classmethod
+    def make_gene(cls, values: tuple) -> dict[str]:
+        # Fields NCBI did not report are left out, as they are in its reports
+        gene = {}
+        for field, value in zip(cls.GENE_FIELDS, values):
+            if value is None:
+                continue
+            gene[field] = loads(value) if field in ["synonyms", "chromosomes"] else value
+        return gene
+
+    def store(self, genes: dict[str, Union[None, dict[str]]]) -> None:
+        now = time()
+        values = ((accession_number, gene is not None, *self.flatten_gene(gene or {}), now, now)
+                  for accession_number, gene in genes.items())
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO accession_genes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", values)
+            self.evict()
+
+    @classmethod
+    def flatten_gene(cls, gene: dict[str]) -> list:
+        values = []
+        for field in cls.GENE_FIELDS:
+            value = gene.get(field)
+            values.append(dumps(value) if field in ["synonyms", "chromosomes"] and value is not None else value)
+        return values
+
+    def evict(self) -> None:
+        excess_entries = self.connection.execute("SELECT COUNT(*) FROM accession_genes").fetchone()[0] - self.max_entries
+        if excess_entries <= 0:
+            return
+        print(f"Evicting {excess_entries:,} least recently used accessions from the cache")
+        self.connection.execute("DELETE FROM accession_genes WHERE accession_number IN "
+                                "(SELECT accession_number FROM accession_genes ORDER BY last_used LIMIT ?)", (excess_entries,))
+
+    def close(self) -> None:
+        self.connection.close()
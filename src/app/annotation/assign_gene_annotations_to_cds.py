@@ -3,6 +3,7 @@ from collections import defaultdict
 from csv import reader
 from pathlib import Path
 import sqlite3
+from sqlite_tools import SqliteBulkUpdater, SqliteConnectionManager
 from typing import Any
 
 class GeneAssigner:
@@ -35,7 +36,7 @@ class GeneAssigner:
                                                                          cds_id_best_gene_mapping, core_cds_ids)
         
         # Insert new metadata to CDS metadata table
-        with sqlite3.connect(self.sqlite_db) as connection:
+        with SqliteConnectionManager.bulk_load(self.sqlite_db) as connection:
             self.update_cds_table(connection, blast_results_metadata)
 
     @staticmethod
@@ -58,7 +59,7 @@ class GeneAssigner:
     @staticmethod
     def extract_transcriptome_filtered_cds_ids(sqlite_db: Path, transcriptome: str) -> set[int]:
         print(f"\nExtracting cds ids that belong to transcriptome: {transcriptome}")
-        with sqlite3.connect(sqlite_db) as connection:
+        with SqliteConnectionManager.connect(sqlite_db) as connection:
             cursor = connection.cursor()
             sql_query = ("SELECT c.uid "
                          "FROM cds c "
@@ -70,7 +71,7 @@ class GeneAssigner:
 
     @staticmethod
     def extract_accession_number_gene_symbol_mapping(sqlite_db: Path) -> dict[str]:
-        with sqlite3.connect(sqlite_db) as connection:
+        with SqliteConnectionManager.connect(sqlite_db) as connection:
             cursor = connection.cursor()
             sql_query = "SELECT accession_number,gene_symbol FROM accession_numbers"
             cursor.execute(sql_query)
@@ -131,7 +132,7 @@ class GeneAssigner:
 
     @staticmethod
     def extract_cds_id_len_mapping(sqlite_db: Path) -> dict[int]:
-        with sqlite3.connect(sqlite_db) as connection:
+        with SqliteConnectionManager.connect(sqlite_db) as connection:
             cursor = connection.cursor()
             sql_query = "SELECT uid,length FROM cds"
             cursor.execute(sql_query)
@@ -165,17 +166,12 @@ class GeneAssigner:
 
     @staticmethod
     def update_cds_table(connection: sqlite3.Connection, blast_results_metadata: dict[Any]) -> None:
-        cursor = connection.cursor()
         values = [(data["accession_number"], data["gene_symbol"],
                     data["unambiguous_gene"], data["core_cds"], uid)
                     for uid, data in blast_results_metadata.items()]
         
-        sql_statement = ("UPDATE cds "
-                            "SET accession_number = ?, gene_symbol = ?, "
-                            "unambiguous_gene = ?, core_cds = ? "
-                            "WHERE uid = ?")
-        cursor.executemany(sql_statement, values)
-        connection.commit()
+        columns = ["accession_number", "gene_symbol", "unambiguous_gene", "core_cds"]
+        SqliteBulkUpdater.update(connection, "cds", columns, values)
 
 if __name__ == "__main__":
     parser = ArgumentParser()
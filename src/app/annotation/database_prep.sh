@@ -27,4 +27,11 @@ make_nucleotide_blast_db() {
 	makeblastdb -in $1 -dbtype nucl -title $2 -parse_seqids -blastdb_version 5 -taxid $3 -out $4
 }
 
+# NCBI gene files for offline accession to gene symbol mapping
+pull-ncbi-gene-files() {
+	cd $1 \
+	&& wget https://ftp.ncbi.nlm.nih.gov/gene/DATA/gene2accession.gz \
+	&& wget https://ftp.ncbi.nlm.nih.gov/gene/DATA/gene_info.gz
+}
+
 "$@"
\ No newline at end of file
@@ -1,40 +1,261 @@
+from accession_gene_cache import AccessionGeneCache
 from argparse import ArgumentParser
+from collections import deque
+from contextlib import contextmanager
 from csv import reader
-from itertools import islice
-from json import loads
+from functools import partial
+from json import dumps, JSONDecodeError, loads
+from multiprocessing.pool import ThreadPool
+from offline_gene_resolver import OfflineGeneResolver
+from os import environ, fsync
 from pathlib import Path
+from queue import Empty, Queue
 import sqlite3
-import subprocess
-from typing import Iterator
+from sqlite_tools import SqliteConnectionManager
+from subprocess_tools import SubprocessRunner
+from threading import Lock
+from time import monotonic, sleep
+from typing import Any, IO, Iterator, Union
+
+class TokenBucket:
+    # Spaces out requests shared by several threads to at most rate per second, allowing bursts of up to capacity.
+    # Each caller takes a token, going into debt if none are left, and then sleeps until its token would have been
+    # refilled, so waiting callers are served in the order they arrived
+    def __init__(self, rate: float, capacity: int=1) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = monotonic()
+        self.lock = Lock()
+
+    def acquire(self) -> None:
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            sleep(wait)
+
+class AdaptiveDatasetsBatcher:
+    # Submits accession numbers to NCBI Datasets in batches sized by how quickly they are answered: new batches grow
+    # while answered within FAST_BATCH_SECONDS and shrink when slower than SLOW_BATCH_SECONDS. A batch that fails, or
+    # comes back without any reports, is split in halves that are retried first, so a malformed accession is isolated
+    # instead of failing the run. A single accession is given up on after MAX_ATTEMPTS, and left for the next run.
+    # Every failure pauses all submissions, for twice as long as the last after each consecutive failure, so an
+    # overloaded server is backed off from, while an isolated bad accession only costs short pauses.
+    # Answered batches are appended to a checkpoint file, so a killed run resumes from them
+    INITIAL_BATCH_SIZE = 500
+    MIN_BATCH_SIZE = 50
+    MAX_BATCH_SIZE = 2_000
+    FAST_BATCH_SECONDS = 30
+    SLOW_BATCH_SECONDS = 120
+    MAX_ATTEMPTS = 5
+    BASE_BACKOFF_SECONDS = 2
+    MAX_BACKOFF_SECONDS = 300
+
+    def __init__(self, workers: int=1, rate_limiter: Union[None, TokenBucket]=None, datasets_executable: str="datasets",
+                 checkpoint: Union[None, Path]=None) -> None:
+        self.workers = workers
+        self.rate_limiter = rate_limiter
+        self.datasets_executable = datasets_executable
+        self.checkpoint = checkpoint
+        self.batch_size = self.INITIAL_BATCH_SIZE
+
+    def run(self, accession_numbers: set[str]) -> dict[str, Union[None, dict[str]]]:
+        # Batches are run by worker threads, as they only wait on the datasets CLI, and merged in the order they finish
+        accession_numbers_genes = self.load_checkpoint(self.checkpoint, accession_numbers)
+        new_accession_numbers = sorted(acc for acc in accession_numbers if acc not in accession_numbers_genes)
+        print(f"Beginning NCBI Datasets batches ({self.workers} workers, {len(new_accession_numbers):,} accession numbers)")
+
+        # Retried batches are (accession numbers, failed attempts at this size)
+        retry_batches = deque()
+        unresolved_accession_numbers = []
+        finished_batches = Queue()
+        next_new = 0
+        running = 0
+        completed = 0
+        consecutive_failures = 0
+        resume_time = monotonic()
+        with ThreadPool(processes=self.workers) as pool, self.open_checkpoint(self.checkpoint) as checkpoint_handle:
+            while True:
+                pending = bool(retry_batches) or next_new < len(new_accession_numbers)
+                while pending and running < self.workers and monotonic() >= resume_time:
+                    if retry_batches:
+                        batch, attempts = retry_batches.popleft()
+                        new_batch = False
+                    else:
+                        batch, attempts = new_accession_numbers[next_new:next_new + self.batch_size], 0
+                        next_new += len(batch)
+                        new_batch = True
+                    pool.apply_async(self.submit_batch_proxy, ({"accession_numbers": batch, "attempts": attempts,
+                                                                "new_batch": new_batch},),
+                                     callback=finished_batches.put)
+                    running += 1
+                    pending = bool(retry_batches) or next_new < len(new_accession_numbers)
+                if not running and not pending:
+                    break
+
+                # Waits for a batch to finish, or until submissions resume after a backoff
+                try:
+                    timeout = max(0, resume_time - monotonic()) if pending and running < self.workers else None
+                    batch, attempts, new_batch, batch_genes, seconds = finished_batches.get(timeout=timeout)
+                except Empty:
+                    continue
+                running -= 1
+                if batch_genes:
+                    consecutive_failures = 0
+                    accession_numbers_genes.update(batch_genes)
+                    self.append_checkpoint(checkpoint_handle, batch_genes)
+                    if new_batch:
+                        self.adapt_batch_size(seconds)
+                    completed += 1
+                    if completed % 100 == 0:
+                        print(f"NCBI Datasets batch {completed} finished (batch size {self.batch_size})")
+                    continue
+
+                consecutive_failures += 1
+                resume_time = monotonic() + min(self.MAX_BACKOFF_SECONDS,
+                                                self.BASE_BACKOFF_SECONDS * 2**(consecutive_failures - 1))
+                if len(batch) > 1:
+                    half = len(batch) // 2
+                    retry_batches.extendleft([(batch[half:], 0), (batch[:half], 0)])
+                elif attempts + 1 < self.MAX_ATTEMPTS:
+                    retry_batches.append((batch, attempts + 1))
+                else:
+                    unresolved_accession_numbers.extend(batch)
+
+        if unresolved_accession_numbers:
+            print(f"{len(unresolved_accession_numbers):,} accession numbers could not be resolved, e.g. "
+                  f"{', '.join(unresolved_accession_numbers[:5])}")
+        print(f"\nNCBI Datasets batches complete\n")
+        return accession_numbers_genes
+
+    def submit_batch_proxy(self, input_data: dict[Any]) -> tuple[list[str], int, bool, dict[str, Union[None, dict[str]]], float]:
+        # Never raises, as the batch would otherwise never be reported as finished. A failure returns no genes
+        accession_numbers = input_data["accession_numbers"]
+        start_time = monotonic()
+        try:
+            batch_genes = AccessionGeneMapper.submit_accession_numbers_with_ncbi_datasets(
+                accession_numbers, rate_limiter=self.rate_limiter, datasets_executable=self.datasets_executable)
+        except Exception as e:
+            print(f"NCBI Datasets batch of {len(accession_numbers)} failed: {e}")
+            batch_genes = {}
+        return accession_numbers, input_data["attempts"], input_data["new_batch"], batch_genes, monotonic() - start_time
+
+    def adapt_batch_size(self, seconds: float) -> None:
+        if seconds < self.FAST_BATCH_SECONDS:
+            self.batch_size = min(self.MAX_BATCH_SIZE, int(self.batch_size * 1.5))
+        elif seconds > self.SLOW_BATCH_SECONDS:
+            self.batch_size = max(self.MIN_BATCH_SIZE, self.batch_size // 2)
+
+    @staticmethod
+    def load_checkpoint(checkpoint: Union[None, Path], accession_numbers: set[str]) -> dict[str, Union[None, dict[str]]]:
+        # Each line holds the genes of one answered batch. A line cut short by the run being killed is skipped
+        accession_numbers_genes = {}
+        if checkpoint is None or not checkpoint.exists():
+            return accession_numbers_genes
+        with checkpoint.open() as inhandle:
+            for line in inhandle:
+                try:
+                    batch_genes = loads(line)
+                except JSONDecodeError:
+                    continue
+                accession_numbers_genes.update((k, v) for k, v in batch_genes.items() if k in accession_numbers)
+        print(f"Resuming from checkpoint: {len(accession_numbers_genes):,} accession numbers already resolved")
+        return accession_numbers_genes
+
+    @staticmethod
+    @contextmanager
+    def open_checkpoint(checkpoint: Union[None, Path]) -> Iterator[Union[None, IO[str]]]:
+        if checkpoint is None:
+            yield None
+            return
+        with checkpoint.open("a") as outhandle:
+            yield outhandle
+
+    @staticmethod
+    def append_checkpoint(checkpoint_handle: Union[None, IO[str]], batch_genes: dict[str, Union[None, dict[str]]]) -> None:
+        if checkpoint_handle is None:
+            return
+        checkpoint_handle.write(dumps(batch_genes) + "\n")
+        checkpoint_handle.flush()
+        fsync(checkpoint_handle.fileno())
 
 class AccessionGeneMapper:
-    def __init__(self, blast_results: Path, sqlite_db: Path, table_name: str) -> None:
+    # NCBI Datasets allows 5 requests per second, or 10 with an API key (NCBI_API_KEY, which the datasets CLI reads)
+    # NOTE: A token is taken per datasets submission, which the CLI may split into several requests for large batches
+    DEFAULT_REQUESTS_PER_SECOND = 5
+    API_KEY_REQUESTS_PER_SECOND = 10
+
+    def __init__(self, blast_results: Path, sqlite_db: Path, table_name: str, workers: int=1,
+                 requests_per_second: Union[None, float]=None, datasets_executable: str="datasets",
+                 accession_cache: Union[None, AccessionGeneCache]=None,
+                 offline_resolver: Union[None, OfflineGeneResolver]=None, checkpoint: Union[None, Path]=None) -> None:
+        # Batches are submitted by a pool of worker threads, sharing one rate limit. datasets_executable may be
+        # replaced, e.g. by a stand-in printing canned json lines for testing offline. Only accessions missing from
+        # accession_cache (if given) are submitted. If offline_resolver is given, NCBI is not contacted at all.
+        # The checkpoint is removed once the mapping has been written to the table
         self.blast_results = blast_results
         self.sqlite_db = sqlite_db
         self.table_name = table_name
+        self.workers = workers
+        self.accession_cache = accession_cache
+        self.offline_resolver = offline_resolver
+        self.rate_limiter = TokenBucket(requests_per_second or self.set_default_requests_per_second())
+        self.datasets_executable = datasets_executable
+        self.checkpoint = checkpoint
+
+    @classmethod
+    def set_default_requests_per_second(cls) -> float:
+        if environ.get("NCBI_API_KEY"):
+            return cls.API_KEY_REQUESTS_PER_SECOND
+        return cls.DEFAULT_REQUESTS_PER_SECOND
 
     def run(self, rna_type: str, upper: bool=True) -> None:
+        # Checked here, as quitting from a worker thread would not stop the script
+        acceptable_gene_types = self.select_acceptable_gene_types(rna_type)
+
         # Extract non redundant accession numbers for submission to NCBI
         accession_numbers = self.extract_accession_numbers(self.blast_results)
         print(f"\nAll accession numbers count: {len(accession_numbers)}")
 
-        accession_numbers_gene_symbol_mapping = {}
-        batch_sizes = [500, 500]
-        for batch_size in batch_sizes:
-            remaining_accession_numbers = {acc for acc in accession_numbers if acc not in accession_numbers_gene_symbol_mapping}
-            accession_numbers_gene_symbol_mapping.update(
-                self.batch_ncbi_datasets_accession_gene_mapping(remaining_accession_numbers, rna_type, batch_size)
-                )
-            print(f"Mapping keys so far: {len(accession_numbers_gene_symbol_mapping)}")
+        # Genes are resolved whatever their type, so the cache can serve any rna_type, and filtered afterwards
+        if self.offline_resolver:
+            accession_numbers_genes = self.offline_resolver.resolve(accession_numbers)
+        else:
+            accession_numbers_genes = self.resolve_with_ncbi_datasets(accession_numbers)
 
+        accession_numbers_gene_symbol_mapping = self.select_gene_symbols(accession_numbers_genes, acceptable_gene_types)
         accession_numbers_gene_symbol_mapping = self.remove_extraneous_accession_numbers(accession_numbers_gene_symbol_mapping, accession_numbers)
         if upper:
             accession_numbers_gene_symbol_mapping = self.upper_case_genes(accession_numbers_gene_symbol_mapping)
 
-        with sqlite3.connect(self.sqlite_db) as connection:
+        with SqliteConnectionManager.bulk_load(self.sqlite_db) as connection:
             self.insert_accession_gene_mapping_into_table(connection, accession_numbers_gene_symbol_mapping, self.table_name)
 
-        print(f"Datasets mapping keys count: {len(accession_numbers_gene_symbol_mapping)}")
+        if self.checkpoint:
+            self.checkpoint.unlink(missing_ok=True)
+
+        print(f"Mapping keys count: {len(accession_numbers_gene_symbol_mapping)}")
+
+    def resolve_with_ncbi_datasets(self, accession_numbers: set[str]) -> dict[str, Union[None, dict[str]]]:
+        accession_numbers_genes = {}
+        if self.accession_cache:
+            accession_numbers_genes = self.accession_cache.fetch(accession_numbers)
+            print(f"Cached accession numbers count: {len(accession_numbers_genes)}")
+
+        remaining_accession_numbers = {acc for acc in accession_numbers if acc not in accession_numbers_genes}
+        fetched_accession_numbers_genes = {}
+        if remaining_accession_numbers:
+            batcher = AdaptiveDatasetsBatcher(self.workers, self.rate_limiter, self.datasets_executable, self.checkpoint)
+            fetched_accession_numbers_genes = batcher.run(remaining_accession_numbers)
+        print(f"Resolved accession numbers count: {len(accession_numbers_genes) + len(fetched_accession_numbers_genes)}")
+        if self.accession_cache:
+            self.accession_cache.store(fetched_accession_numbers_genes)
+        accession_numbers_genes.update(fetched_accession_numbers_genes)
+        return accession_numbers_genes
 
     @staticmethod
     def extract_accession_numbers(blast_results: Path) -> set[str]:
@@ -46,91 +267,98 @@ class AccessionGeneMapper:
                 accession_numbers.add(accession_number)
         return accession_numbers
 
-    @classmethod
-    def batch_ncbi_datasets_accession_gene_mapping(cls, accession_numbers: set[str], rna_type, batch_size: int=500) -> dict[str]:
-        print("Beginning NCBI Datasets batches")
-        accession_number_gene_symbol_mapping = {}
-        for i, accession_numbers_batch in enumerate(cls.chunk_set(accession_numbers, batch_size), 1):
-            accession_number_gene_symbol_mapping.update(
-                cls.submit_accession_numbers_with_ncbi_datasets(accession_numbers_batch, rna_type)
-                )
-            if i % 100 == 0:
-                print(f"NCBI Datasets batch {i} finished")
-        print(f"\nNCBI Datasets batches complete\n")
-        return accession_number_gene_symbol_mapping
-
-    @staticmethod
-    def chunk_set(data: set, chunk_size: int) -> Iterator[set]:
-        iterable = iter(data)
-        while True:
-            chunk = set(islice(iterable, chunk_size))
-            if not chunk:
-                break
-            yield chunk
-
     @staticmethod
-    def submit_accession_numbers_with_ncbi_datasets(accession_numbers: set[str], rna_type: str, quiet: bool=True) -> dict[str]:
+    def select_acceptable_gene_types(rna_type: str) -> list[str]:
         if rna_type == "coding":
-            acceptable_gene_types = ["PROTEIN_CODING"]
-        elif rna_type == "non_coding":
-            acceptable_gene_types = ["ncRNA", "rRNA", "snRNA", "snoRNA", "PSEUDO"]
-        else:
-            print(f"rna_type '{rna_type}' not recognized. Terminating script")
-            quit(1)
+            return ["PROTEIN_CODING"]
+        if rna_type == "non_coding":
+            return ["ncRNA", "rRNA", "snRNA", "snoRNA", "PSEUDO"]
+        print(f"rna_type '{rna_type}' not recognized. Terminating script")
+        quit(1)
 
+    @classmethod
+    def submit_accession_numbers_with_ncbi_datasets(cls, accession_numbers: list[str], quiet: bool=True,
+                                                    rate_limiter: Union[None, TokenBucket]=None,
+                                                    datasets_executable: str="datasets") -> dict[str, Union[None, dict[str]]]:
+        # Returns the gene fields reported for each accession number. If any were reported, the accession numbers
+        # without a report are returned as None, as NCBI did answer for them. A batch without any reports may
+        # instead have failed (see add_report_genes), so its accession numbers are left out to be submitted again
         if not quiet:
             print("Starting NCBI Datasets submission\n(This may take awhile)")
-        datasets_command = ["datasets", "summary", "gene", "accession"] + list(accession_numbers)
+        datasets_command = [datasets_executable, "summary", "gene", "accession"] + list(accession_numbers)
+        if rate_limiter:
+            rate_limiter.acquire()
 
-        p1 = subprocess.Popen(datasets_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        accession_numbers_genes = {}
+        stdout_handler = partial(cls.add_report_genes, accession_numbers_genes=accession_numbers_genes)
+        SubprocessRunner("Datasets submission", stdout_handler=stdout_handler, report_exit_code=False).run(datasets_command)
+        if accession_numbers_genes:
+            for accession_number in accession_numbers:
+                accession_numbers_genes.setdefault(accession_number, None)
 
-        accession_numbers_gene_mapping = {}
+        if not quiet:
+            print("NCBI Submission complete")
+        return accession_numbers_genes
+
+    @staticmethod
+    def add_report_genes(line: str, accession_numbers_genes: dict[str, Union[None, dict[str]]]) -> None:
+        data = loads(line)
+        try:
+            records = data["reports"]
+        except KeyError:
+            return # On iterations sometimes batches return empty jsons
 
-        while p1.poll() is None and (line := p1.stdout.readline()) != "":
-            data = loads(line)
+        for record in records:
             try:
-                records = data["reports"]
+                accession_number = record["query"][0]
             except KeyError:
-                continue # On iterations sometimes batches return empty jsons
+                continue # Can't use data without original accession number
 
-            for record in records:
-                try:
-                    accession_number = record["query"][0]
-                except KeyError:
-                    continue # Can't use data without original accession number
+            gene = record.get("gene", {})
+            accession_numbers_genes[accession_number] = {field: gene[field] for field in AccessionGeneCache.GENE_FIELDS
+                                                         if field in gene}
 
-                try:
-                    chromosomes = record["gene"]["chromosomes"]
-                    if len(chromosomes) == 1 and chromosomes[0] == "MT":
-                        continue # Currently mitochondrial hits tend to include the whole genome and are uninformative
-                except KeyError:
-                    pass
+    @classmethod
+    def select_gene_symbols(cls, accession_numbers_genes: dict[str, Union[None, dict[str]]],
+                            acceptable_gene_types: list[str]) -> dict[str]:
+        accession_numbers_gene_mapping = {}
+        for accession_number, gene in accession_numbers_genes.items():
+            if gene is None:
+                continue
+            gene_symbol = cls.select_gene_symbol(gene, acceptable_gene_types)
+            if gene_symbol is not None:
+                accession_numbers_gene_mapping[accession_number] = gene_symbol
+        return accession_numbers_gene_mapping
 
-                gene_symbol = record["gene"]["symbol"]
+    @staticmethod
+    def select_gene_symbol(gene: dict[str], acceptable_gene_types: list[str]) -> Union[None, str]:
+        try:
+            chromosomes = gene["chromosomes"]
+            if len(chromosomes) == 1 and chromosomes[0] == "MT":
+                return None # Currently mitochondrial hits tend to include the whole genome and are uninformative
+        except KeyError:
+            pass
 
-                if gene_symbol.startswith("LOC") or gene_symbol.startswith("CUN"):
-                    try:
-                        gene_symbol = record["gene"]["synonyms"][0] # Better to get a real gene symbol if possible
-                    except KeyError:
-                        pass
+        try:
+            gene_symbol = gene["symbol"]
+        except KeyError:
+            return None
 
-                try:
-                    gene_type = record["gene"]["type"]
-                except KeyError:
-                    continue # Some annotations lack this information, making it unreliable
+        if gene_symbol.startswith("LOC") or gene_symbol.startswith("CUN"):
+            try:
+                gene_symbol = gene["synonyms"][0] # Better to get a real gene symbol if possible
+            except KeyError:
+                pass
 
-                if gene_type not in acceptable_gene_types:
-                    continue
+        try:
+            gene_type = gene["type"]
+        except KeyError:
+            return None # Some annotations lack this information, making it unreliable
 
-                accession_numbers_gene_mapping[accession_number] = gene_symbol
-        p1.wait()
+        if gene_type not in acceptable_gene_types:
+            return None
 
-        if p1.poll() != 0:
-            print(p1.stderr.readlines())
-            raise Exception("Datasets submission did not complete successfully")
-        if not quiet:
-            print("NCBI Submission complete")
-        return accession_numbers_gene_mapping
+        return gene_symbol
 
     @staticmethod
     def remove_extraneous_accession_numbers(accession_numbers_gene_mapping: dict[str], accession_numbers: set[str]):
@@ -148,7 +376,6 @@ class AccessionGeneMapper:
         values = [(acc, gene) for acc, gene in accession_numbers_gene_symbol_mapping.items()]
         sql_statement = f"INSERT INTO {table_name} VALUES (?, ?)"
         cursor.executemany(sql_statement, values)
-        connection.commit()
 
 if __name__ == "__main__":
     parser = ArgumentParser()
@@ -156,7 +383,37 @@ if __name__ == "__main__":
     parser.add_argument("-sqlite_db", type=str, required=True)
     parser.add_argument("-table_name", type=str, required=True)
     parser.add_argument("-rna_type", type=str, required=True)
+    parser.add_argument("-workers", type=int, required=False, default=4)
+    parser.add_argument("-requests_per_second", type=float, required=False)
+    parser.add_argument("-datasets_executable", type=str, required=False, default="datasets")
+    parser.add_argument("-accession_cache", type=str, required=False)
+    parser.add_argument("-cache_ttl_days", type=float, required=False, default=30)
+    parser.add_argument("-cache_max_entries", type=int, required=False, default=2_000_000)
+    parser.add_argument("-no_cache", action="store_true", required=False)
+    parser.add_argument("-offline_gene_db", type=str, required=False)
+    parser.add_argument("-gene2accession", type=str, required=False)
+    parser.add_argument("-gene_info", type=str, required=False)
+    parser.add_argument("-tax_ids", type=str, nargs="+", required=False)
+    parser.add_argument("-checkpoint", type=str, required=False)
     args = parser.parse_args()
 
-    agm = AccessionGeneMapper(Path(args.blast_results), Path(args.sqlite_db), args.table_name)
+    # Offline mode resolves accessions from a local lookup, built first if the NCBI gene files are given
+    offline_resolver = None
+    if args.offline_gene_db:
+        offline_resolver = OfflineGeneResolver(Path(args.offline_gene_db))
+        if args.gene2accession and args.gene_info:
+            offline_resolver.build(Path(args.gene2accession), Path(args.gene_info), set(args.tax_ids or []))
+
+    # The cache is kept next to tatat.db unless placed elsewhere, e.g. to share it between projects
+    accession_cache = None
+    if not args.no_cache and not offline_resolver:
+        accession_cache_db = Path(args.accession_cache) if args.accession_cache else Path(args.sqlite_db).parent / "accession_cache.db"
+        accession_cache = AccessionGeneCache(accession_cache_db, args.cache_ttl_days, args.cache_max_entries)
+
+    # Completed Datasets batches are checkpointed next to the blast results unless placed elsewhere
+    checkpoint = Path(args.checkpoint) if args.checkpoint else Path(f"{args.blast_results}.checkpoint.jsonl")
+
+    agm = AccessionGeneMapper(Path(args.blast_results), Path(args.sqlite_db), args.table_name,
+                              args.workers, args.requests_per_second, args.datasets_executable, accession_cache,
+                              offline_resolver, checkpoint)
     agm.run(args.rna_type)
\ No newline at end of file
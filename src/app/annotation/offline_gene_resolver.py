@@ -0,0 +1,128 @@
+from accession_gene_cache import AccessionGeneCache
+import gzip
+from json import dumps
+from pathlib import Path
+import sqlite3
+from sqlite_tools import SqliteConnectionManager
+from typing import IO, Iterable, Iterator, Union
+
+class OfflineGeneResolver:
+    # Resolves accession numbers to genes without network access, from a sqlite lookup built from NCBI's gene2accession
+    # and gene_info files (https://ftp.ncbi.nlm.nih.gov/gene/DATA/). Genes have the same fields as NCBI Datasets
+    # reports, so are filtered the same way. Only RNA nucleotide accessions are indexed, without their version, as
+    # blastn's sacc has none. An accession listed for several genes is resolved to the smallest GeneID
+    # NOTE: gene_info types are converted to their Datasets names, e.g. "protein-coding" to "PROTEIN_CODING"
+    GENE_TYPES = {"protein-coding": "PROTEIN_CODING",
+                  "pseudo": "PSEUDO",
+                  "miscRNA": "MISC_RNA",
+                  "biological-region": "BIOLOGICAL_REGION",
+                  "other": "OTHER",
+                  "unknown": "UNKNOWN"}
+    BUILD_PRAGMAS = {"journal_mode": "OFF", "synchronous": "OFF", "cache_size": -262_144}
+    PROGRESS_INTERVAL = 10_000_000
+
+    def __init__(self, gene_db: Path) -> None:
+        self.gene_db = gene_db
+
+    def build(self, gene2accession: Path, gene_info: Path, tax_ids: Union[None, set[str]]=None) -> None:
+        # Built in a temporary file that replaces gene_db once complete, so an interrupted build is never used.
+        # Accessions are staged unsorted and then inserted in key order, as gene2accession lists them in taxon order
+        print(f"Building offline gene lookup: {self.gene_db}\n(This may take awhile)")
+        tmp_gene_db = self.gene_db.with_name(f"{self.gene_db.name}.tmp")
+        tmp_gene_db.unlink(missing_ok=True)
+        connection = sqlite3.connect(tmp_gene_db)
+        SqliteConnectionManager.set_pragmas(connection, self.BUILD_PRAGMAS)
+        with connection:
+            self.create_tables(connection)
+            connection.execute("CREATE TEMP TABLE staged_accessions (accession_number TEXT NOT NULL, gene_id INTEGER NOT NULL)")
+            connection.executemany("INSERT INTO staged_accessions VALUES (?, ?)",
+                                   self.parse_gene2accession(gene2accession, tax_ids))
+            connection.execute("INSERT OR IGNORE INTO accession_genes SELECT accession_number, gene_id "
+                               "FROM staged_accessions ORDER BY accession_number, gene_id")
+            connection.execute("DROP TABLE staged_accessions")
+            connection.executemany("INSERT OR IGNORE INTO genes VALUES (?, ?, ?, ?, ?)", self.parse_gene_info(gene_info, tax_ids))
+            accession_count = connection.execute("SELECT COUNT(*) FROM accession_genes").fetchone()[0]
+            gene_count = connection.execute("SELECT COUNT(*) FROM genes").fetchone()[0]
+        connection.close()
+        tmp_gene_db.replace(self.gene_db)
+        print(f"Offline gene lookup built: {accession_count:,} accessions, {gene_count:,} genes")
+
+    @staticmethod
+    def create_tables(connection: sqlite3.Connection) -> None:
+        # genes columns follow AccessionGeneCache.GENE_FIELDS, with synonyms and chromosomes as json lists
+        connection.execute('''CREATE TABLE accession_genes
+                           (accession_number TEXT NOT NULL PRIMARY KEY,
+                           gene_id INTEGER NOT NULL) WITHOUT ROWID''')
+        connection.execute('''CREATE TABLE genes
+                           (gene_id INTEGER NOT NULL PRIMARY KEY,
+                           symbol TEXT,
+                           synonyms TEXT,
+                           type TEXT,
+                           chromosomes TEXT)''')
+
+    @staticmethod
+    def open_flat_file(path: Path) -> IO[str]:
+        if path.suffix == ".gz":
+            return gzip.open(path, "rt")
+        return path.open()
+
+    @classmethod
+    def parse_gene2accession(cls, gene2accession: Path, tax_ids: Union[None, set[str]]=None) -> Iterator[tuple[str, int]]:
+        # Columns: tax_id, GeneID, status, RNA_nucleotide_accession.version, ...
+        print(f"Reading {gene2accession.name}")
+        with cls.open_flat_file(gene2accession) as inhandle:
+            for i, line in enumerate(inhandle, 1):
+                if i % cls.PROGRESS_INTERVAL == 0:
+                    print(f"{i:,} {gene2accession.name} lines read")
+                if line.startswith("#"):
+                    continue
+                fields = line.split("\t", 4)
+                if tax_ids and fields[0] not in tax_ids:
+                    continue
+                if fields[3] == "-":
+                    continue
+                yield fields[3].partition(".")[0], int(fields[1])
+
+    @classmethod
+    def parse_gene_info(cls, gene_info: Path, tax_ids: Union[None, set[str]]=None) -> Iterator[tuple]:
+        # Columns: tax_id, GeneID, Symbol, LocusTag, Synonyms, dbXrefs, chromosome, map_location, description,
+        # type_of_gene, ... with "|" separated lists and "-" for missing values
+        print(f"Reading {gene_info.name}")
+        with cls.open_flat_file(gene_info) as inhandle:
+            for line in inhandle:
+                if line.startswith("#"):
+                    continue
+                fields = line.split("\t", 10)
+                if tax_ids and fields[0] not in tax_ids:
+                    continue
+                yield (int(fields[1]),
+                       fields[2],
+                       cls.format_list_field(fields[4]),
+                       cls.GENE_TYPES.get(fields[9], fields[9]),
+                       cls.format_list_field(fields[6]))
+
+    @staticmethod
+    def format_list_field(value: str) -> Union[None, str]:
+        if value == "-":
+            return None
+        return dumps(value.split("|"))
+
+    def resolve(self, accession_numbers: Iterable[str]) -> dict[str, Union[None, dict[str]]]:
+        # Returns the gene of each accession number, or None if it is not in the lookup
+        if not self.gene_db.exists():
+            raise Exception(f"Offline gene lookup does not exist: {self.gene_db}")
+        print("Resolving accession numbers with the offline gene lookup")
+        accession_numbers = list(accession_numbers)
+        connection = sqlite3.connect(f"{self.gene_db.resolve().as_uri()}?mode=ro", uri=True)
+        try:
+            connection.execute("CREATE TEMP TABLE requested_accessions (accession_number TEXT NOT NULL, lookup_accession TEXT NOT NULL)")
+            connection.executemany("INSERT INTO requested_accessions VALUES (?, ?)",
+                                   ((accession_number, accession_number.partition(".")[0]) for accession_number in accession_numbers))
+            sql_query = ("SELECT r.accession_number, g.symbol, g.synonyms, g.type, g.chromosomes "
+                         "FROM requested_accessions r "
+                         "JOIN accession_genes a ON a.accession_number = r.lookup_accession "
+                         "JOIN genes g ON g.gene_id = a.gene_id")
+            genes = {row[0]: AccessionGeneCache.make_gene(row[1:]) for row in connection.execute(sql_query)}
+        finally:
+            connection.close()
+        return {accession_number: genes.get(accession_number) for accession_number in accession_numbers}
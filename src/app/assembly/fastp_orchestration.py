@@ -1,7 +1,8 @@
 from argparse import ArgumentParser
 from pathlib import Path
-import sqlite3
-import subprocess
+from sqlite_tools import SqliteConnectionManager
+from stage_metrics import StageMetricsRecorder
+from subprocess_tools import SubprocessRunner
 
 class FastqPathManager:
     def __init__(self, fastq_dir: Path, sqlite_db : Path, uid: str, outdir: Path) -> None:
@@ -11,7 +12,7 @@ class FastqPathManager:
 
     @staticmethod
     def extract_file_names(sqlite_db: Path, uid: str) -> list[str]:
-        with sqlite3.connect(sqlite_db, timeout=600) as connection:
+        with SqliteConnectionManager.connect(sqlite_db) as connection:
             cursor = connection.cursor()
             sql_query = ("SELECT uid,r1_reads,r2_reads "
                          "FROM samples "
@@ -39,9 +40,11 @@ class FastqPathManager:
         return output_fastqs
 
 class FastpManager:
-    def __init__(self, input_fastqs: list[Path], output_fastqs: list[Path]) -> None:
+    def __init__(self, input_fastqs: list[Path], output_fastqs: list[Path], sqlite_db: Path, uid: str) -> None:
         self.input_fastqs = input_fastqs
         self.output_fastqs = output_fastqs
+        self.sqlite_db = sqlite_db
+        self.uid = uid
 
     def run_fastp(self, r1_adapter: str, r2_adapter: str, cpus: int) -> None:
         if len(self.input_fastqs) == 2:
@@ -58,14 +61,9 @@ class FastpManager:
                             "--adapter_sequence", r1_adapter,
                             "--thread", f"{cpus}"]
 
-        p = subprocess.Popen(fastp_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        while p.poll() is None and (line := p.stderr.readline()) != "":
-            print(line.strip())
-        p.wait()
-        print(f"Exit code: {p.poll()}")
-
-        if p.poll() != 0:
-            raise Exception("Fastp did not complete successfully")
+        # fastp logs to stderr
+        metrics_handler = StageMetricsRecorder.make_handler(self.sqlite_db, "fastp", self.uid)
+        SubprocessRunner("Fastp", echo_stderr=True, metrics_handler=metrics_handler).run(fastp_command)
 
 if __name__ == "__main__":
     parser = ArgumentParser()
@@ -80,5 +78,5 @@ if __name__ == "__main__":
 
     fpm = FastqPathManager(Path(args.fastq_dir), Path(args.sqlite_db), args.uid, Path(args.outdir))
 
-    fm = FastpManager(fpm.uid_fastq_paths, fpm.output_fastq_paths)
+    fm = FastpManager(fpm.uid_fastq_paths, fpm.output_fastq_paths, Path(args.sqlite_db), args.uid)
     fm.run_fastp(args.r1_adapter, args.r2_adapter, args.cpus)
\ No newline at end of file
@@ -1,6 +1,9 @@
 import argparse
 from pathlib import Path
+from stage_metrics import StageMetricsRecorder
 import subprocess
+from subprocess_tools import SubprocessRunner
+from typing import Union
 
 class FastqAssemblyPathManager:
     def __init__(self, fastq_dir: Path, unique_identifier: str, assembly_dir: Path, collated_dir: Path) -> None:
@@ -28,12 +31,16 @@ class FastqAssemblyPathManager:
         return assembly_dir
 
 class RnaspadesManager:
-    def __init__(self, fastq_paths: list[Path], assembly_dir: Path, output_collated_path: Path, cpus: int, memory: int) -> None:
+    def __init__(self, fastq_paths: list[Path], assembly_dir: Path, output_collated_path: Path, cpus: int, memory: int,
+                 sqlite_db: Union[None, Path]=None, unique_identifier: str="") -> None:
+        # Resource usage is recorded in the stage_metrics table if a sqlite db is given
         self.fastq_paths = fastq_paths
         self.assembly_dir = assembly_dir
         self.output_collated_path = output_collated_path
         self.cpus = cpus
         self.memory = memory
+        self.sqlite_db = sqlite_db
+        self.unique_identifier = unique_identifier
 
     def run(self) -> None:
         rnaspades_assembly_path = self.run_rnaspades()
@@ -55,16 +62,8 @@ class RnaspadesManager:
                                "-t", f"{self.cpus}",
                                "-m", f"{self.memory}"]
 
-        p = subprocess.Popen(rnaspades_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        while p.poll() is None and (line := p.stdout.readline()) != "":
-            print(line.strip())
-        p.wait()
-        print(f"Exit code: {p.poll()}")
-        for line in p.stderr:
-            print(line)
-
-        if p.poll() != 0:
-            raise Exception("rnaSPAdes did not complete successfully")
+        metrics_handler = StageMetricsRecorder.make_handler(self.sqlite_db, "rnaspades", self.unique_identifier)
+        SubprocessRunner("rnaSPAdes", echo_stderr=True, metrics_handler=metrics_handler).run(rnaspades_command)
 
         rnaspades_fasta_path = Path(f"{self.assembly_dir}/transcripts.fasta")
         return rnaspades_fasta_path
@@ -86,9 +85,12 @@ if __name__ == "__main__":
     parser.add_argument("-unique_identifier", type=str, required=True)
     parser.add_argument("-cpus", type=int, required=True)
     parser.add_argument("-memory", type=int, required=True)
+    parser.add_argument("-sqlite_db", type=str, required=False)
     args = parser.parse_args()
 
     fapm = FastqAssemblyPathManager(Path(args.fastq_dir), args.unique_identifier, Path(args.assembly_dir), Path(args.collated_dir))
 
-    rm = RnaspadesManager(fapm.uid_fastq_paths, fapm.assembly_dir, fapm.output_collated_path, args.cpus, args.memory)
+    sqlite_db = Path(args.sqlite_db) if args.sqlite_db else None
+    rm = RnaspadesManager(fapm.uid_fastq_paths, fapm.assembly_dir, fapm.output_collated_path, args.cpus, args.memory,
+                          sqlite_db, args.unique_identifier)
     rm.run()
\ No newline at end of file
@@ -1,6 +1,6 @@
 from argparse import ArgumentParser
 from pathlib import Path
-import sqlite3
+from sqlite_tools import SqliteConnectionManager
 import subprocess
 
 class SraReadDownload:
@@ -44,7 +44,7 @@ class SraReadDownload:
     @staticmethod
     def update_samples_table_read_file_names(sqlite_db: Path, accession_number: str,
                                              fastq_files: list[Path]) -> None:
-        with sqlite3.connect(sqlite_db, timeout=600) as connection:
+        with SqliteConnectionManager.connect(sqlite_db) as connection:
             cursor = connection.cursor()
             for i, fastq_file in enumerate(fastq_files, 1):
                 sql_statement = f"UPDATE samples SET r{i}_reads = ? WHERE uid = ?"
@@ -0,0 +1,108 @@
+from argparse import ArgumentParser
+from pathlib import Path
+from random import Random
+import shutil
+import sqlite3
+from sqlite_tools import SqliteBulkUpdater, SqliteConnectionManager
+from time import perf_counter
+from typing import Callable
+
+class SqliteBulkUpdateBenchmark:
+    def __init__(self, sqlite_db: Path) -> None:
+        self.sqlite_db = sqlite_db
+
+    def run(self, update_fraction: float, seed: int=0) -> None:
+        with SqliteConnectionManager.connect(self.sqlite_db) as connection:
+            transcript_count = connection.execute("SELECT COUNT(*) FROM transcripts").fetchone()[0]
+        values = self.generate_evigene_values(transcript_count, update_fraction, seed)
+        print(f"Benchmarking updating {len(values):,} of {transcript_count:,} transcripts rows: {self.sqlite_db}")
+
+        updaters = {"executemany UPDATE": self.executemany_update,
+                    "SqliteBulkUpdater.update": self.staging_update}
+
+        results = {}
+        for updater_name, updater in updaters.items():
+            results[updater_name] = self.time_updater(updater, values)
+            print(f"{updater_name}: {results[updater_name]:.2f} s, {len(values) / results[updater_name]:,.0f} rows/s")
+
+        baseline = results["executemany UPDATE"]
+        for updater_name, seconds in results.items():
+            print(f"{updater_name} speedup: {baseline / seconds:.2f}x")
+
+    def time_updater(self, updater: Callable[[sqlite3.Connection, list[tuple]], None], values: list[tuple]) -> float:
+        # Each updater gets a fresh copy of the database, with the same bulk load PRAGMAs and indexes as the pipeline.
+        # The timing includes the commit, but not the index updates bulk_load runs afterwards
+        benchmark_db = self.sqlite_db.with_suffix(".benchmark.db")
+        shutil.copyfile(self.sqlite_db, benchmark_db)
+        try:
+            with SqliteConnectionManager.bulk_transaction(benchmark_db) as connection:
+                start = perf_counter()
+                updater(connection, values)
+            seconds = perf_counter() - start
+            self.verify_update(connection, values)
+        finally:
+            SqliteConnectionManager.close_connections()
+            benchmark_db.unlink()
+            for suffix in ["-wal", "-shm"]:
+                Path(f"{benchmark_db}{suffix}").unlink(missing_ok=True)
+        return seconds
+
+    @staticmethod
+    def executemany_update(connection: sqlite3.Connection, values: list[tuple]) -> None:
+        # NOTE: Copy of the per row update previously used by the pipeline, kept as the baseline
+        sql_statement = "UPDATE transcripts SET transcript_class = ?, evigene_pass = ? WHERE uid = ?"
+        connection.executemany(sql_statement, values)
+
+    @staticmethod
+    def staging_update(connection: sqlite3.Connection, values: list[tuple]) -> None:
+        SqliteBulkUpdater.update(connection, "transcripts", ["transcript_class", "evigene_pass"], values)
+
+    @staticmethod
+    def verify_update(connection: sqlite3.Connection, values: list[tuple]) -> None:
+        sql_query = "SELECT COUNT(*) FROM transcripts WHERE transcript_class IS NOT NULL"
+        updated_count = connection.execute(sql_query).fetchone()[0]
+        if updated_count != len(values):
+            raise Exception(f"Expected {len(values):,} updated rows, found {updated_count:,}")
+
+    @staticmethod
+    def generate_evigene_values(transcript_count: int, update_fraction: float, seed: int) -> list[tuple]:
+        # Evigene output is grouped by class rather than ordered by uid, so the updates arrive in random uid order
+        rng = Random(seed)
+        uids = rng.sample(range(1, transcript_count + 1), int(transcript_count * update_fraction))
+        transcript_classes = [("okay", 1), ("okalt", 1), ("drop", 0)]
+        return [(*rng.choice(transcript_classes), uid) for uid in uids]
+
+    @staticmethod
+    def generate_sqlite_db(sqlite_db: Path, transcript_count: int) -> None:
+        # Generates a transcripts table with the pipeline schema, as left by merge_fastas before evigene runs
+        print(f"Generating benchmark sqlite db with {transcript_count:,} transcripts: {sqlite_db}")
+        sqlite_db.unlink(missing_ok=True)
+        with SqliteConnectionManager.bulk_load(sqlite_db) as connection:
+            connection.execute('''CREATE TABLE transcripts
+                               (uid INTEGER NOT NULL PRIMARY KEY,
+                               sample_uid TEXT NOT NULL,
+                               length INTEGER NOT NULL,
+                               transcript_class TEXT,
+                               evigene_pass INTEGER,
+                               cds_ids TEXT,
+                               coverage REAL,
+                               node_id INTEGER,
+                               isoform_group INTEGER,
+                               isoform INTEGER)''')
+            values = ((uid, f"SRR{uid % 50:08d}", 200 + uid % 5_000) for uid in range(1, transcript_count + 1))
+            connection.executemany("INSERT INTO transcripts (uid, sample_uid, length) VALUES (?, ?, ?)", values)
+        SqliteConnectionManager.close_connections()
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-sqlite_db", type=str, required=True)
+    parser.add_argument("-generate_transcripts", type=int, required=False)
+    parser.add_argument("-update_fraction", type=float, default=1.0, required=False)
+    args = parser.parse_args()
+
+    sqlite_db = Path(args.sqlite_db)
+    if args.generate_transcripts:
+        SqliteBulkUpdateBenchmark.generate_sqlite_db(sqlite_db, args.generate_transcripts)
+
+    sbub = SqliteBulkUpdateBenchmark(sqlite_db)
+    sbub.run(args.update_fraction)
@@ -0,0 +1,60 @@
+from itertools import product
+import numpy as np
+
+class CodonTranslator:
+    # Nucleotides are encoded as 4 bit IUPAC masks (A=1, C=2, G=4, T=8, N=15, etc.), so each codon maps to
+    # one of 16**3 lookup table entries. Ambiguous codons translate to the amino acid shared by every codon
+    # they could represent (e.g. "GGN" -> "G"), otherwise "X". Unrecognized characters are encoded as 0,
+    # which always translates to "X"
+    IUPAC_MASKS = {"A": 1, "C": 2, "G": 4, "T": 8, "U": 8,
+                   "R": 5, "Y": 10, "S": 6, "W": 9, "K": 12, "M": 3,
+                   "B": 14, "D": 13, "H": 11, "V": 7, "N": 15}
+    MASK_BASES = {1: "A", 2: "C", 4: "G", 8: "T"}
+
+    def __init__(self, codon_to_aa: dict[str]) -> None:
+        self.nucleotide_encoding = self.make_nucleotide_encoding(self.IUPAC_MASKS)
+        self.codon_table = self.make_codon_table(codon_to_aa, self.MASK_BASES)
+
+    @staticmethod
+    def make_nucleotide_encoding(iupac_masks: dict[int]) -> np.ndarray:
+        encoding = np.zeros(256, dtype=np.uint8)
+        for nucleotide, mask in iupac_masks.items():
+            encoding[ord(nucleotide)] = mask
+            encoding[ord(nucleotide.lower())] = mask
+        return encoding
+
+    @classmethod
+    def make_codon_table(cls, codon_to_aa: dict[str], mask_bases: dict[str]) -> np.ndarray:
+        codon_table = np.full(16**3, ord("X"), dtype=np.uint8)
+        for masks in product(range(1, 16), repeat=3):
+            expanded_codons = product(*[cls.expand_mask(mask, mask_bases) for mask in masks])
+            amino_acids = {codon_to_aa["".join(codon)] for codon in expanded_codons}
+            if len(amino_acids) == 1:
+                codon_table[masks[0] * 256 + masks[1] * 16 + masks[2]] = ord(amino_acids.pop())
+        return codon_table
+
+    @staticmethod
+    def expand_mask(mask: int, mask_bases: dict[str]) -> list[str]:
+        return [base for bit, base in mask_bases.items() if mask & bit]
+
+    def translate_batch(self, dna_sequences: list[str]) -> list[str]:
+        # All sequences are concatenated and translated in one pass. Sequences are padded to whole codons
+        # with an unrecognized character, so an incomplete final codon translates to "X"
+        if not dna_sequences:
+            return []
+        padded_sequences = [sequence + "?" * (-len(sequence) % 3) for sequence in dna_sequences]
+        encoded = self.nucleotide_encoding[np.frombuffer("".join(padded_sequences).encode("ascii", "replace"), dtype=np.uint8)]
+        codons = encoded.reshape(-1, 3).astype(np.uint16)
+        codon_indices = (codons[:, 0] << 8) | (codons[:, 1] << 4) | codons[:, 2]
+        amino_acids = self.codon_table[codon_indices].tobytes().decode()
+
+        aa_sequences = []
+        start = 0
+        for sequence in padded_sequences:
+            end = start + len(sequence) // 3
+            aa_sequences.append(amino_acids[start:end])
+            start = end
+        return aa_sequences
+
+    def translate(self, dna_sequence: str) -> str:
+        return self.translate_batch([dna_sequence])[0]
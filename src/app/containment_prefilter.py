@@ -0,0 +1,214 @@
+from fasta_tools import FastaParser, IndexedFastaReader
+import numpy as np
+from pathlib import Path
+from typing import Any, Iterable, Iterator
+
+class ContainmentPrefilter:
+    # Finds ncrna candidates that are exact substrings, on either strand, of a cds (run ahead of cd-hit-est-2d) or of a
+    # longer candidate (run on the cd-hit-est-2d output, ahead of cd-hit-est). Each candidate is sketched by its anchor,
+    # the canonical k-mer with the smallest hash. Any sequence containing the candidate must also contain its anchor,
+    # so only k-mers matching an anchor are indexed, and every containment found through the index is confirmed with a
+    # substring search. Candidates of equal length are only contained by an identical candidate with a smaller uid,
+    # so one is kept.
+    # NOTE: Near-complete containments are left to CD-HIT, as a shared sketch cannot confirm 99% identity
+    KMER_SIZE = 21
+    MAX_HASH = np.uint64(2**64 - 1)
+    # Anchors shared by more sequences than this (e.g. repeats) are not searched, and left to CD-HIT
+    MAX_CONTAINERS = 64
+    BATCH_BASES = 2_097_152
+    COMPLEMENT = bytes.maketrans(b"ACGT", b"TGCA")
+
+    def __init__(self) -> None:
+        self.base_encoding = self.make_base_encoding()
+
+    def find_cds_contained_ncrna(self, cds_fasta: Path, transcripts_fasta: Path,
+                                 ncrna_ids: set[int]) -> dict[int, tuple[str, str]]:
+        # Returns the reason and containing cds for each contained candidate. cd-hit-est-2d would remove all of
+        # these, as they match a cds at 100% identity over their whole length
+        print("\nPrefiltering ncrna candidates contained in cds")
+        cds_names, cds_sequences = self.load_cds_sequences(cds_fasta)
+        ncrna_records = IndexedFastaReader(transcripts_fasta).fetch_raw_sequences(ncrna_ids)
+        ncrna_names, ncrna_sequences = self.sort_ncrna_sequences(ncrna_records)
+        contained_ncrna = self.find_contained_sequences(ncrna_names, ncrna_sequences, cds_names, cds_sequences,
+                                                        "cds_substring")
+        print(f"{len(contained_ncrna):,} of {len(ncrna_names):,} ncrna candidates contained in cds and removed")
+        return contained_ncrna
+
+    def find_ncrna_contained_ncrna(self, ncrna_fasta: Path) -> dict[int, tuple[str, str]]:
+        # Returns the reason and containing candidate for each contained candidate. Only candidates left after
+        # cd-hit-est-2d are compared, so a container is never one that cd-hit-est would not see.
+        # NOTE: cd-hit-est clusters a contained candidate with its container, unless the container itself joins a
+        # third candidate's cluster, to which the contained candidate may fall below 99% identity
+        print("\nPrefiltering ncrna candidates contained in longer candidates")
+        ncrna_records = ((int(header.split()[0]), sequence.encode()) for header, sequence in FastaParser.parse(ncrna_fasta))
+        ncrna_names, ncrna_sequences = self.sort_ncrna_sequences(ncrna_records)
+        contained_ncrna = self.find_contained_sequences(ncrna_names, ncrna_sequences, ncrna_names, ncrna_sequences,
+                                                        "ncrna_substring")
+        print(f"{len(contained_ncrna):,} of {len(ncrna_names):,} ncrna candidates contained in longer candidates and removed")
+        return contained_ncrna
+
+    @staticmethod
+    def make_base_encoding() -> np.ndarray:
+        # Any non ACGT character is encoded as 4, so k-mers including it are never used
+        encoding = np.full(256, 4, dtype=np.uint8)
+        for code, base in enumerate("ACGT"):
+            encoding[ord(base)] = code
+            encoding[ord(base.lower())] = code
+        return encoding
+
+    @staticmethod
+    def load_cds_sequences(cds_fasta: Path) -> tuple[list[str], list[bytes]]:
+        names = []
+        sequences = []
+        for header, sequence in FastaParser.parse(cds_fasta):
+            if sequence:
+                names.append(header.split()[0])
+                sequences.append(sequence.encode().upper())
+        return names, sequences
+
+    @staticmethod
+    def sort_ncrna_sequences(ncrna_records: Iterable[tuple[int, bytes]]) -> tuple[list[int], list[bytes]]:
+        # Candidates are kept in uid order, so a sequence index orders equal length candidates
+        ncrna_sequences = {}
+        for ncrna_id, sequence in ncrna_records:
+            sequence = sequence.translate(None, b"\r\n").upper()
+            if sequence:
+                ncrna_sequences[ncrna_id] = sequence
+        ncrna_names = sorted(ncrna_sequences)
+        return ncrna_names, [ncrna_sequences[ncrna_id] for ncrna_id in ncrna_names]
+
+    @classmethod
+    def batch_sequences(cls, sequences: list[bytes]) -> Iterator[tuple[int, list[bytes]]]:
+        # Yields (index of first sequence, sequences) with roughly BATCH_BASES bases per batch
+        batch_start = 0
+        batch_bases = 0
+        for i, sequence in enumerate(sequences):
+            if batch_bases and batch_bases + len(sequence) > cls.BATCH_BASES:
+                yield batch_start, sequences[batch_start:i]
+                batch_start = i
+                batch_bases = 0
+            batch_bases += len(sequence)
+        if batch_start < len(sequences):
+            yield batch_start, sequences[batch_start:]
+
+    def calculate_kmer_hashes(self, sequences: list[bytes]) -> tuple[np.ndarray, np.ndarray]:
+        # Returns the canonical k-mer hash starting at every position of the concatenated sequences, and the start of
+        # each sequence. Positions without a complete k-mer of ACGT bases in their own sequence are set to MAX_HASH
+        lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+        starts = np.zeros(len(sequences), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=starts[1:])
+        codes = self.base_encoding[np.frombuffer(b"".join(sequences), dtype=np.uint8)]
+        hashes = np.full(len(codes), self.MAX_HASH, dtype=np.uint64)
+        kmer_count = len(codes) - self.KMER_SIZE + 1
+        if kmer_count <= 0:
+            return hashes, starts
+
+        bases = (codes & 3).astype(np.uint64)
+        forward = self.pack_kmers(bases, self.KMER_SIZE, False)
+        reverse = self.pack_kmers(np.uint64(3) - bases, self.KMER_SIZE, True)
+        np.minimum(forward, reverse, out=forward)
+        hashes[:kmer_count] = self.mix_hashes(forward)
+
+        invalid_counts = np.zeros(len(codes) + 1, dtype=np.int64)
+        np.cumsum(codes > 3, out=invalid_counts[1:])
+        sequence_ends = np.repeat(starts + lengths, lengths)[:kmer_count]
+        masked = ((invalid_counts[self.KMER_SIZE:] - invalid_counts[:kmer_count] > 0)
+                  | (np.arange(kmer_count) + self.KMER_SIZE > sequence_ends))
+        hashes[:kmer_count][masked] = self.MAX_HASH
+        return hashes, starts
+
+    @staticmethod
+    def pack_kmers(bases: np.ndarray, kmer_size: int, reverse: bool) -> np.ndarray:
+        # Packs the 2 bit bases of every k-mer into one integer, first base highest (or lowest, for reverse
+        # complements). Packed words are doubled in length each round, so k-mers take log2(k) rounds, not k
+        kmer_count = len(bases) - kmer_size + 1
+        packed = np.zeros(kmer_count, dtype=np.uint64)
+        packed_size = 0
+        word = bases
+        word_size = 1
+        while True:
+            if kmer_size & word_size:
+                if reverse:
+                    packed |= word[packed_size:packed_size + kmer_count] << np.uint64(2 * packed_size)
+                else:
+                    packed <<= np.uint64(2 * word_size)
+                    packed |= word[packed_size:packed_size + kmer_count]
+                packed_size += word_size
+            if word_size * 2 > kmer_size:
+                return packed
+            shift = np.uint64(2 * word_size)
+            if reverse:
+                word = word[:-word_size] | (word[word_size:] << shift)
+            else:
+                word = (word[:-word_size] << shift) | word[word_size:]
+            word_size *= 2
+
+    @staticmethod
+    def mix_hashes(values: np.ndarray) -> np.ndarray:
+        # splitmix64 finalizer, so anchors are not biased towards low complexity (e.g. poly-A) k-mers
+        values ^= values >> np.uint64(30)
+        values *= np.uint64(0xBF58476D1CE4E5B9)
+        values ^= values >> np.uint64(27)
+        values *= np.uint64(0x94D049BB133111EB)
+        values ^= values >> np.uint64(31)
+        return values
+
+    def calculate_anchors(self, sequences: list[bytes]) -> np.ndarray:
+        # Sequences without a complete k-mer get MAX_HASH, i.e. no anchor
+        anchors = np.full(len(sequences), self.MAX_HASH, dtype=np.uint64)
+        for batch_start, batch in self.batch_sequences(sequences):
+            hashes, starts = self.calculate_kmer_hashes(batch)
+            anchors[batch_start:batch_start + len(batch)] = np.minimum.reduceat(hashes, starts)
+        return anchors
+
+    def index_anchor_containers(self, sequences: list[bytes], unique_anchors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # Returns the (anchor, sequence index) pairs of every sequence containing an anchor, sorted by anchor
+        container_hashes = []
+        container_indices = []
+        if len(unique_anchors) == 0:
+            return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+        for batch_start, batch in self.batch_sequences(sequences):
+            hashes, starts = self.calculate_kmer_hashes(batch)
+            positions = np.minimum(np.searchsorted(unique_anchors, hashes), len(unique_anchors) - 1)
+            hits = np.flatnonzero(unique_anchors[positions] == hashes)
+            container_hashes.append(hashes[hits])
+            container_indices.append(np.searchsorted(starts, hits, side="right") - 1 + batch_start)
+
+        container_hashes = np.concatenate(container_hashes)
+        container_indices = np.concatenate(container_indices)
+        order = np.lexsort((container_indices, container_hashes))
+        container_hashes = container_hashes[order]
+        container_indices = container_indices[order]
+        unique = np.ones(len(order), dtype=bool)
+        unique[1:] = (container_hashes[1:] != container_hashes[:-1]) | (container_indices[1:] != container_indices[:-1])
+        return container_hashes[unique], container_indices[unique]
+
+    def find_contained_sequences(self, query_names: list, query_sequences: list[bytes], container_names: list,
+                                 container_sequences: list[bytes], reason: str) -> dict[Any, tuple[str, str]]:
+        # Queries and containers may be the same list, in which case a query is never its own container
+        same_sequences = query_sequences is container_sequences
+        anchors = self.calculate_anchors(query_sequences)
+        container_hashes, container_indices = self.index_anchor_containers(container_sequences,
+                                                                           np.unique(anchors[anchors != self.MAX_HASH]))
+        contained_sequences = {}
+        lefts = np.searchsorted(container_hashes, anchors, side="left")
+        rights = np.searchsorted(container_hashes, anchors, side="right")
+        # Every query with an anchor contains it, so queries sharing their anchor with no other sequence are skipped
+        container_counts = rights - lefts - (1 if same_sequences else 0)
+        for query_index in np.flatnonzero((container_counts > 0) & (container_counts <= self.MAX_CONTAINERS)).tolist():
+            query = query_sequences[query_index]
+            reverse_query = None
+            for container_index in container_indices[lefts[query_index]:rights[query_index]].tolist():
+                container = container_sequences[container_index]
+                if len(container) < len(query):
+                    continue
+                if same_sequences and len(container) == len(query) and container_index >= query_index:
+                    continue
+                if query not in container:
+                    if reverse_query is None:
+                        reverse_query = query[::-1].translate(self.COMPLEMENT)
+                    if reverse_query not in container:
+                        continue
+                contained_sequences[query_names[query_index]] = (reason, str(container_names[container_index]))
+                break
+        return contained_sequences
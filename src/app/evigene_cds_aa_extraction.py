@@ -1,12 +1,72 @@
 from argparse import ArgumentParser
+from codon_translation import CodonTranslator
 from constants import CODON_TO_AMINO_ACID
 from csv import reader
+from fasta_tools import IndexedFastaReader
 from json import load
+from multiprocessing import Pool
+import numpy as np
 from pathlib import Path
-import sqlite3
-from typing import Any, Iterator, Union
+from shutil import copyfileobj, rmtree
+from sqlite_tools import SqliteConnectionManager
+from tempfile import mkdtemp
+from typing import Any, Iterator, TextIO, Union
+
+class TranscriptCdsMapping:
+    # CSR style mapping of transcript ids to cds, i.e. the cds ids of transcript_ids[i] are cds_ids[offsets[i]:offsets[i+1]].
+    # cds_records holds the 0 based start, end, strand and gene code (an index into gene_symbols) aligned with cds_ids.
+    # Transcript ids are kept sorted, so lookups are binary searches
+    RECORD_DTYPE = np.dtype([("start", np.int32), ("end", np.int32), ("strand", "S1"), ("gene_code", np.int32)])
+
+    def __init__(self, transcript_ids: np.ndarray, offsets: np.ndarray, cds_ids: np.ndarray, cds_records: np.ndarray) -> None:
+        self.transcript_ids = transcript_ids
+        self.offsets = offsets
+        self.cds_ids = cds_ids
+        self.cds_records = cds_records
+
+    def __len__(self) -> int:
+        return len(self.transcript_ids)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.transcript_ids.tolist())
+
+    @classmethod
+    def from_chunks(cls, transcript_id_chunks: list[np.ndarray], cds_id_chunks: list[np.ndarray],
+                    cds_record_chunks: list[np.ndarray]) -> "TranscriptCdsMapping":
+        # Chunks hold one entry per cds ordered by transcript id, so each change in transcript id starts a new row
+        cds_transcript_ids = np.concatenate([np.zeros(0, dtype=np.int64)] + transcript_id_chunks)
+        cds_ids = np.concatenate([np.zeros(0, dtype=np.int64)] + cds_id_chunks)
+        cds_records = np.concatenate([np.zeros(0, dtype=cls.RECORD_DTYPE)] + cds_record_chunks)
+        row_starts = np.flatnonzero(np.diff(cds_transcript_ids, prepend=-1))
+        offsets = np.append(row_starts, len(cds_ids))
+        return cls(cds_transcript_ids[row_starts], offsets, cds_ids, cds_records)
+
+    @staticmethod
+    def counts_to_offsets(counts: np.ndarray) -> np.ndarray:
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return offsets
+
+    def take_rows(self, rows: np.ndarray) -> "TranscriptCdsMapping":
+        counts = self.offsets[rows + 1] - self.offsets[rows]
+        offsets = self.counts_to_offsets(counts)
+        # Position of every cds of the selected rows within cds_ids, in the order of the selected rows
+        cds_index = np.repeat(self.offsets[rows] - offsets[:-1], counts)
+        cds_index += np.arange(offsets[-1])
+        return TranscriptCdsMapping(self.transcript_ids[rows], offsets, self.cds_ids[cds_index], self.cds_records[cds_index])
+
+    def take_transcripts(self, transcript_ids: list[int]) -> "TranscriptCdsMapping":
+        return self.take_rows(np.sort(np.searchsorted(self.transcript_ids, transcript_ids)))
+
+    def get_cds(self, transcript_id: int) -> Iterator[tuple[int, tuple[Any]]]:
+        row = np.searchsorted(self.transcript_ids, transcript_id)
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return zip(self.cds_ids[start:end].tolist(), self.cds_records[start:end].tolist())
 
 class CdsAaFastaManager:
+    AA_BATCH_SIZE = 10_000
+    FETCH_SIZE = 100_000
+
     def __init__(self, assembly_fasta: Path, sqlite_db: Path,
                  sql_queries: Path, cds_fasta: Union[None, Path], aa_fasta: Union[None, Path]) -> None:
         self.assembly_fasta = assembly_fasta
@@ -20,163 +80,165 @@ class CdsAaFastaManager:
         with json_path.open() as inhandle:
             return load(inhandle)
 
-    def run(self, codon_to_aa: dict[str]=None, add_gene_name: True=None, transcriptome: str=None) -> None:
-        # Extract a dictionary of transcript ids mapping to cds ids (sometimes more than one cds id per transcript id)
-        transcript_cds_id_mapping = self.extract_transcript_cds_id_mapping(self.sqlite_db, self.sql_queries)
-        print(len(transcript_cds_id_mapping))
-        if transcriptome:
-            transcript_cds_id_mapping = self.filter_transcript_cds_id_mapping_by_transcriptome(transcript_cds_id_mapping,
-                                                                                               self.sqlite_db, transcriptome)
-            print(len(transcript_cds_id_mapping))
-
-        # If cds metadata extraction fields are present, extract cds ids that meet the criteria,
-        # then remove any transcript ids whose cds ids do not meet that criteria
-        if self.sql_queries["cds_query"] is not None:
-            filtered_cds_ids = self.extract_filtered_cds_ids(self.sqlite_db, self.sql_queries)
-            transcript_cds_id_mapping = self.filter_transcript_cds_id_mapping(transcript_cds_id_mapping, filtered_cds_ids)
-            print(len(transcript_cds_id_mapping))
-
-        if add_gene_name:
-            cds_gene_mapping = self.extract_cds_gene_mapping(self.sqlite_db)
-        else:
-            cds_gene_mapping = None
+    def run(self, codon_to_aa: dict[str]=None, add_gene_name: True=None, transcriptome: str=None, workers: int=1) -> None:
+        if (not self.cds_fasta) and (not self.aa_fasta):
+            raise Exception("Neither output cds nor aa fasta paths detected\nNo calculation performed")
 
-        # Extract cds_position info
-        cds_positions = self.extract_cds_positions(self.sqlite_db)
-        print(len(cds_positions))
+        # Compile the transcript and cds queries (and transcriptome, if given) into a single query, which returns
+        # only the cds to write, along with their positions and gene names
+        sql_query, parameters = self.compile_cds_query(self.sql_queries, transcriptome)
+        transcript_cds_mapping, gene_symbols = self.extract_transcript_cds_mapping(self.sqlite_db, sql_query,
+                                                                                   parameters, add_gene_name)
+        print(len(transcript_cds_mapping))
 
         # Using the remaining transcript ids write cds and/or aa fasta files
-        if (self.cds_fasta) and (not self.aa_fasta):
-            self.extract_and_write_cds(transcript_cds_id_mapping, cds_positions, self.assembly_fasta, self.cds_fasta, cds_gene_mapping)
-        elif (not self.cds_fasta) and (self.aa_fasta):
-            self.extract_and_write_aa(transcript_cds_id_mapping, cds_positions, self.assembly_fasta,
-                                      self.aa_fasta, codon_to_aa, cds_gene_mapping)
-        elif self.cds_fasta and self.aa_fasta:
-            self.extract_and_write_cds_aa(transcript_cds_id_mapping, cds_positions, self.assembly_fasta,
-                                          self.cds_fasta, self.aa_fasta, codon_to_aa, cds_gene_mapping)
+        if workers > 1:
+            self.pool_extract_and_write(transcript_cds_mapping, self.assembly_fasta,
+                                        self.cds_fasta, self.aa_fasta, codon_to_aa, gene_symbols, workers)
         else:
-            raise Exception("Neither output cds nor aa fasta paths detected\nNo calculation performed")
+            transcript_sequences = IndexedFastaReader(self.assembly_fasta).fetch_sequences(transcript_cds_mapping)
+            self.extract_and_write(transcript_sequences, transcript_cds_mapping,
+                                   self.cds_fasta, self.aa_fasta, codon_to_aa, gene_symbols)
 
     @staticmethod
-    def extract_transcript_cds_id_mapping(sqlite_db: Path, sql_queries: dict[dict[str]]) -> dict[list[int]]:
-        sql_query = sql_queries["transcripts_query"]
-        print("Starting transcript id to cds id mapping")
+    def compile_cds_query(sql_queries: dict[dict[str]], transcriptome: Union[None, str]) -> tuple[str, list[str]]:
+        # The transcripts_query and cds_query are used as subqueries of their "uid" columns, so existing query files
+        # work unchanged. They are correlated EXISTS checks rather than IN lists, so sqlite flattens them into primary
+        # key lookups and the transcriptome filter can drive the join through the samples and transcripts indexes.
+        # Cds are ordered by transcript, matching the cds_ids order of the transcripts table
+        sql_query = ("SELECT c.transcript_uid,c.uid,c.start,c.end,c.strand,c.gene_symbol "
+                     "FROM cds c ")
+        conditions = [f"EXISTS (SELECT 1 FROM ({sql_queries['transcripts_query']}) tq WHERE tq.uid = c.transcript_uid)"]
+        parameters = []
 
-        with sqlite3.connect(sqlite_db) as connection:
-            cursor = connection.cursor()
-            cursor.execute(sql_query)
-            return {row[0]: [int(id) for id in row[1].split(";")] for row in cursor.fetchall()}
+        if transcriptome:
+            sql_query += ("JOIN transcripts t ON c.transcript_uid = t.uid "
+                          "JOIN samples s ON t.sample_uid = s.uid ")
+            conditions.append("s.transcriptome = ?")
+            parameters.append(transcriptome)
+
+        if sql_queries["cds_query"] is not None:
+            conditions.append(f"EXISTS (SELECT 1 FROM ({sql_queries['cds_query']}) cq WHERE cq.uid = c.uid)")
+
+        sql_query += f"WHERE {' AND '.join(conditions)} ORDER BY c.transcript_uid,c.uid"
+        return sql_query, parameters
 
     @classmethod
-    def filter_transcript_cds_id_mapping_by_transcriptome(cls, transcript_cds_id_mapping: dict[list[int]],
-                                                          sqlite_db: Path, transcriptome: str) -> dict[list[int]]:
-        transcriptome_filtered_transcript_ids = cls.extract_transcriptome_filtered_transcript_ids(sqlite_db, transcriptome)
-        return {k: v for k, v in transcript_cds_id_mapping.items() if k in transcriptome_filtered_transcript_ids}
+    def extract_transcript_cds_mapping(cls, sqlite_db: Path, sql_query: str, parameters: list[str],
+                                       add_gene_name: bool) -> tuple[TranscriptCdsMapping, Union[None, list[str]]]:
+        print("Starting transcript id to cds mapping")
+        transcript_id_chunks, cds_id_chunks, cds_record_chunks = [], [], []
+        gene_codes = dict()
 
-    @staticmethod
-    def extract_transcriptome_filtered_transcript_ids(sqlite_db: Path, transcriptome: str) -> set[int]:
-        print(f"\nExtracting transcript ids that belong to transcriptome: {transcriptome}")
-        with sqlite3.connect(sqlite_db) as connection:
+        with SqliteConnectionManager.connect(sqlite_db) as connection:
             cursor = connection.cursor()
-            sql_query = ("SELECT t.uid "
-                         "FROM transcripts t "
-                         "LEFT OUTER JOIN samples s ON t.sample_uid = s.uid "
-                         f"WHERE s.transcriptome = '{transcriptome}'")
-            cursor.execute(sql_query)
-            return {row[0] for row in cursor.fetchall()}
+            cursor.execute(sql_query, parameters)
+            while rows := cursor.fetchmany(cls.FETCH_SIZE):
+                transcript_ids, cds_ids, starts, ends, strands, genes = zip(*rows)
+                cds_records = np.zeros(len(rows), dtype=TranscriptCdsMapping.RECORD_DTYPE)
+                cds_records["start"] = np.array(starts, dtype=np.int32) - 1
+                cds_records["end"] = ends
+                cds_records["strand"] = np.array(strands, dtype="S1")
+                if add_gene_name:
+                    cds_records["gene_code"] = [gene_codes.setdefault(gene, len(gene_codes)) for gene in genes]
+
+                transcript_id_chunks.append(np.array(transcript_ids, dtype=np.int64))
+                cds_id_chunks.append(np.array(cds_ids, dtype=np.int64))
+                cds_record_chunks.append(cds_records)
+
+        gene_symbols = list(gene_codes) if add_gene_name else None
+        return TranscriptCdsMapping.from_chunks(transcript_id_chunks, cds_id_chunks, cds_record_chunks), gene_symbols
 
-    @staticmethod
-    def extract_filtered_cds_ids(sqlite_db: Path, sql_queries: dict[dict[str]]) -> set[int]:
-        sql_query = sql_queries["cds_query"]
-        print("Starting filtered cds id mapping")
+    @classmethod
+    def extract_and_write(cls, transcript_sequences: Iterator[tuple[int, str]], transcript_cds_mapping: TranscriptCdsMapping,
+                          cds_fasta: Union[None, Path], aa_fasta: Union[None, Path],
+                          codon_to_aa: dict[str], gene_symbols: Union[None, list[str]]) -> None:
+        if (cds_fasta) and (not aa_fasta):
+            cls.extract_and_write_cds(transcript_sequences, transcript_cds_mapping, cds_fasta, gene_symbols)
+        elif (not cds_fasta) and (aa_fasta):
+            cls.extract_and_write_aa(transcript_sequences, transcript_cds_mapping, aa_fasta, codon_to_aa, gene_symbols)
+        elif cds_fasta and aa_fasta:
+            cls.extract_and_write_cds_aa(transcript_sequences, transcript_cds_mapping,
+                                         cds_fasta, aa_fasta, codon_to_aa, gene_symbols)
 
-        with sqlite3.connect(sqlite_db) as connection:
-            cursor = connection.cursor()
-            cursor.execute(sql_query)
-            return {row[0] for row in cursor.fetchall()}
+    @classmethod
+    def pool_extract_and_write(cls, transcript_cds_mapping: TranscriptCdsMapping,
+                               assembly_fasta: Path, cds_fasta: Union[None, Path], aa_fasta: Union[None, Path],
+                               codon_to_aa: dict[str], gene_symbols: Union[None, list[str]], workers: int) -> None:
+        print(f"Workers: {workers}")
+        # Transcripts are split into contiguous byte ranges of the assembly fasta, so writing the shard outputs
+        # back out in shard order gives files identical to the single process output
+        reader = IndexedFastaReader(assembly_fasta)
+        index_entries = reader.extract_index_entries(transcript_cds_mapping)
+        shards = reader.split_entries(index_entries, workers * 4)
+
+        temp_dir = Path(mkdtemp(dir=(cds_fasta or aa_fasta).parent))
+        try:
+            input_data = cls.extract_shard_input_data(shards, transcript_cds_mapping, assembly_fasta,
+                                                      cds_fasta, aa_fasta, codon_to_aa, gene_symbols, temp_dir)
+            with Pool(processes=workers) as pool:
+                pool.map(cls.extract_and_write_shard_proxy, input_data)
+
+            if cds_fasta:
+                cls.concatenate_shard_fastas([data["cds_fasta"] for data in input_data], cds_fasta)
+            if aa_fasta:
+                cls.concatenate_shard_fastas([data["aa_fasta"] for data in input_data], aa_fasta)
+        finally:
+            rmtree(temp_dir)
 
     @staticmethod
-    def filter_transcript_cds_id_mapping(transcript_cds_id_mapping: dict[list[int]], filtered_cds_ids: set[str]) -> dict[list[int]]:
-        filtered_transcript_cds_id_mapping = dict()
-
-        for transcript_id, cds_ids in transcript_cds_id_mapping.items():
-            cds_ids_keepers = []
-            for cds_id in cds_ids:
-                if cds_id in filtered_cds_ids:
-                    cds_ids_keepers.append(cds_id)
-            if len(cds_ids_keepers) < 1:
-                continue
-            filtered_transcript_cds_id_mapping[transcript_id] = cds_ids_keepers
-        return filtered_transcript_cds_id_mapping
+    def extract_shard_input_data(shards: list[list[tuple[Any]]], transcript_cds_mapping: TranscriptCdsMapping,
+                                 assembly_fasta: Path, cds_fasta: Union[None, Path], aa_fasta: Union[None, Path],
+                                 codon_to_aa: dict[str], gene_symbols: Union[None, list[str]], temp_dir: Path) -> list[dict[Any]]:
+        # Each shard only receives the mapping rows for its own transcripts, to keep what is sent to workers small
+        input_data = []
+        for i, shard_entries in enumerate(shards):
+            data = {"assembly_fasta": assembly_fasta,
+                    "index_entries": shard_entries,
+                    "transcript_cds_mapping": transcript_cds_mapping.take_transcripts([entry[0] for entry in shard_entries]),
+                    "cds_fasta": temp_dir / f"shard_{i}.cds" if cds_fasta else None,
+                    "aa_fasta": temp_dir / f"shard_{i}.aa" if aa_fasta else None,
+                    "codon_to_aa": codon_to_aa,
+                    "gene_symbols": gene_symbols}
+            input_data.append(data)
+        return input_data
 
-    @staticmethod
-    def extract_cds_gene_mapping(sqlite_db: Path) -> dict[str]:
-        print("Starting cds to gene name mapping")
-        sql_query = "SELECT uid,gene_symbol FROM cds"
+    @classmethod
+    def extract_and_write_shard_proxy(cls, input_data: dict[Any]) -> None:
+        return cls.extract_and_write_shard(**input_data)
 
-        with sqlite3.connect(sqlite_db) as connection:
-            cursor = connection.cursor()
-            cursor.execute(sql_query)
-            return {row[0]: row[1] for row in cursor.fetchall()}
+    @classmethod
+    def extract_and_write_shard(cls, assembly_fasta: Path, index_entries: list[tuple[Any]],
+                                transcript_cds_mapping: TranscriptCdsMapping,
+                                cds_fasta: Union[None, Path], aa_fasta: Union[None, Path], codon_to_aa: dict[str],
+                                gene_symbols: Union[None, list[str]]) -> None:
+        transcript_sequences = IndexedFastaReader(assembly_fasta).fetch_entry_sequences(index_entries)
+        cls.extract_and_write(transcript_sequences, transcript_cds_mapping, cds_fasta, aa_fasta, codon_to_aa, gene_symbols)
 
     @staticmethod
-    def extract_cds_positions(sqlite_db: Path) -> dict[Any]:
-        print("Starting cds positions extraction")
-        with sqlite3.connect(sqlite_db) as connection:
-            cursor = connection.cursor()
-            sql_query = "SELECT uid,start,end,strand FROM cds"
-            cursor.execute(sql_query)
-            return {row[0]: {"start": row[1]-1, "end": row[2], "strand": row[3]} for row in cursor.fetchall()}
+    def concatenate_shard_fastas(shard_fastas: list[Path], outpath: Path) -> None:
+        with outpath.open("wb") as outhandle:
+            for shard_fasta in shard_fastas:
+                with shard_fasta.open("rb") as inhandle:
+                    copyfileobj(inhandle, outhandle, 16_777_216)
 
     @classmethod
-    def extract_and_write_cds(cls, transcript_cds_id_mapping: dict[list[int]], cds_positions: dict[Any],
-                              assembly_fasta: Path, cds_fasta: Path, cds_gene_mapping: Union[None, dict[str]]) -> None:
+    def extract_and_write_cds(cls, transcript_sequences: Iterator[tuple[int, str]], transcript_cds_mapping: TranscriptCdsMapping,
+                              cds_fasta: Path, gene_symbols: Union[None, list[str]]) -> None:
         print("Starting cds extraction and writing\n(This may take awhile)")
         with cds_fasta.open("w") as cds_outhandle:
-            for fasta_seq in cls.fasta_chunker(assembly_fasta):
-                transcript_id = int(fasta_seq[0][1:])
-                try:
-                    cds_ids = transcript_cds_id_mapping[transcript_id]
-                except KeyError:
-                    continue
-
-                transcript_seq = "".join(fasta_seq[1:])
-
-                for cds_id in cds_ids:
-                    cds_seq = cls.extract_cds_sequence(cds_positions[cds_id], transcript_seq)
-                    if cds_gene_mapping:
-                        gene = cds_gene_mapping[cds_id]
-                        cds_outhandle.write(f">{cds_id};{gene}\n")
-                    else:
-                        cds_outhandle.write(f">{cds_id}\n")
+            for transcript_id, transcript_seq in transcript_sequences:
+                for cds_id, cds_record in transcript_cds_mapping.get_cds(transcript_id):
+                    cds_seq = cls.extract_cds_sequence(cds_record, transcript_seq)
+                    cds_outhandle.write(f"{cls.set_fasta_header(cds_id, cds_record, gene_symbols)}\n")
                     cds_outhandle.write(f"{cds_seq}\n")
 
-    @staticmethod
-    def fasta_chunker(fasta_path: Path) -> Iterator[list[str]]:
-        fasta_seq = []
-        first_chunk = True
-        with fasta_path.open() as inhandle:
-            for line in inhandle:
-                line = line.strip()
-                if not line.startswith(">"):
-                    fasta_seq.append(line)
-                else:
-                    if first_chunk:
-                        fasta_seq.append(line)
-                        first_chunk = False
-                        continue
-                    yield fasta_seq
-                    fasta_seq = [line]
-            if fasta_seq:
-                yield fasta_seq
-
     @classmethod
-    def extract_cds_sequence(cls, cds_position: dict[Any], transcript_seq: str) -> str:
-        cds_start = cds_position["start"]
-        cds_end = cds_position["end"]
+    def extract_cds_sequence(cls, cds_record: tuple[Any], transcript_seq: str) -> str:
+        cds_start, cds_end, strand, _ = cds_record
         cds_seq = transcript_seq[cds_start:cds_end]
 
-        if cds_position["strand"] == "-":
+        if strand == b"-":
             cds_seq = cls.reverse_translate_dna(cds_seq)
         return cds_seq
 
@@ -186,78 +248,58 @@ class CdsAaFastaManager:
         return dna_sequence.translate(translation_mapping)[::-1]
 
     @classmethod
-    def extract_and_write_aa(cls, transcript_cds_id_mapping: dict[list[str]], cds_positions: dict[Any],
-                              assembly_fasta:Path, aa_fasta: Path, codon_to_aa: dict[str],
-                              cds_gene_mapping: Union[None, dict[str]]) -> None:
+    def extract_and_write_aa(cls, transcript_sequences: Iterator[tuple[int, str]], transcript_cds_mapping: TranscriptCdsMapping,
+                             aa_fasta: Path, codon_to_aa: dict[str], gene_symbols: Union[None, list[str]]) -> None:
         print("Starting cds extraction, aa translation, and aa writing\n(This may take awhile)")
+        codon_translator = CodonTranslator(codon_to_aa)
+        aa_batch = []
 
         with aa_fasta.open("w") as aa_outhandle:
-            for fasta_seq in cls.fasta_chunker(assembly_fasta):
-                transcript_id = int(fasta_seq[0][1:])
-                try:
-                    cds_ids = transcript_cds_id_mapping[transcript_id]
-                except KeyError:
-                    continue
-
-                transcript_seq = "".join(fasta_seq[1:])
-
-                for cds_id in cds_ids:
-                    cds_seq = cls.extract_cds_sequence(cds_positions[cds_id], transcript_seq)
-                    try:
-                        aa_seq = cls.translate_cds_to_aa(cds_seq, codon_to_aa)
-                    except KeyError:
-                        continue
-                    if cds_gene_mapping:
-                        gene = cds_gene_mapping[cds_id]
-                        aa_outhandle.write(f">{cds_id};{gene}\n")
-                    else:
-                        aa_outhandle.write(f">{cds_id}\n")
-                    aa_outhandle.write(f"{aa_seq}\n")
+            for transcript_id, transcript_seq in transcript_sequences:
+                for cds_id, cds_record in transcript_cds_mapping.get_cds(transcript_id):
+                    cds_seq = cls.extract_cds_sequence(cds_record, transcript_seq)
+                    aa_batch.append((cls.set_fasta_header(cds_id, cds_record, gene_symbols), cds_seq))
+                    if len(aa_batch) >= cls.AA_BATCH_SIZE:
+                        cls.translate_and_write_aa_batch(aa_batch, codon_translator, aa_outhandle)
+            cls.translate_and_write_aa_batch(aa_batch, codon_translator, aa_outhandle)
 
-    @classmethod
-    def translate_cds_to_aa(cls, dna_sequence: str, codon_to_aa: dict[str]) -> str:
-        return "".join([codon_to_aa[codon] for codon in cls.codon_chunker(dna_sequence)])
+    @staticmethod
+    def set_fasta_header(cds_id: int, cds_record: tuple[Any], gene_symbols: Union[None, list[str]]) -> str:
+        if gene_symbols is not None:
+            gene = gene_symbols[cds_record[3]]
+            return f">{cds_id};{gene}"
+        return f">{cds_id}"
 
     @staticmethod
-    def codon_chunker(dna_sequence: str) -> Iterator[str]:
-        codon_size = 3
-        for i in range(0, len(dna_sequence), codon_size):
-            yield dna_sequence[i:i+codon_size]
+    def translate_and_write_aa_batch(aa_batch: list[tuple[str, str]], codon_translator: CodonTranslator,
+                                     aa_outhandle: TextIO) -> None:
+        # Translating many cds at once lets numpy do the per codon work, instead of a python loop
+        aa_seqs = codon_translator.translate_batch([cds_seq for _, cds_seq in aa_batch])
+        for (header, _), aa_seq in zip(aa_batch, aa_seqs):
+            aa_outhandle.write(f"{header}\n")
+            aa_outhandle.write(f"{aa_seq}\n")
+        aa_batch.clear()
 
     @classmethod
-    def extract_and_write_cds_aa(cls, transcript_cds_id_mapping: dict[list[str]], cds_positions: dict[Any],
-                              assembly_fasta:Path, cds_fasta:Path, aa_fasta: Path, codon_to_aa: dict[str],
-                              cds_gene_mapping: Union[None, dict[str]]) -> None:
+    def extract_and_write_cds_aa(cls, transcript_sequences: Iterator[tuple[int, str]], transcript_cds_mapping: TranscriptCdsMapping,
+                                 cds_fasta:Path, aa_fasta: Path, codon_to_aa: dict[str],
+                                 gene_symbols: Union[None, list[str]]) -> None:
         print("Starting cds extraction, aa translation, and cds and aa writing\n(This may take awhile)")
+        codon_translator = CodonTranslator(codon_to_aa)
+        aa_batch = []
 
         with cds_fasta.open("w") as cds_outhandle, aa_fasta.open("w") as aa_outhandle:
-            for fasta_seq in cls.fasta_chunker(assembly_fasta):
-                transcript_id = int(fasta_seq[0][1:])
-                try:
-                    cds_ids = transcript_cds_id_mapping[transcript_id]
-                except KeyError:
-                    continue
-
-                transcript_seq = "".join(fasta_seq[1:])
-
-                for cds_id in cds_ids:
-                    cds_seq = cls.extract_cds_sequence(cds_positions[cds_id], transcript_seq)
-                    if cds_gene_mapping:
-                        gene = cds_gene_mapping[cds_id]
-                        cds_outhandle.write(f">{cds_id};{gene}\n")
-                    else:
-                        cds_outhandle.write(f">{cds_id}\n")
+            for transcript_id, transcript_seq in transcript_sequences:
+                for cds_id, cds_record in transcript_cds_mapping.get_cds(transcript_id):
+                    cds_seq = cls.extract_cds_sequence(cds_record, transcript_seq)
+                    header = cls.set_fasta_header(cds_id, cds_record, gene_symbols)
+                    cds_outhandle.write(f"{header}\n")
                     cds_outhandle.write(f"{cds_seq}\n")
-                    try:
-                        aa_seq = cls.translate_cds_to_aa(cds_seq, codon_to_aa)
-                    except KeyError:
-                        continue
-                    if cds_gene_mapping:
-                        gene = cds_gene_mapping[cds_id]
-                        aa_outhandle.write(f">{cds_id};{gene}\n")
-                    else:
-                        aa_outhandle.write(f">{cds_id}\n")
-                    aa_outhandle.write(f"{aa_seq}\n")
+
+                    aa_batch.append((header, cds_seq))
+                    if len(aa_batch) >= cls.AA_BATCH_SIZE:
+                        cls.translate_and_write_aa_batch(aa_batch, codon_translator, aa_outhandle)
+            cls.translate_and_write_aa_batch(aa_batch, codon_translator, aa_outhandle)
 
 if __name__ == "__main__":
     parser = ArgumentParser()
@@ -268,6 +310,7 @@ if __name__ == "__main__":
     parser.add_argument("-aa_fasta", type=str, required=False)
     parser.add_argument("-add_gene_name", action="store_true", required=False)
     parser.add_argument("-transcriptome", type=str, required=False)
+    parser.add_argument("-workers", type=int, default=1, required=False)
     args = parser.parse_args()
 
     cds_fasta_path = Path(args.cds_fasta) if args.cds_fasta else None
@@ -276,5 +319,5 @@ if __name__ == "__main__":
     cafm = CdsAaFastaManager(Path(args.assembly_fasta), Path(args.sqlite_db),
                              Path(args.sql_queries), cds_fasta_path, aa_fasta_path)
     print("\nStarting CDS/AA Fasta Manager")
-    cafm.run(CODON_TO_AMINO_ACID, args.add_gene_name, args.transcriptome)
+    cafm.run(CODON_TO_AMINO_ACID, args.add_gene_name, args.transcriptome, args.workers)
     print("\nFinished")
\ No newline at end of file
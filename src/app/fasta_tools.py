@@ -0,0 +1,344 @@
+from errno import EINVAL, ENOSYS, EOPNOTSUPP, EXDEV
+from os import O_RDONLY, close, copy_file_range, getpid, open as os_open, pread, replace, sendfile, write
+from pathlib import Path
+from socket import gethostname
+from typing import Any, Callable, Iterable, Iterator, TextIO, Union
+
+class FastaParser:
+    # Reads large binary blocks and splits records on b"\n>" boundaries, so no per-line objects are made.
+    # Records are yielded as (header, sequence) tuples, with the ">" removed from the header and all line
+    # breaks removed from the sequence. In headers_only mode only the header strings are yielded.
+    # Parsing can be limited to the byte range [start, end), where both are record boundaries (e.g. from
+    # split_byte_ranges), so a large fasta can be parsed in parallel without an index
+
+    @classmethod
+    def parse(cls, fasta_path: Path, headers_only: bool=False, block_size: int=16_777_216,
+              start: int=0, end: Union[None, int]=None) -> Iterator[Union[str, tuple[str, str]]]:
+        with fasta_path.open("rb") as inhandle:
+            end = fasta_path.stat().st_size if end is None else end
+            inhandle.seek(start)
+            position = -1
+            while position == -1:
+                buffer = inhandle.read(min(block_size, end - inhandle.tell()))
+                if not buffer:
+                    return
+                position = buffer.find(b">")
+            end_of_file = inhandle.tell() >= end
+
+            while True:
+                record_end = cls.find_record_end(buffer, position + 1)
+                if record_end == -1:
+                    if not end_of_file:
+                        block = inhandle.read(min(block_size, end - inhandle.tell()))
+                        end_of_file = inhandle.tell() >= end
+                        buffer = buffer[position:] + block
+                        position = 0
+                        continue
+                    record_end = len(buffer)
+
+                header_end = buffer.find(b"\n", position, record_end)
+                if header_end == -1:
+                    header_end = record_end
+                header = buffer[position + 1:header_end].strip().decode()
+
+                if headers_only:
+                    yield header
+                else:
+                    sequence = buffer[header_end + 1:record_end].replace(b"\n", b"")
+                    if b"\r" in sequence:
+                        sequence = sequence.replace(b"\r", b"")
+                    yield header, sequence.decode()
+
+                if record_end == len(buffer):
+                    return
+                position = record_end + 1
+
+    @staticmethod
+    def find_record_end(buffer: bytes, start: int) -> int:
+        # Searching for the single byte ">" is much faster than for b"\n>", so the preceding newline
+        # is checked separately (">" may also legitimately appear within header descriptions)
+        while True:
+            boundary = buffer.find(b">", start)
+            if boundary == -1:
+                return -1
+            if buffer[boundary - 1] == 10:
+                return boundary - 1
+            start = boundary + 1
+
+    @classmethod
+    def parse_headers(cls, fasta_path: Path, block_size: int=16_777_216) -> Iterator[str]:
+        return cls.parse(fasta_path, headers_only=True, block_size=block_size)
+
+    @classmethod
+    def count_records(cls, fasta_path: Path) -> int:
+        return sum(1 for _ in cls.parse_headers(fasta_path))
+
+    @staticmethod
+    def split_byte_ranges(fasta_path: Path, range_count: int, probe_size: int=1_048_576) -> list[tuple[int, int]]:
+        # Splits a fasta into contiguous byte ranges of roughly equal size, each starting at a record header
+        size = fasta_path.stat().st_size
+        boundaries = [0]
+        with fasta_path.open("rb") as inhandle:
+            for i in range(1, range_count):
+                position = max(size * i // range_count, boundaries[-1] + 1)
+                boundary = -1
+                while boundary == -1 and position < size:
+                    inhandle.seek(position - 1)
+                    boundary = inhandle.read(probe_size + 1).find(b"\n>")
+                    if boundary == -1:
+                        position += probe_size
+                boundaries.append(min(position + boundary, size) if boundary != -1 else size)
+        boundaries.append(size)
+        return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if start < end]
+
+    @staticmethod
+    def wrap_sequence(sequence: str, line_width: int=60) -> list[str]:
+        return [sequence[i:i+line_width] for i in range(0, len(sequence), line_width)]
+
+class FastaIndexer:
+    # Generates samtools faidx compatible ".fai" indexes, i.e. one tab separated line per record of:
+    # name, sequence length, byte offset of first base, bases per line, bytes per line
+    @staticmethod
+    def set_index_path(fasta_path: Path) -> Path:
+        return fasta_path.with_name(f"{fasta_path.name}.fai")
+
+    @staticmethod
+    def format_index_entry(name: str, length: int, offset: int, linebases: int, linewidth: int) -> str:
+        return f"{name}\t{length}\t{offset}\t{linebases}\t{linewidth}\n"
+
+    @staticmethod
+    def calculate_line_geometry(name: str, sequence_lines: list[str]) -> tuple[int, int, int]:
+        # NOTE: Assumes lines are written with single "\n" terminators
+        if not sequence_lines:
+            return 0, 0, 0
+        linebases = len(sequence_lines[0])
+        for line in sequence_lines[1:-1]:
+            if len(line) != linebases:
+                raise Exception(f"Record '{name}' has irregular line lengths and cannot be faidx indexed")
+        if len(sequence_lines[-1]) > linebases:
+            raise Exception(f"Record '{name}' has irregular line lengths and cannot be faidx indexed")
+        length = sum(len(line) for line in sequence_lines)
+        return length, linebases, linebases + 1
+
+    @classmethod
+    def build_index(cls, fasta_path: Path) -> Path:
+        print(f"Building fasta index for: {fasta_path}\n(This may take awhile)")
+        index_path = cls.set_index_path(fasta_path)
+
+        # The index is written to a temporary file and moved into place, so concurrent jobs (possibly on other
+        # nodes) building the same index never read, or write into, a partial index
+        temp_index_path = index_path.with_name(f"{index_path.name}.{gethostname()}.{getpid()}.tmp")
+        try:
+            with temp_index_path.open("w") as outhandle:
+                cls.write_index(fasta_path, outhandle)
+            replace(temp_index_path, index_path)
+        finally:
+            temp_index_path.unlink(missing_ok=True)
+        return index_path
+
+    @classmethod
+    def write_index(cls, fasta_path: Path, outhandle: TextIO) -> None:
+        with fasta_path.open("rb") as inhandle:
+            offset = 0
+            record = None
+            short_line_seen = False
+            for line in inhandle:
+                if line.startswith(b">"):
+                    if record:
+                        outhandle.write(cls.format_index_entry(*record))
+                    name = line[1:].split(maxsplit=1)[0].decode()
+                    record = [name, 0, offset + len(line), 0, 0]
+                    short_line_seen = False
+                elif record:
+                    bases = len(line.rstrip(b"\r\n"))
+                    if record[3] == 0:
+                        record[3] = bases
+                        record[4] = len(line)
+                    elif short_line_seen or bases > record[3]:
+                        raise Exception(f"Record '{record[0]}' has irregular line lengths and cannot be faidx indexed")
+                    elif bases < record[3]:
+                        short_line_seen = True
+                    record[1] += bases
+                offset += len(line)
+            if record:
+                outhandle.write(cls.format_index_entry(*record))
+
+class IndexedFastaReader:
+    def __init__(self, fasta_path: Path, max_gap: int=65_536, max_read: int=8_388_608) -> None:
+        self.fasta_path = fasta_path
+        self.index_path = self.check_index(fasta_path)
+        self.max_gap = max_gap
+        self.max_read = max_read
+
+    @staticmethod
+    def check_index(fasta_path: Path) -> Path:
+        index_path = FastaIndexer.set_index_path(fasta_path)
+        if not index_path.exists() or index_path.stat().st_mtime < fasta_path.stat().st_mtime:
+            print("Fasta index missing or older than fasta")
+            FastaIndexer.build_index(fasta_path)
+        return index_path
+
+    def extract_index_entries(self, names: Iterable[Any]) -> list[tuple[Any, int, int, int]]:
+        # Returns (name, length, offset, byte count) for requested records, sorted by file offset.
+        # Names are matched as strings, but returned as the type originally requested (e.g. int uids)
+        requested_names = {str(name): name for name in names}
+        entries = []
+        with self.index_path.open() as inhandle:
+            for line in inhandle:
+                name = line[:line.find("\t")]
+                if name not in requested_names:
+                    continue
+                _, length, offset, linebases, linewidth = line.split("\t")
+                length, linebases, linewidth = int(length), int(linebases), int(linewidth)
+                if linebases:
+                    line_count = -(-length // linebases)
+                    byte_count = length + line_count * (linewidth - linebases)
+                else:
+                    byte_count = 0
+                entries.append((requested_names[name], length, int(offset), byte_count))
+
+        missing_count = len(requested_names) - len(entries)
+        if missing_count:
+            print(f"WARNING: {missing_count} requested records not found in fasta index")
+        return sorted(entries, key=lambda entry: entry[2])
+
+    @staticmethod
+    def coalesce_entries(entries: list[tuple[Any, int, int, int]],
+                         max_gap: int, max_read: int) -> Iterator[list[tuple[Any, int, int, int]]]:
+        # Groups records that are close together on disk, so they can be fetched with a single read
+        run = []
+        for entry in entries:
+            if run:
+                run_start = run[0][2]
+                run_end = run[-1][2] + run[-1][3]
+                entry_end = entry[2] + entry[3]
+                if entry[2] - run_end > max_gap or entry_end - run_start > max_read:
+                    yield run
+                    run = []
+            run.append(entry)
+        if run:
+            yield run
+
+    @staticmethod
+    def read_byte_range(file_descriptor: int, start: int, size: int) -> bytes:
+        chunks = []
+        while size > 0:
+            chunk = pread(file_descriptor, size, start)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            start += len(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    @staticmethod
+    def split_entries(entries: list[tuple[Any, int, int, int]], shard_count: int) -> list[list[tuple[Any, int, int, int]]]:
+        # Splits offset sorted entries into contiguous shards of roughly equal byte counts
+        total_bytes = sum(entry[3] for entry in entries)
+        shard_bytes = max(1, -(-total_bytes // max(1, shard_count)))
+        shards = []
+        shard = []
+        current_bytes = 0
+        for entry in entries:
+            shard.append(entry)
+            current_bytes += entry[3]
+            if current_bytes >= shard_bytes:
+                shards.append(shard)
+                shard = []
+                current_bytes = 0
+        if shard:
+            shards.append(shard)
+        return shards
+
+    def fetch_raw_sequences(self, names: Iterable[Any]) -> Iterator[tuple[Any, bytes]]:
+        # Yields sequence bytes exactly as stored (i.e. with original line wrapping), in file order
+        return self.fetch_raw_entry_sequences(self.extract_index_entries(names))
+
+    def fetch_raw_entry_sequences(self, entries: list[tuple[Any, int, int, int]]) -> Iterator[tuple[Any, bytes]]:
+        file_descriptor = os_open(self.fasta_path, O_RDONLY)
+        try:
+            for run in self.coalesce_entries(entries, self.max_gap, self.max_read):
+                run_start = run[0][2]
+                run_end = run[-1][2] + run[-1][3]
+                block = self.read_byte_range(file_descriptor, run_start, run_end - run_start)
+                for name, _, offset, byte_count in run:
+                    raw_sequence = block[offset - run_start:offset - run_start + byte_count]
+                    if not raw_sequence.endswith(b"\n"):
+                        raw_sequence += b"\n"
+                    yield name, raw_sequence
+        finally:
+            close(file_descriptor)
+
+    def fetch_sequences(self, names: Iterable[Any]) -> Iterator[tuple[Any, str]]:
+        return self.fetch_entry_sequences(self.extract_index_entries(names))
+
+    def fetch_entry_sequences(self, entries: list[tuple[Any, int, int, int]]) -> Iterator[tuple[Any, str]]:
+        for name, raw_sequence in self.fetch_raw_entry_sequences(entries):
+            yield name, raw_sequence.translate(None, b"\r\n").decode()
+
+class FastaSubsetWriter:
+    # Writes a subset of an indexed fasta with the sequence bytes copied kernel side (copy_file_range, falling back to
+    # sendfile, then to pread and write), so only rewritten headers pass through Python. Consecutive records whose
+    # stored header already matches the requested header are copied as a single byte range
+    def __init__(self, reader: IndexedFastaReader) -> None:
+        self.reader = reader
+        self.copy_chunk = self.copy_chunk_with_copy_file_range
+
+    def write(self, entries: list[tuple[Any, int, int, int]], fasta_path: Path,
+              format_header: Callable[[Any], str]=str) -> None:
+        # Entries must be sorted by file offset, as returned by IndexedFastaReader.extract_index_entries
+        in_descriptor = os_open(self.reader.fasta_path, O_RDONLY)
+        try:
+            with fasta_path.open("wb", buffering=0) as outhandle:
+                out_descriptor = outhandle.fileno()
+                run_start = run_end = 0
+                for name, _, offset, byte_count in entries:
+                    header = f">{format_header(name)}\n".encode()
+                    header_start = offset - len(header)
+                    if (run_end > run_start and header_start == run_end
+                            and IndexedFastaReader.read_byte_range(in_descriptor, header_start, len(header)) == header):
+                        run_end = offset + byte_count
+                        continue
+                    self.copy_run(in_descriptor, out_descriptor, run_start, run_end)
+                    write(out_descriptor, header)
+                    run_start = offset
+                    run_end = offset + byte_count
+                self.copy_run(in_descriptor, out_descriptor, run_start, run_end)
+        finally:
+            close(in_descriptor)
+
+    def copy_run(self, in_descriptor: int, out_descriptor: int, start: int, end: int) -> None:
+        copied = 0
+        while start + copied < end:
+            count = self.copy_chunk(in_descriptor, out_descriptor, start + copied, end - start - copied)
+            if count == 0:
+                break
+            copied += count
+        # The last record of a fasta may not end with a newline
+        if start + copied < end:
+            write(out_descriptor, b"\n")
+
+    def copy_chunk_with_copy_file_range(self, in_descriptor: int, out_descriptor: int, start: int, size: int) -> int:
+        try:
+            return copy_file_range(in_descriptor, out_descriptor, size, start)
+        except OSError as error:
+            # e.g. older kernels copying across filesystems, or filesystems without support
+            if error.errno not in (EINVAL, ENOSYS, EOPNOTSUPP, EXDEV):
+                raise
+            self.copy_chunk = self.copy_chunk_with_sendfile
+            return self.copy_chunk(in_descriptor, out_descriptor, start, size)
+
+    def copy_chunk_with_sendfile(self, in_descriptor: int, out_descriptor: int, start: int, size: int) -> int:
+        try:
+            return sendfile(out_descriptor, in_descriptor, start, size)
+        except OSError as error:
+            if error.errno not in (EINVAL, ENOSYS, EOPNOTSUPP):
+                raise
+            self.copy_chunk = self.copy_chunk_with_pread
+            return self.copy_chunk(in_descriptor, out_descriptor, start, size)
+
+    def copy_chunk_with_pread(self, in_descriptor: int, out_descriptor: int, start: int, size: int) -> int:
+        chunk = pread(in_descriptor, min(size, self.reader.max_read), start)
+        if chunk:
+            write(out_descriptor, chunk)
+        return len(chunk)
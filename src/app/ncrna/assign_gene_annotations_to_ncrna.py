@@ -3,6 +3,7 @@ from collections import defaultdict
 from csv import reader
 from pathlib import Path
 import sqlite3
+from sqlite_tools import SqliteBulkUpdater, SqliteConnectionManager
 from typing import Any
 
 class GeneAssigner:
@@ -35,7 +36,7 @@ class GeneAssigner:
                                                                          ncrna_id_best_gene_mapping, core_ncrna_ids)
         
         # Insert new metadata to ncRNA metadata table
-        with sqlite3.connect(self.sqlite_db) as connection:
+        with SqliteConnectionManager.bulk_load(self.sqlite_db) as connection:
             self.update_ncrna_table(connection, blast_results_metadata)
 
     @staticmethod
@@ -58,7 +59,7 @@ class GeneAssigner:
     @staticmethod
     def extract_transcriptome_filtered_ncrna_ids(sqlite_db: Path, transcriptome: str) -> set[int]:
         print(f"\nExtracting ncrna ids that belong to transcriptome: {transcriptome}")
-        with sqlite3.connect(sqlite_db) as connection:
+        with SqliteConnectionManager.connect(sqlite_db) as connection:
             cursor = connection.cursor()
             sql_query = ("SELECT n.uid "
                          "FROM ncrna n "
@@ -70,7 +71,7 @@ class GeneAssigner:
 
     @staticmethod
     def extract_accession_number_gene_symbol_mapping(sqlite_db: Path) -> dict[str]:
-        with sqlite3.connect(sqlite_db) as connection:
+        with SqliteConnectionManager.connect(sqlite_db) as connection:
             cursor = connection.cursor()
             sql_query = "SELECT accession_number,gene_symbol FROM nc_accession_numbers"
             cursor.execute(sql_query)
@@ -131,7 +132,7 @@ class GeneAssigner:
 
     @staticmethod
     def extract_ncrna_id_len_mapping(sqlite_db: Path) -> dict[int]:
-        with sqlite3.connect(sqlite_db) as connection:
+        with SqliteConnectionManager.connect(sqlite_db) as connection:
             cursor = connection.cursor()
             sql_query = ("SELECT n.uid,t.length "
                          "FROM ncrna n "
@@ -167,17 +168,12 @@ class GeneAssigner:
 
     @staticmethod
     def update_ncrna_table(connection: sqlite3.Connection, blast_results_metadata: dict[Any]) -> None:
-        cursor = connection.cursor()
         values = [(data["accession_number"], data["gene_symbol"],
                     data["core_ncrna"], uid)
                     for uid, data in blast_results_metadata.items()]
         
-        sql_statement = ("UPDATE ncrna "
-                            "SET accession_number = ?, gene_symbol = ?, "
-                            "core_ncrna = ? "
-                            "WHERE uid = ?")
-        cursor.executemany(sql_statement, values)
-        connection.commit()
+        columns = ["accession_number", "gene_symbol", "core_ncrna"]
+        SqliteBulkUpdater.update(connection, "ncrna", columns, values)
 
 if __name__ == "__main__":
     parser = ArgumentParser()
@@ -1,7 +1,7 @@
 from argparse import ArgumentParser
+from fasta_tools import FastaSubsetWriter, IndexedFastaReader
 from pathlib import Path
-import sqlite3
-from typing import Iterator, Union
+from sqlite_tools import SqliteConnectionManager
 
 class NcrnaFastaManager:
     def __init__(self, assembly_fasta: Path, sqlite_db: Path, ncrna_fasta: Path) -> None:
@@ -16,7 +16,7 @@ class NcrnaFastaManager:
     @staticmethod
     def extract_cd_hit_filtered_ncrna_ids(sqlite_db: Path) -> set[int]:
         print(f"\nExtracting ncRNA ids for blast")
-        with sqlite3.connect(sqlite_db) as connection:
+        with SqliteConnectionManager.connect(sqlite_db) as connection:
             cursor = connection.cursor()
             sql_query = ("SELECT uid FROM ncrna "
                          "WHERE cd_hit_pass = 1")
@@ -27,33 +27,8 @@ class NcrnaFastaManager:
     def extract_and_write_ncrna(cls, assembly_fasta: Path, ncrna_fasta: Path,
                                 ncrna_ids: set[int]) -> None:
         print("Starting ncRNA extraction and writing\n(This may take awhile)")
-        with ncrna_fasta.open("w") as ncrna_outhandle:
-            for fasta_seq in cls.fasta_chunker(assembly_fasta):
-                transcript_id = int(fasta_seq[0][1:])
-                if transcript_id not in ncrna_ids:
-                    continue
-
-                for line in fasta_seq:
-                    ncrna_outhandle.write(f"{line}\n")
-
-    @staticmethod
-    def fasta_chunker(fasta_path: Path) -> Iterator[list[str]]:
-        fasta_seq = []
-        first_chunk = True
-        with fasta_path.open() as inhandle:
-            for line in inhandle:
-                line = line.strip()
-                if not line.startswith(">"):
-                    fasta_seq.append(line)
-                else:
-                    if first_chunk:
-                        fasta_seq.append(line)
-                        first_chunk = False
-                        continue
-                    yield fasta_seq
-                    fasta_seq = [line]
-            if fasta_seq:
-                yield fasta_seq
+        reader = IndexedFastaReader(assembly_fasta)
+        FastaSubsetWriter(reader).write(reader.extract_index_entries(ncrna_ids), ncrna_fasta)
 
 if __name__ == "__main__":
     parser = ArgumentParser()
@@ -1,10 +1,24 @@
 from argparse import ArgumentParser
+from containment_prefilter import ContainmentPrefilter
+from fasta_tools import FastaSubsetWriter, IndexedFastaReader
+from multiprocessing import Pool
 from pathlib import Path
-import sqlite3
-import subprocess
-from typing import Iterator
+import re
+from sqlite_tools import SqliteBulkUpdater, SqliteConnectionManager
+from stage_metrics import StageMetricsRecorder
+from subprocess_tools import SubprocessRunner
+from typing import Any, Callable, Union
 
 class CdHitManager:
+    # .clstr member lines, e.g. "1\t2290nt, >123... at +/99.56%", with "*" instead of "at ..." for the representative
+    CLUSTER_MEMBER_PATTERN = re.compile(r"\d+\t\d+nt, >(\S+?)\.\.\. (?:\*|at (?:([+-])/)?([\d.]+)%)")
+    # Length bins also include the next bin's candidates up to this fraction longer than their own longest candidate
+    BIN_OVERLAP = 0.1
+    # Minimum cd-hit-est -M (MB) per concurrent shard, above cd-hit's own 800 MB default
+    MIN_SHARD_MEMORY = 1_000
+    # Progress lines, e.g. "12.3%" or "..........    10000  finished       9876  clusters"
+    CD_HIT_PROGRESS_PATTERN = re.compile(r"^(?:[\d.]+%|\.+\s+\d+\s+finished\s+\d+\s+clusters)$")
+
     def __init__(self, sqlite_db: Path, transcriptome: str,
                  transcripts_fasta: Path, ncrna_dir: Path, cds_fasta: Path) -> None:
         self.sqlite_db = sqlite_db
@@ -15,29 +29,39 @@ class CdHitManager:
 
         self.temp_ncrna_fasta = ncrna_dir / f"{self.transcriptome}_temp_ncrna.fna"
         self.ncrna_cd_hit_est_2d_fasta = ncrna_dir / f"{self.transcriptome}_ncrna_cd_hit_est_2d.fna"
+        self.prefiltered_ncrna_fasta = ncrna_dir / f"{self.transcriptome}_ncrna_prefiltered.fna"
         self.ncrna_cd_hit_est_fasta = ncrna_dir / f"{self.transcriptome}_ncrna_cd_hit_est.fna"
 
-    def run(self, cpus: int, memory: int) -> None:
+    def run(self, cpus: int, memory: int, prefilter: bool=False, shards: int=1) -> None:
         ncrna_ids = self.extract_ncrna_ids(self.sqlite_db, self.transcriptome)
+        if prefilter:
+            ncrna_ids = self.prefilter_cds_contained_ncrna(self.sqlite_db, ncrna_ids, self.cds_fasta, self.transcripts_fasta)
         self.write_temporary_ncrna_fasta(ncrna_ids, self.transcripts_fasta, self.temp_ncrna_fasta)
-        self.run_cd_hit_est_2d(self.cds_fasta, self.temp_ncrna_fasta, self.ncrna_cd_hit_est_2d_fasta, cpus, memory)
-        self.run_cd_hit_est(self.ncrna_cd_hit_est_2d_fasta, self.ncrna_cd_hit_est_fasta, cpus, memory)
+        self.run_cd_hit_est_2d(self.cds_fasta, self.temp_ncrna_fasta, self.ncrna_cd_hit_est_2d_fasta, cpus, memory,
+                               StageMetricsRecorder.make_handler(self.sqlite_db, "cd-hit-est-2d", self.transcriptome))
+        cd_hit_est_input_fasta = self.ncrna_cd_hit_est_2d_fasta
+        if prefilter:
+            self.prefilter_ncrna_contained_ncrna(self.sqlite_db, self.ncrna_cd_hit_est_2d_fasta, self.prefiltered_ncrna_fasta)
+            cd_hit_est_input_fasta = self.prefiltered_ncrna_fasta
+        if shards > 1:
+            clusters = self.run_sharded_cd_hit_est(cd_hit_est_input_fasta, self.ncrna_cd_hit_est_fasta,
+                                                   shards, cpus, memory, self.sqlite_db, self.transcriptome)
+        else:
+            self.run_cd_hit_est(cd_hit_est_input_fasta, self.ncrna_cd_hit_est_fasta, cpus, memory,
+                                StageMetricsRecorder.make_handler(self.sqlite_db, "cd-hit-est", self.transcriptome))
+            clusters = self.compose_clusters(self.extract_clusters(self.set_cluster_path(self.ncrna_cd_hit_est_fasta)))
+        self.insert_into_ncrna_clusters_table(self.sqlite_db, self.transcriptome, clusters)
 
-        ncrna_ids = self.extract_kept_ncrna_ids(self.ncrna_cd_hit_est_fasta)
+        ncrna_ids = self.extract_kept_ncrna_ids(clusters)
 
         values = [(1, id) for id in ncrna_ids]
-        with sqlite3.connect(self.sqlite_db, timeout=600) as connection:
-            cursor = connection.cursor()
-            sql_statement = ("UPDATE ncrna "
-                             "SET cd_hit_pass = ? "
-                             "WHERE uid = ?")
-            cursor.executemany(sql_statement, values)
-            connection.commit()
+        with SqliteConnectionManager.bulk_load(self.sqlite_db) as connection:
+            SqliteBulkUpdater.update(connection, "ncrna", ["cd_hit_pass"], values)
 
     @staticmethod
     def extract_ncrna_ids(sqlite_db: Path, transcriptome: str) -> set[int]:
         print("\nExtracting ncrna ids")
-        with sqlite3.connect(sqlite_db) as connection:
+        with SqliteConnectionManager.connect(sqlite_db) as connection:
             cursor = connection.cursor()
             sql_query = ("SELECT n.uid "
                          "FROM ncrna n "
@@ -48,39 +72,41 @@ class CdHitManager:
             return {row[0] for row in cursor.fetchall()}
 
     @classmethod
-    def write_temporary_ncrna_fasta(cls, ncrna_ids: set[int], transcripts_fasta: Path, temp_ncrna_fasta: Path) -> None:
-        print("Writing temporary ncrna fasta\n(This may take a while)")
+    def prefilter_cds_contained_ncrna(cls, sqlite_db: Path, ncrna_ids: set[int], cds_fasta: Path,
+                                      transcripts_fasta: Path) -> set[int]:
+        contained_ncrna = ContainmentPrefilter().find_cds_contained_ncrna(cds_fasta, transcripts_fasta, ncrna_ids)
+        cls.update_prefiltered_ncrna(sqlite_db, contained_ncrna)
+        return ncrna_ids - contained_ncrna.keys()
 
-        with temp_ncrna_fasta.open("w") as outhandle:
-            for fasta_seq in cls.fasta_chunker(transcripts_fasta):
-                transcript_id = int(fasta_seq[0][1:])
-                if transcript_id not in ncrna_ids:
-                    continue
-                for line in fasta_seq:
-                    outhandle.write(f"{line}\n")
+    @classmethod
+    def prefilter_ncrna_contained_ncrna(cls, sqlite_db: Path, ncrna_cd_hit_est_2d_fasta: Path,
+                                        prefiltered_ncrna_fasta: Path) -> None:
+        # Writes the cd-hit-est-2d output without the contained candidates
+        contained_ncrna = ContainmentPrefilter().find_ncrna_contained_ncrna(ncrna_cd_hit_est_2d_fasta)
+        cls.update_prefiltered_ncrna(sqlite_db, contained_ncrna)
+        reader = IndexedFastaReader(ncrna_cd_hit_est_2d_fasta)
+        entries = [entry for entry in cls.extract_length_sorted_entries(reader) if entry[0] not in contained_ncrna]
+        cls.write_entries_fasta(reader, entries, prefiltered_ncrna_fasta)
+        reader.index_path.unlink()
 
     @staticmethod
-    def fasta_chunker(fasta_path: Path) -> Iterator[list[str]]:
-        fasta_seq = []
-        first_chunk = True
-        with fasta_path.open() as inhandle:
-            for line in inhandle:
-                line = line.strip()
-                if not line.startswith(">"):
-                    fasta_seq.append(line)
-                else:
-                    if first_chunk:
-                        fasta_seq.append(line)
-                        first_chunk = False
-                        continue
-                    yield fasta_seq
-                    fasta_seq = [line]
-            if fasta_seq:
-                yield fasta_seq
+    def update_prefiltered_ncrna(sqlite_db: Path, contained_ncrna: dict[int, tuple[str, str]]) -> None:
+        # Contained candidates keep cd_hit_pass NULL, as if CD-HIT had removed them
+        values = [(reason, contained_in, id) for id, (reason, contained_in) in contained_ncrna.items()]
+        with SqliteConnectionManager.bulk_load(sqlite_db) as connection:
+            SqliteBulkUpdater.update(connection, "ncrna", ["prefilter_reason", "contained_in"], values)
+
+    @classmethod
+    def write_temporary_ncrna_fasta(cls, ncrna_ids: set[int], transcripts_fasta: Path, temp_ncrna_fasta: Path) -> None:
+        print("Writing temporary ncrna fasta\n(This may take a while)")
+
+        reader = IndexedFastaReader(transcripts_fasta)
+        FastaSubsetWriter(reader).write(reader.extract_index_entries(ncrna_ids), temp_ncrna_fasta)
 
     @staticmethod
     def run_cd_hit_est_2d(cds_fasta: Path, temp_ncrna_fasta: Path, ncrna_cd_hit_est_2d_fasta: Path,
-                          cpus: int=1, memory: int=1_000) -> None:
+                          cpus: int=1, memory: int=1_000,
+                          metrics_handler: Union[None, Callable[[dict[str]], None]]=None) -> None:
         print("\nStarting cd-hit-est-2d\n(This may take even longer)")
         cd_hit_command = ["cd-hit-est-2d",
                           "-i", f"{cds_fasta}",
@@ -92,52 +118,187 @@ class CdHitManager:
                           "-s2", "0",
                           "-S2", "999999"]
 
-        p = subprocess.Popen(cd_hit_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        while p.poll() is None and (line := p.stdout.readline()) != "":
-            line = line.strip()
-            try:
-                progress = float(line[:-1])
-                if progress % 10 == 0:
-                    print(line)
-            except ValueError:
-                print(line)
-        p.wait()
-        print(f"Exit code: {p.poll()}")
-        for line in p.stderr:
-            print(line)
-
-        if p.poll() != 0:
-            raise Exception("cd-hit-est-2d did not complete successfully")
+        SubprocessRunner("cd-hit-est-2d", progress_pattern=CdHitManager.CD_HIT_PROGRESS_PATTERN,
+                         metrics_handler=metrics_handler).run(cd_hit_command)
 
     @staticmethod
     def run_cd_hit_est(ncrna_cd_hit_est_2d_fasta: Path, ncrna_cd_hit_est_fasta: Path,
-                          cpus: int=1, memory: int=1_000) -> None:
+                          cpus: int=1, memory: int=1_000,
+                          metrics_handler: Union[None, Callable[[dict[str]], None]]=None) -> None:
         print("\nStarting cd-hit-est\n(This may take a while)")
+        # "-d 0" keeps whole uids in the .clstr file, rather than the first 19 characters
         cd_hit_command = ["cd-hit-est",
                           "-i", f"{ncrna_cd_hit_est_2d_fasta}",
                           "-o", f"{ncrna_cd_hit_est_fasta}",
                           "-c", "0.99",
                           "-T", f"{cpus}",
-                          "-M", f"{memory}"]
+                          "-M", f"{memory}",
+                          "-d", "0"]
+
+        SubprocessRunner("cd-hit-est", progress_pattern=CdHitManager.CD_HIT_PROGRESS_PATTERN,
+                         metrics_handler=metrics_handler).run(cd_hit_command)
+
+    @classmethod
+    def run_cd_hit_est_proxy(cls, input_data: dict[Any]) -> None:
+        cls.run_cd_hit_est(**input_data)
+
+    @classmethod
+    def run_sharded_cd_hit_est(cls, ncrna_cd_hit_est_2d_fasta: Path, ncrna_cd_hit_est_fasta: Path,
+                               shards: int, cpus: int=1, memory: int=1_000, sqlite_db: Union[None, Path]=None,
+                               transcriptome: str="") -> dict[int, tuple]:
+        # Candidates are split into length bins that are clustered concurrently, sharing the cpus and memory. Each bin
+        # also holds the shortest candidates of the next bin, so candidates at its upper edge can still join a slightly
+        # longer representative, but a candidate's cluster is always taken from its own bin. The representatives of
+        # every bin are then clustered together, so clusters spanning bins are still merged
+        reader = IndexedFastaReader(ncrna_cd_hit_est_2d_fasta)
+        entries = cls.extract_length_sorted_entries(reader)
+        if not entries:
+            print("No ncrna left after cd-hit-est-2d")
+            reader.index_path.unlink()
+            return {}
+
+        length_bins = cls.split_length_bins(entries, shards, cls.BIN_OVERLAP)
+        # Fewer shards are run at once if the memory would not give each at least MIN_SHARD_MEMORY (0 is unlimited)
+        concurrent_shards = max(1, min(len(length_bins), cpus))
+        if memory:
+            concurrent_shards = max(1, min(concurrent_shards, memory // cls.MIN_SHARD_MEMORY))
+        input_data = []
+        bin_uids = []
+        for i, (bin_entries, overlap_entries) in enumerate(length_bins):
+            shard_fasta = ncrna_cd_hit_est_fasta.with_name(f"{ncrna_cd_hit_est_fasta.stem}_shard{i}.fna")
+            print(f"Writing {shard_fasta.name}: {len(bin_entries):,} ncrna of {bin_entries[0][1]:,}-{bin_entries[-1][1]:,} bp "
+                  f"(+{len(overlap_entries):,} overlapping)")
+            cls.write_entries_fasta(reader, bin_entries + overlap_entries, shard_fasta)
+            input_data.append({"ncrna_cd_hit_est_2d_fasta": shard_fasta,
+                               "ncrna_cd_hit_est_fasta": cls.set_shard_output_path(shard_fasta),
+                               "cpus": max(1, cpus // concurrent_shards),
+                               "memory": memory // concurrent_shards,
+                               "metrics_handler": StageMetricsRecorder.make_handler(sqlite_db, f"cd-hit-est_shard{i}",
+                                                                                    transcriptome)})
+            bin_uids.append([entry[0] for entry in bin_entries])
+        print(f"\nRunning {len(input_data)} cd-hit-est shards, {concurrent_shards} at a time")
+        with Pool(processes=concurrent_shards) as pool:
+            pool.map(cls.run_cd_hit_est_proxy, input_data)
+
+        bin_clusters = {}
+        for data, uids in zip(input_data, bin_uids):
+            shard_clusters = cls.extract_clusters(cls.set_cluster_path(data["ncrna_cd_hit_est_fasta"]))
+            bin_clusters.update((uid, shard_clusters[uid]) for uid in uids)
 
-        p = subprocess.Popen(cd_hit_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        while p.poll() is None and (line := p.stdout.readline()) != "":
-            print(line.strip())
-        p.wait()
-        print(f"Exit code: {p.poll()}")
-        for line in p.stderr:
-            print(line)
+        print("\nClustering cd-hit-est shard representatives")
+        representatives_fasta = ncrna_cd_hit_est_fasta.with_name(f"{ncrna_cd_hit_est_fasta.stem}_shard_representatives.fna")
+        representative_entries = [entry for entry in entries if bin_clusters[entry[0]][0] == entry[0]]
+        cls.write_entries_fasta(reader, representative_entries, representatives_fasta)
+        cls.run_cd_hit_est(representatives_fasta, ncrna_cd_hit_est_fasta, cpus, memory,
+                           StageMetricsRecorder.make_handler(sqlite_db, "cd-hit-est", transcriptome))
+        clusters = cls.compose_clusters(bin_clusters, cls.extract_clusters(cls.set_cluster_path(ncrna_cd_hit_est_fasta)))
 
-        if p.poll() != 0:
-            raise Exception("cd-hit-est did not complete successfully")
+        for data in input_data:
+            for path in [data["ncrna_cd_hit_est_2d_fasta"], data["ncrna_cd_hit_est_fasta"],
+                         cls.set_cluster_path(data["ncrna_cd_hit_est_fasta"])]:
+                path.unlink(missing_ok=True)
+        representatives_fasta.unlink()
+        reader.index_path.unlink()
+        return clusters
+
+    @staticmethod
+    def set_shard_output_path(shard_fasta: Path) -> Path:
+        return shard_fasta.with_name(f"{shard_fasta.stem}_cd_hit_est.fna")
+
+    @staticmethod
+    def set_cluster_path(cd_hit_fasta: Path) -> Path:
+        return cd_hit_fasta.with_name(f"{cd_hit_fasta.name}.clstr")
+
+    @staticmethod
+    def extract_length_sorted_entries(reader: IndexedFastaReader) -> list[tuple[int, int, int, int]]:
+        with reader.index_path.open() as inhandle:
+            uids = [int(line[:line.find("\t")]) for line in inhandle]
+        return sorted(reader.extract_index_entries(uids), key=lambda entry: (entry[1], entry[2]))
+
+    @staticmethod
+    def split_length_bins(entries: list[tuple[int, int, int, int]], shards: int,
+                          overlap: float) -> list[tuple[list[tuple], list[tuple]]]:
+        # Returns (bin entries, overlap entries) for contiguous length ranges with roughly equal numbers of bases. The
+        # overlap is the following candidates up to overlap (a fraction) longer than the longest candidate in the bin
+        length_bins = []
+        bin_end = 0
+        for bin_entries in IndexedFastaReader.split_entries(entries, shards):
+            bin_end += len(bin_entries)
+            max_length = bin_entries[-1][1] * (1 + overlap)
+            overlap_end = bin_end
+            while overlap_end < len(entries) and entries[overlap_end][1] <= max_length:
+                overlap_end += 1
+            length_bins.append((bin_entries, entries[bin_end:overlap_end]))
+        return length_bins
+
+    @staticmethod
+    def write_entries_fasta(reader: IndexedFastaReader, entries: list[tuple[int, int, int, int]], fasta: Path) -> None:
+        FastaSubsetWriter(reader).write(sorted(entries, key=lambda entry: entry[2]), fasta)
 
     @classmethod
-    def extract_kept_ncrna_ids(cls, ncrna_cd_hit_est_fasta: Path) -> set[int]:
-        ncrna_ids = set()
-        for fasta_seq in cls.fasta_chunker(ncrna_cd_hit_est_fasta):
-            ncrna_id = int(fasta_seq[0][1:])
-            ncrna_ids.add(ncrna_id)
-        return ncrna_ids
+    def extract_clusters(cls, cluster_file: Path) -> dict[int, tuple[int, Union[None, float], Union[None, str]]]:
+        # Returns uid -> (representative uid, identity, strand). Representatives have no identity or strand
+        clusters = {}
+        members = []
+        with cluster_file.open() as inhandle:
+            for line in inhandle:
+                if line.startswith(">"):
+                    cls.add_cluster_members(clusters, members)
+                    members = []
+                    continue
+                match = cls.CLUSTER_MEMBER_PATTERN.match(line)
+                if not match:
+                    raise Exception(f"Unrecognized cd-hit cluster line in {cluster_file}: {line.strip()}")
+                members.append(match.groups())
+        cls.add_cluster_members(clusters, members)
+        return clusters
+
+    @staticmethod
+    def add_cluster_members(clusters: dict[int, tuple], members: list[tuple[str, str, str]]) -> None:
+        if not members:
+            return
+        representatives = [int(name) for name, _, identity in members if identity is None]
+        if len(representatives) != 1:
+            raise Exception(f"Expected one representative per cd-hit cluster, found {len(representatives)}")
+        for name, strand, identity in members:
+            clusters[int(name)] = (representatives[0], None if identity is None else float(identity), strand)
+
+    @staticmethod
+    def compose_clusters(clusters: dict[int, tuple], representative_clusters: Union[None, dict[int, tuple]]=None) -> dict[int, tuple]:
+        # Returns uid -> (final representative uid, uid clustered with, identity, strand). In sharded runs a candidate
+        # may be clustered with a longer one from the next bin, so representatives are followed through the later bins
+        # to a bin representative, which takes its final representative from representative_clusters
+        composed_clusters = {}
+        for uid, (representative, identity, strand) in clusters.items():
+            if representative == uid and representative_clusters is not None:
+                representative, identity, strand = representative_clusters[uid]
+            final_representative = representative
+            while True:
+                next_representative = clusters[final_representative][0]
+                if next_representative == final_representative and representative_clusters is not None:
+                    next_representative = representative_clusters[final_representative][0]
+                if next_representative == final_representative:
+                    break
+                final_representative = next_representative
+            clustered_with = None if representative == uid else representative
+            composed_clusters[uid] = (final_representative, clustered_with, identity, strand)
+        return composed_clusters
+
+    @staticmethod
+    def insert_into_ncrna_clusters_table(sqlite_db: Path, transcriptome: str, clusters: dict[int, tuple]) -> None:
+        print(f"Inserting {len(clusters):,} ncrna into ncrna_clusters table")
+        with SqliteConnectionManager.bulk_load(sqlite_db) as connection:
+            sql_statement = ("DELETE FROM ncrna_clusters WHERE uid IN "
+                             "(SELECT t.uid FROM transcripts t "
+                             "JOIN samples s ON t.sample_uid = s.uid "
+                             "WHERE s.transcriptome = ?)")
+            connection.execute(sql_statement, (transcriptome,))
+            values = ((uid, *cluster) for uid, cluster in sorted(clusters.items()))
+            connection.executemany("INSERT INTO ncrna_clusters VALUES (?, ?, ?, ?, ?)", values)
+
+    @staticmethod
+    def extract_kept_ncrna_ids(clusters: dict[int, tuple]) -> set[int]:
+        return {uid for uid, cluster in clusters.items() if cluster[0] == uid}
 
 if __name__ == "__main__":
     parser = ArgumentParser()
@@ -148,8 +309,10 @@ if __name__ == "__main__":
     parser.add_argument("-cds_fasta", type=str, required=True)
     parser.add_argument("-cpus", type=int, default=1, required=False)
     parser.add_argument("-memory", type=int, default=1_000, required=False)
+    parser.add_argument("-prefilter", action="store_true", required=False)
+    parser.add_argument("-shards", type=int, default=1, required=False)
     args = parser.parse_args()
 
     chm = CdHitManager(Path(args.sqlite_db), args.transcriptome,
                        Path(args.transcripts_fasta), Path(args.ncrna_dir), Path(args.cds_fasta))
-    chm.run(args.cpus, args.memory)
\ No newline at end of file
+    chm.run(args.cpus, args.memory, args.prefilter, args.shards)
\ No newline at end of file
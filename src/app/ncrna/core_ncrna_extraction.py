@@ -1,7 +1,8 @@
 from argparse import ArgumentParser
+from fasta_tools import IndexedFastaReader
 from pathlib import Path
-import sqlite3
-from typing import Iterator, Union
+from sqlite_tools import SqliteConnectionManager
+from typing import Union
 
 class NcrnaFastaManager:
     def __init__(self, assembly_fasta: Path, sqlite_db: Path, ncrna_fasta: Path) -> None:
@@ -21,7 +22,7 @@ class NcrnaFastaManager:
     @staticmethod
     def extract_transcriptome_filtered_core_ncrna_ids(sqlite_db: Path, transcriptome: str) -> set[int]:
         print(f"\nExtracting ncRNA ids that belong to transcriptome: {transcriptome}")
-        with sqlite3.connect(sqlite_db) as connection:
+        with SqliteConnectionManager.connect(sqlite_db) as connection:
             cursor = connection.cursor()
             sql_query = ("SELECT n.uid "
                          "FROM ncrna n "
@@ -35,7 +36,7 @@ class NcrnaFastaManager:
     @staticmethod
     def extract_ncrna_id_gene_mapping(sqlite_db: Path) -> dict[str]:
         print("Extracting ncRNA id gene mapping")
-        with sqlite3.connect(sqlite_db) as connection:
+        with SqliteConnectionManager.connect(sqlite_db) as connection:
             cursor = connection.cursor()
             sql_query = ("SELECT uid, gene_symbol "
                          "FROM ncrna")
@@ -47,12 +48,7 @@ class NcrnaFastaManager:
                                 core_ncrna_ids: set[int], ncrna_gene_mapping: Union[None, dict[str]]) -> None:
         print("Starting ncRNA extraction and writing\n(This may take awhile)")
         with ncrna_fasta.open("w") as ncrna_outhandle:
-            for fasta_seq in cls.fasta_chunker(assembly_fasta):
-                transcript_id = int(fasta_seq[0][1:])
-                if transcript_id not in core_ncrna_ids:
-                    continue
-
-                transcript_seq = "".join(fasta_seq[1:])
+            for transcript_id, transcript_seq in IndexedFastaReader(assembly_fasta).fetch_sequences(core_ncrna_ids):
                 if ncrna_gene_mapping:
                     gene = ncrna_gene_mapping[transcript_id]
                     ncrna_outhandle.write(f">{transcript_id};{gene}\n")
@@ -60,25 +56,6 @@ class NcrnaFastaManager:
                     ncrna_outhandle.write(f">{transcript_id}\n")
                 ncrna_outhandle.write(f"{transcript_seq}\n")
 
-    @staticmethod
-    def fasta_chunker(fasta_path: Path) -> Iterator[list[str]]:
-        fasta_seq = []
-        first_chunk = True
-        with fasta_path.open() as inhandle:
-            for line in inhandle:
-                line = line.strip()
-                if not line.startswith(">"):
-                    fasta_seq.append(line)
-                else:
-                    if first_chunk:
-                        fasta_seq.append(line)
-                        first_chunk = False
-                        continue
-                    yield fasta_seq
-                    fasta_seq = [line]
-            if fasta_seq:
-                yield fasta_seq
-
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("-assembly_fasta", type=str, required=True)
@@ -1,30 +1,37 @@
 from argparse import ArgumentParser
-from hashlib import sha256
+from fasta_tools import FastaParser
+from multiprocessing import Pool
+import numpy as np
 from pathlib import Path
-import sqlite3
-from typing import Iterator
+from sqlite_tools import SqliteConnectionManager
+from typing import Any
+import xxhash
 
 class NcrnaInitialManager:
+    # Each sequence is reduced to a 128 bit xxh3 digest of its canonical orientation (the lesser of the sequence and its
+    # reverse complement), stored in a compact numpy array rather than a set of digest objects
+    DIGEST_DTYPE = [("digest_high", np.uint64), ("digest_low", np.uint64), ("uid", np.int64)]
+    COMPLEMENT = bytes.maketrans(b"ATCG", b"TAGC")
+
     def __init__(self, sqlite_db: Path, transcripts_fasta: Path) -> None:
         self.sqlite_db = sqlite_db
         self.transcripts_fasta = transcripts_fasta
 
-    def run(self, transcriptome: str) -> None:
+    def run(self, transcriptome: str, workers: int=1) -> None:
         transcript_ids = self.extract_length_and_gene_filtered_transcript_ids(self.sqlite_db, transcriptome)
-        transcript_ids = self.remove_ids_of_duplicate_sequences(self.transcripts_fasta, transcript_ids)
+        transcript_ids = self.remove_ids_of_duplicate_sequences(self.transcripts_fasta, transcript_ids, workers)
         print(len(transcript_ids))
 
         values = [(id,) for id in transcript_ids]
-        with sqlite3.connect(self.sqlite_db, timeout=600) as connection:
+        with SqliteConnectionManager.bulk_load(self.sqlite_db) as connection:
             cursor = connection.cursor()
             sql_statement = ("INSERT INTO ncrna (uid) VALUES (?)")
             cursor.executemany(sql_statement, values)
-            connection.commit()
 
     @staticmethod
     def extract_length_and_gene_filtered_transcript_ids(sqlite_db: Path, transcriptome: str) -> set[int]:
         print("\nExtracting filtered transcript ids")
-        with sqlite3.connect(sqlite_db, timeout=600) as connection:
+        with SqliteConnectionManager.connect(sqlite_db) as connection:
             cursor = connection.cursor()
             sql_query = ("SELECT t.uid "
                          "FROM transcripts t "
@@ -36,61 +43,67 @@ class NcrnaInitialManager:
             return {row[0] for row in cursor.fetchall()}
 
     @classmethod
-    def remove_ids_of_duplicate_sequences(cls, transcripts_fasta: Path, transcript_ids: set[int]) -> set[int]:
+    def remove_ids_of_duplicate_sequences(cls, transcripts_fasta: Path, transcript_ids: set[int], workers: int) -> set[int]:
         print("Removing transcript ids of duplicate sequences")
-        non_duplicate_ids = set()
-        sha256_hashes = set()
-        for fasta_seq in cls.fasta_chunker(transcripts_fasta):
-            transcript_id = int(fasta_seq[0][1:])
+        # Workers parse contiguous byte ranges of the fasta, so digests are concatenated in fasta file order
+        candidate_ids = np.fromiter(transcript_ids, dtype=np.int64, count=len(transcript_ids))
+        byte_ranges = FastaParser.split_byte_ranges(transcripts_fasta, workers * 4 if workers > 1 else 1)
+        input_data = [{"transcripts_fasta": transcripts_fasta, "start": start, "end": end, "candidate_ids": candidate_ids}
+                      for start, end in byte_ranges]
 
-            if transcript_id not in transcript_ids:
-                continue
+        if workers > 1:
+            with Pool(processes=workers) as pool:
+                canonical_digests = pool.map(cls.calculate_canonical_digests_proxy, input_data)
+        else:
+            canonical_digests = [cls.calculate_canonical_digests(**data) for data in input_data]
+        if not canonical_digests:
+            return set()
+        return cls.extract_first_unique_ids(np.concatenate(canonical_digests))
 
-            seq = "".join(fasta_seq[1:])
-            seq_hash = sha256(seq.encode("utf-8")).digest()
-            if seq_hash in sha256_hashes:
-                continue
+    @classmethod
+    def calculate_canonical_digests_proxy(cls, input_data: dict[Any]) -> np.ndarray:
+        return cls.calculate_canonical_digests(**input_data)
 
-            rev_seq = cls.reverse_translate_dna(seq)
-            rev_seq_hash = sha256(rev_seq.encode("utf-8")).digest()
-            if rev_seq_hash in sha256_hashes:
+    @classmethod
+    def calculate_canonical_digests(cls, transcripts_fasta: Path, start: int, end: int, candidate_ids: np.ndarray) -> np.ndarray:
+        # A sequence and its reverse complement share a canonical orientation, so hashing only that orientation
+        # detects both kinds of duplicate
+        candidate_ids = set(candidate_ids.tolist())
+        digests = bytearray()
+        uids = []
+        for header, seq in FastaParser.parse(transcripts_fasta, start=start, end=end):
+            transcript_id = int(header)
+            if transcript_id not in candidate_ids:
                 continue
-            
-            sha256_hashes.add(seq_hash)
-            sha256_hashes.add(rev_seq_hash)
-            non_duplicate_ids.add(transcript_id)
-        return non_duplicate_ids
+            seq = seq.encode("utf-8")
+            rev_seq = seq.translate(cls.COMPLEMENT)[::-1]
+            digests += xxhash.xxh3_128_digest(min(seq, rev_seq))
+            uids.append(transcript_id)
 
-    @staticmethod
-    def fasta_chunker(fasta_path: Path) -> Iterator[list[str]]:
-        fasta_seq = []
-        first_chunk = True
-        with fasta_path.open() as inhandle:
-            for line in inhandle:
-                line = line.strip()
-                if not line.startswith(">"):
-                    fasta_seq.append(line)
-                else:
-                    if first_chunk:
-                        fasta_seq.append(line)
-                        first_chunk = False
-                        continue
-                    yield fasta_seq
-                    fasta_seq = [line]
-            if fasta_seq:
-                yield fasta_seq
+        digests = np.frombuffer(digests, dtype=np.uint64).reshape(-1, 2)
+        canonical_digests = np.empty(len(uids), dtype=cls.DIGEST_DTYPE)
+        canonical_digests["digest_high"] = digests[:, 0]
+        canonical_digests["digest_low"] = digests[:, 1]
+        canonical_digests["uid"] = uids
+        return canonical_digests
 
     @staticmethod
-    def reverse_translate_dna(dna_sequence: str) -> str:
-        translation_mapping = str.maketrans("ATCG", "TAGC")
-        return dna_sequence.translate(translation_mapping)[::-1]
+    def extract_first_unique_ids(canonical_digests: np.ndarray) -> set[int]:
+        # lexsort is stable, so within each group of equal digests the sequence first in the fasta comes first
+        order = np.lexsort((canonical_digests["digest_low"], canonical_digests["digest_high"]))
+        sorted_digests = canonical_digests[order]
+        first = np.ones(len(sorted_digests), dtype=bool)
+        first[1:] = ((sorted_digests["digest_high"][1:] != sorted_digests["digest_high"][:-1]) |
+                     (sorted_digests["digest_low"][1:] != sorted_digests["digest_low"][:-1]))
+        return set(sorted_digests["uid"][first].tolist())
 
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("-sqlite_db", type=str, required=True)
     parser.add_argument("-transcripts_fasta", type=str, required=True)
     parser.add_argument("-transcriptome", type=str, required=True)
+    parser.add_argument("-workers", type=int, default=1, required=False)
     args = parser.parse_args()
 
     nim = NcrnaInitialManager(Path(args.sqlite_db), Path(args.transcripts_fasta))
-    nim.run(args.transcriptome)
\ No newline at end of file
+    nim.run(args.transcriptome, args.workers)
\ No newline at end of file
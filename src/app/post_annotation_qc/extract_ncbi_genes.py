@@ -1,7 +1,7 @@
 from argparse import ArgumentParser
+from fasta_tools import FastaParser
 from pathlib import Path
 import re
-from typing import Iterator
 
 class NcbiGeneExtractor:
     def __init__(self, ncbi_cds_fasta: Path, outpath: Path) -> None:
@@ -20,31 +20,11 @@ class NcbiGeneExtractor:
 
         gene_pattern = r"\[gene=(.*?)\]"
 
-        for fasta_seq in cls.fasta_chunker(ncbi_cds_fasta):
-            header = fasta_seq[0]
+        for header in FastaParser.parse_headers(ncbi_cds_fasta):
             gene = re.search(gene_pattern, header).group()[6:-1]
             genes.add(gene)
         return genes
 
-    @staticmethod
-    def fasta_chunker(fasta_path: Path) -> Iterator[list[str]]:
-        fasta_seq = []
-        first_chunk = True
-        with fasta_path.open() as inhandle:
-            for line in inhandle:
-                line = line.strip()
-                if not line.startswith(">"):
-                    fasta_seq.append(line)
-                else:
-                    if first_chunk:
-                        fasta_seq.append(line)
-                        first_chunk = False
-                        continue
-                    yield fasta_seq
-                    fasta_seq = [line]
-            if fasta_seq:
-                yield fasta_seq
-
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("-ncbi_cds_fasta", type=str, required=True)
@@ -2,7 +2,7 @@ from argparse import ArgumentParser
 import matplotlib.pyplot as plt # type: ignore
 from matplotlib_venn import venn2 # type: ignore
 from pathlib import Path
-import sqlite3
+from sqlite_tools import SqliteConnectionManager
 
 class GeneIntersector:
     def __init__(self, sqlite_db: Path, ncbi_genes_path: Path, outdir: Path) -> None:
@@ -35,7 +35,7 @@ class GeneIntersector:
 
     @staticmethod
     def extract_tatat_core_genes(sqlite_db: Path) -> set[str]:
-        with sqlite3.connect(sqlite_db) as connection:
+        with SqliteConnectionManager.connect(sqlite_db) as connection:
             cursor = connection.cursor()
             cursor.execute("SELECT gene_symbol FROM cds WHERE core_cds=1")
             return {row[0] for row in cursor.fetchall()}
@@ -2,6 +2,7 @@ from argparse import ArgumentParser
 from Bio.Align import PairwiseAligner, substitution_matrices # type: ignore
 from collections import defaultdict
 from copy import deepcopy
+from fasta_tools import FastaParser
 import matplotlib.pyplot as plt # type: ignore
 from matplotlib.colors import LinearSegmentedColormap # type: ignore
 from multiprocessing import Pool
@@ -9,7 +10,7 @@ import pandas as pd # type: ignore
 from pathlib import Path
 import re
 from seaborn import jointplot # type: ignore
-from typing import Any, Iterator, Union
+from typing import Any, Union
 
 class PairwiseGeneAligner:
     def __init__(self, tatat_cds_fasta: Path,
@@ -47,8 +48,8 @@ class PairwiseGeneAligner:
 
     @classmethod
     def extract_tatat_sequences(cls, tatat_aa_fasta: Path) -> dict[str]:
-        return {fasta_seq[0].split(";")[1]: "".join(fasta_seq[1:]).replace("*", "")
-                for fasta_seq in cls.fasta_chunker(tatat_aa_fasta)}
+        return {header.split(";")[1]: sequence.replace("*", "")
+                for header, sequence in FastaParser.parse(tatat_aa_fasta)}
 
     @classmethod
     def extract_longest_ncbi_genes(cls, ncbi_cds_fasta: Path, alignment_type: str) -> dict[str]:
@@ -57,15 +58,14 @@ class PairwiseGeneAligner:
         gene_pattern = r"\[gene=(.*?)\]"
         protein_accession_pattern = r"\[protein_id=(.*?)\]"
 
-        for fasta_seq in cls.fasta_chunker(ncbi_cds_fasta):
-            header = fasta_seq[0]
+        for header, sequence in FastaParser.parse(ncbi_cds_fasta):
             gene = re.search(gene_pattern, header).group()[6:-1]
             nucleotide_accession = header.split(" ")[0].split("|")[1]
             try:
                 protein_accession = re.search(protein_accession_pattern, header).group()[12:-1]
             except AttributeError:
                 continue
-            sequence_len = len("".join(fasta_seq[1:]))
+            sequence_len = len(sequence)
 
             longest_gene_len = longest_genes[gene]["length"]
             if sequence_len > longest_gene_len:
@@ -80,37 +80,16 @@ class PairwiseGeneAligner:
         if alignment_type == "nucleotide":
             return {data["nucleotide_accession"]: gene for gene, data in longest_genes.items()}
             
-    @staticmethod
-    def fasta_chunker(fasta_path: Path) -> Iterator[list[str]]:
-        fasta_seq = []
-        first_chunk = True
-        with fasta_path.open() as inhandle:
-            for line in inhandle:
-                line = line.strip()
-                if not line.startswith(">"):
-                    fasta_seq.append(line)
-                else:
-                    if first_chunk:
-                        fasta_seq.append(line)
-                        first_chunk = False
-                        continue
-                    yield fasta_seq
-                    fasta_seq = [line]
-            if fasta_seq:
-                yield fasta_seq
-
     @classmethod
     def extract_ncbi_aa_sequences(cls, ncbi_aa_fasta: Path, ncbi_genes: dict[str]) -> dict[str]:
         aa_sequences = dict()
 
-        for fasta_seq in cls.fasta_chunker(ncbi_aa_fasta):
-            header = fasta_seq[0]
-            protein_accession = header.split(" ")[0][1:]
+        for header, aa_seq in FastaParser.parse(ncbi_aa_fasta):
+            protein_accession = header.split(" ")[0]
             try:
                 gene = ncbi_genes[protein_accession]
             except KeyError:
                 continue
-            aa_seq = "".join(fasta_seq[1:])
             aa_sequences[gene] = aa_seq
         return aa_sequences
 
@@ -118,14 +97,12 @@ class PairwiseGeneAligner:
     def extract_ncbi_cds_sequences(cls, ncbi_cds_fasta: Path, ncbi_genes: dict[str]) -> dict[str]:
         cds_sequences = dict()
 
-        for fasta_seq in cls.fasta_chunker(ncbi_cds_fasta):
-            header = fasta_seq[0]
+        for header, cds in FastaParser.parse(ncbi_cds_fasta):
             nuc_accession = header.split(" ")[0].split("|")[1]
             try:
                 gene = ncbi_genes[nuc_accession]
             except KeyError:
                 continue
-            cds = "".join(fasta_seq[1:])
             cds_sequences[gene] = cds
         return cds_sequences
 
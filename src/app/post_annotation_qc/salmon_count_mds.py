@@ -5,7 +5,7 @@ import seaborn as sns # type: ignore
 import matplotlib.pyplot as plt # type: ignore
 from sklearn.manifold import MDS # type: ignore
 from sklearn.metrics import pairwise_distances # type: ignore
-import sqlite3
+from sqlite_tools import SqliteConnectionManager
 
 class SalmonCountMDS:
     def __init__(self, counts: Path, sqlite_db: Path, outdir: Path) -> None:
@@ -15,7 +15,7 @@ class SalmonCountMDS:
 
     @staticmethod
     def extract_sample_metadata(sqlite_db: Path) -> pd.DataFrame:
-        with sqlite3.connect(sqlite_db) as connection:
+        with SqliteConnectionManager.connect(sqlite_db) as connection:
             cursor = connection.cursor()
             cursor.execute("SELECT * FROM samples")
             results = cursor.fetchall()
@@ -1,6 +1,10 @@
 import argparse
 from pathlib import Path
+import re
+from stage_metrics import StageMetricsRecorder
 import subprocess
+from subprocess_tools import SubprocessRunner
+from typing import Union
 
 class FastqPathManager:
     def __init__(self, fastq_dir: Path, sra: str) -> None:
@@ -18,14 +22,18 @@ class FastqPathManager:
         return sorted([file for file in directory.iterdir()])
 
 class SalmonManager:
+    SALMON_PROGRESS_PATTERN = re.compile(r"processed.*fragments")
+
     def __init__(self, fastq_paths: list[Path], outdir: Path, collated_dir: Path,
-                 sra_number: str, salmon_index: Path, cpus: int) -> None:
+                 sra_number: str, salmon_index: Path, cpus: int, sqlite_db: Union[None, Path]=None) -> None:
+        # Resource usage is recorded in the stage_metrics table if a sqlite db is given
         self.fastq_paths = fastq_paths
         self.outdir = self.generate_sra_outdir(outdir, sra_number)
         self.collated_dir = collated_dir
         self.sra_number = sra_number
         self.salmon_index = salmon_index
         self.cpus = cpus
+        self.sqlite_db = sqlite_db
 
     @staticmethod
     def generate_sra_outdir(outdir: Path, sra_number: str) -> Path:
@@ -60,16 +68,10 @@ class SalmonManager:
                               "-o", self.outdir
                               ]
 
-        p = subprocess.Popen(salmon_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        while p.poll() is None and (line := p.stderr.readline()) != "":
-            print(line.strip())
-        p.wait()
-        print(f"Exit code: {p.poll()}")
-        for line in p.stderr:
-            print(line.strip())
-
-        if p.poll() != 0:
-            raise Exception("Salmon did not complete successfully")
+        # Salmon logs to stderr, rewriting its fragment count in place (each rewrite becomes a line here)
+        metrics_handler = StageMetricsRecorder.make_handler(self.sqlite_db, "salmon", self.sra_number)
+        SubprocessRunner("Salmon", progress_pattern=self.SALMON_PROGRESS_PATTERN, echo_stderr=True,
+                         metrics_handler=metrics_handler).run(salmon_command)
 
         salmon_counts_path = Path(f"{self.outdir}/quant.sf")
         return salmon_counts_path
@@ -93,10 +95,11 @@ if __name__ == "__main__":
     parser.add_argument("-collated_dir", type=str, required=True)
     parser.add_argument("-salmon_index", type=str, required=True)
     parser.add_argument("-cpus", type=int, required=True)
+    parser.add_argument("-sqlite_db", type=str, required=False)
     args = parser.parse_args()
 
     fpm = FastqPathManager(Path(args.fastq_dir), args.sra)
 
     sm = SalmonManager(fpm.sra_fastq_paths, Path(args.outdir), Path(args.collated_dir),
-                       args.sra, Path(args.salmon_index), args.cpus)
+                       args.sra, Path(args.salmon_index), args.cpus, Path(args.sqlite_db) if args.sqlite_db else None)
     sm.run()
\ No newline at end of file
@@ -1,13 +1,13 @@
 from argparse import ArgumentParser
 from pathlib import Path
-import sqlite3
+from sqlite_tools import SqliteConnectionManager
 
 class SampleMetadataManager:
     def __init__(self, sqlite_db: Path) -> None:
         self.sqlite_db = sqlite_db
 
     def print_uid(self, array_index: int) -> None:
-        with sqlite3.connect(self.sqlite_db) as connection:
+        with SqliteConnectionManager.connect(self.sqlite_db) as connection:
             cursor = connection.cursor()
             sql_query = "SELECT uid FROM samples ORDER BY uid"
             cursor.execute(sql_query)
@@ -15,7 +15,7 @@ class SampleMetadataManager:
         print(uids[array_index], flush=True)
 
     def print_transcriptome(self, array_index: int) -> None:
-        with sqlite3.connect(self.sqlite_db) as connection:
+        with SqliteConnectionManager.connect(self.sqlite_db) as connection:
             cursor = connection.cursor()
             sql_query = "SELECT DISTINCT transcriptome FROM samples ORDER BY transcriptome"
             cursor.execute(sql_query)
@@ -2,6 +2,7 @@ from argparse import ArgumentParser
 import pandas as pd # type: ignore
 from pathlib import Path
 import sqlite3
+from sqlite_tools import SqliteConnectionManager, SqliteSchemaManager
 
 class SqliteDbManager:
     def __init__(self, sqlite_db_dir: Path) -> None:
@@ -9,9 +10,9 @@ class SqliteDbManager:
 
     def create_and_insert_samples_table(self, sample_metadata: Path) -> None:
         sample_metadata = self.extract_sample_metadata(sample_metadata)
-        with sqlite3.connect(self.sqlite_db) as connection:
+        with SqliteConnectionManager.bulk_load(self.sqlite_db) as connection:
             self.create_samples_table(connection, sample_metadata)
-            sample_metadata.to_sql("samples", connection, if_exists="append", index=False)
+            self.insert_into_samples_table(connection, sample_metadata)
 
     @staticmethod
     def extract_sample_metadata(sample_metadata_path: Path) -> pd.DataFrame:
@@ -30,10 +31,17 @@ class SqliteDbManager:
         for column in sample_metadata.columns:
             if column not in ["uid", "transcriptome", "r1_reads", "r2_reads"]:
                 cursor.execute(f"ALTER TABLE samples ADD COLUMN {column} TEXT")
-        connection.commit()
+
+    @staticmethod
+    def insert_into_samples_table(connection: sqlite3.Connection, sample_metadata: pd.DataFrame) -> None:
+        # Inserted directly rather than with DataFrame.to_sql, which commits and so would end the bulk_load transaction
+        columns = ", ".join(sample_metadata.columns)
+        placeholders = ", ".join("?" for _ in sample_metadata.columns)
+        values = sample_metadata.astype(object).where(sample_metadata.notna(), None).itertuples(index=False, name=None)
+        connection.executemany(f"INSERT INTO samples ({columns}) VALUES ({placeholders})", values)
 
     def create_transcripts_table(self) -> None:
-        with sqlite3.connect(self.sqlite_db) as connection:
+        with SqliteConnectionManager.connect(self.sqlite_db) as connection:
             cursor = connection.cursor()
             cursor.execute("DROP TABLE IF EXISTS transcripts")
             cursor.execute('''CREATE TABLE transcripts
@@ -42,11 +50,21 @@ class SqliteDbManager:
                            length INTEGER NOT NULL,
                            transcript_class TEXT,
                            evigene_pass INTEGER,
-                           cds_ids TEXT)''')
+                           cds_ids TEXT,
+                           coverage REAL,
+                           node_id INTEGER,
+                           isoform_group INTEGER,
+                           isoform INTEGER)''')
+            # Records which sample fasta files have been merged into the transcripts table, for appending new samples
+            cursor.execute("DROP TABLE IF EXISTS merged_samples")
+            cursor.execute('''CREATE TABLE merged_samples
+                           (sample_uid TEXT NOT NULL PRIMARY KEY,
+                           fasta_file TEXT,
+                           merged TEXT)''')
             connection.commit()
 
     def create_cds_table(self) -> None:
-        with sqlite3.connect(self.sqlite_db) as connection:
+        with SqliteConnectionManager.connect(self.sqlite_db) as connection:
             cursor = connection.cursor()
             cursor.execute("DROP TABLE IF EXISTS cds")
             cursor.execute('''CREATE TABLE cds
@@ -64,7 +82,7 @@ class SqliteDbManager:
             connection.commit()
 
     def create_accession_numbers_table(self) -> None:
-        with sqlite3.connect(self.sqlite_db) as connection:
+        with SqliteConnectionManager.connect(self.sqlite_db) as connection:
             cursor = connection.cursor()
             cursor.execute("DROP TABLE IF EXISTS accession_numbers")
             cursor.execute('''CREATE TABLE accession_numbers
@@ -73,7 +91,7 @@ class SqliteDbManager:
             connection.commit()
 
     def create_ncrna_table(self) -> None:
-        with sqlite3.connect(self.sqlite_db) as connection:
+        with SqliteConnectionManager.connect(self.sqlite_db) as connection:
             cursor = connection.cursor()
             cursor.execute("DROP TABLE IF EXISTS ncrna")
             cursor.execute('''CREATE TABLE ncrna
@@ -81,11 +99,21 @@ class SqliteDbManager:
                            cd_hit_pass INT,
                            accession_number TEXT,
                            gene_symbol TEXT,
-                           core_ncrna INTEGER)''')
+                           core_ncrna INTEGER,
+                           prefilter_reason TEXT,
+                           contained_in TEXT)''')
+            # cd-hit-est cluster membership of ncrna candidates, from the .clstr files
+            cursor.execute("DROP TABLE IF EXISTS ncrna_clusters")
+            cursor.execute('''CREATE TABLE ncrna_clusters
+                           (uid INTEGER NOT NULL PRIMARY KEY,
+                           representative_uid INTEGER NOT NULL,
+                           clustered_with INTEGER,
+                           identity REAL,
+                           strand TEXT)''')
             connection.commit()
 
     def create_nc_accession_numbers_table(self) -> None:
-        with sqlite3.connect(self.sqlite_db) as connection:
+        with SqliteConnectionManager.connect(self.sqlite_db) as connection:
             cursor = connection.cursor()
             cursor.execute("DROP TABLE IF EXISTS nc_accession_numbers")
             cursor.execute('''CREATE TABLE nc_accession_numbers
@@ -93,6 +121,21 @@ class SqliteDbManager:
                            gene_symbol TEXT NOT NULL)''')
             connection.commit()
 
+    def migrate_schema(self) -> None:
+        # Any pending migrations are applied when the connection is opened
+        with SqliteConnectionManager.connect(self.sqlite_db) as connection:
+            print(f"Schema version: {SqliteSchemaManager.extract_schema_version(connection)}")
+
+    def analyze(self) -> None:
+        print("Analyzing sqlite db\n(This may take awhile)")
+        with SqliteConnectionManager.connect(self.sqlite_db) as connection:
+            SqliteSchemaManager.create_indexes(connection)
+            SqliteSchemaManager.analyze(connection)
+
+    def explain_queries(self) -> None:
+        with SqliteConnectionManager.connect(self.sqlite_db) as connection:
+            SqliteSchemaManager.explain_queries(connection)
+
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("-sqlite_db_dir", type=str, required=True)
@@ -102,6 +145,9 @@ if __name__ == "__main__":
     parser.add_argument("-create_acc_num_table", action="store_true", required=False)
     parser.add_argument("-create_ncrna_table", action="store_true", required=False)
     parser.add_argument("-create_nc_acc_num_table", action="store_true", required=False)
+    parser.add_argument("-migrate_schema", action="store_true", required=False)
+    parser.add_argument("-analyze", action="store_true", required=False)
+    parser.add_argument("-explain_queries", action="store_true", required=False)
     args = parser.parse_args()
 
     sdm = SqliteDbManager(Path(args.sqlite_db_dir))
@@ -116,4 +162,10 @@ if __name__ == "__main__":
     if args.create_ncrna_table:
         sdm.create_ncrna_table()
     if args.create_nc_acc_num_table:
-        sdm.create_nc_accession_numbers_table()
\ No newline at end of file
+        sdm.create_nc_accession_numbers_table()
+    if args.migrate_schema:
+        sdm.migrate_schema()
+    if args.analyze:
+        sdm.analyze()
+    if args.explain_queries:
+        sdm.explain_queries()
\ No newline at end of file
@@ -0,0 +1,360 @@
+from atexit import register
+from contextlib import contextmanager
+from operator import itemgetter
+from os import environ, getpid
+from pathlib import Path
+import sqlite3
+from typing import Callable, Iterable, Iterator, Union
+
+class SqliteConnectionManager:
+    # One connection per process and database is opened and reused by every module, with PRAGMAs tuned per workload.
+    # Connections are keyed by process id, so workers forked by multiprocessing never share their parent's connection
+    TIMEOUT = 600
+    BASE_PRAGMAS = {"cache_size": -262_144, # 256 MiB
+                    "mmap_size": 1_073_741_824,
+                    "temp_store": "MEMORY"}
+    WORKLOAD_PRAGMAS = {"read": {"synchronous": "NORMAL"},
+                        "bulk_load": {"synchronous": "OFF"}}
+    # WAL relies on shared memory between processes, so is unsafe when jobs on different nodes share a database
+    # on a network filesystem. TATAT_SQLITE_JOURNAL_MODE (e.g. "WAL" or "DELETE") overrides the detected mode
+    NETWORK_FILESYSTEMS = {"nfs", "nfs4", "lustre", "gpfs", "cifs", "smb3", "beegfs", "ceph", "panfs", "fuse.sshfs"}
+    WRITE_ACTIONS = {sqlite3.SQLITE_INSERT, sqlite3.SQLITE_UPDATE, sqlite3.SQLITE_DELETE}
+    connections = dict()
+
+    @classmethod
+    def get_connection(cls, sqlite_db: Path) -> sqlite3.Connection:
+        key = (getpid(), Path(sqlite_db).resolve())
+        if key not in cls.connections:
+            connection = sqlite3.connect(sqlite_db, timeout=cls.TIMEOUT)
+            cls.set_pragmas(connection, cls.BASE_PRAGMAS)
+            connection.execute(f"PRAGMA journal_mode = {cls.select_journal_mode(Path(sqlite_db))}")
+            SqliteSchemaManager.migrate(connection)
+            cls.connections[key] = connection
+        return cls.connections[key]
+
+    @staticmethod
+    def set_pragmas(connection: sqlite3.Connection, pragmas: dict[str]) -> None:
+        for pragma, value in pragmas.items():
+            connection.execute(f"PRAGMA {pragma} = {value}")
+
+    @classmethod
+    def select_journal_mode(cls, sqlite_db: Path) -> str:
+        if "TATAT_SQLITE_JOURNAL_MODE" in environ:
+            return environ["TATAT_SQLITE_JOURNAL_MODE"]
+        if cls.detect_filesystem_type(sqlite_db) in cls.NETWORK_FILESYSTEMS:
+            return "DELETE"
+        return "WAL"
+
+    @staticmethod
+    def detect_filesystem_type(path: Path) -> str:
+        # Uses the longest mount point containing the path, e.g. "/data/tatat.db" is on "/data" rather than "/"
+        path = str(path.resolve())
+        filesystem_type, mount_point_len = "", -1
+        try:
+            with open("/proc/mounts") as inhandle:
+                for line in inhandle:
+                    fields = line.split()
+                    mount_point = fields[1]
+                    if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) and len(mount_point) > mount_point_len:
+                        filesystem_type, mount_point_len = fields[2], len(mount_point)
+        except OSError:
+            pass
+        return filesystem_type
+
+    @classmethod
+    @contextmanager
+    def connect(cls, sqlite_db: Path) -> Iterator[sqlite3.Connection]:
+        # Read mostly workload, commits on success and rolls back on error like "with sqlite3.connect()"
+        connection = cls.get_connection(sqlite_db)
+        cls.set_pragmas(connection, cls.WORKLOAD_PRAGMAS["read"])
+        with connection:
+            yield connection
+
+    @classmethod
+    @contextmanager
+    def bulk_load(cls, sqlite_db: Path) -> Iterator[sqlite3.Connection]:
+        with cls.bulk_transaction(sqlite_db) as connection, cls.track_written_tables(connection) as written_tables:
+            yield connection
+        cls.update_indexes(connection, written_tables)
+
+    @classmethod
+    @contextmanager
+    def bulk_transaction(cls, sqlite_db: Path) -> Iterator[sqlite3.Connection]:
+        # Bulk insert/update workload, run as a single explicit transaction with relaxed syncing. The write lock is
+        # taken up front (BEGIN IMMEDIATE), so concurrent array jobs wait on the timeout instead of failing mid load.
+        # Unlike bulk_load, indexes are not updated afterwards (see update_indexes)
+        connection = cls.get_connection(sqlite_db)
+        cls.set_pragmas(connection, cls.WORKLOAD_PRAGMAS["bulk_load"])
+        # In autocommit mode sqlite3 does not silently open a new transaction after a commit, so any commit made
+        # inside the load (splitting it into several transactions) is caught before the final commit
+        isolation_level = connection.isolation_level
+        connection.isolation_level = None
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            yield connection
+            if not connection.in_transaction:
+                raise Exception("Bulk load transaction was committed early, callers must not commit inside bulk_load")
+            connection.commit()
+        except BaseException:
+            if connection.in_transaction:
+                connection.rollback()
+            raise
+        finally:
+            connection.isolation_level = isolation_level
+            cls.set_pragmas(connection, cls.WORKLOAD_PRAGMAS["read"])
+
+    @classmethod
+    @contextmanager
+    def track_written_tables(cls, connection: sqlite3.Connection) -> Iterator[set[str]]:
+        # The authorizer sees every statement as it is prepared, so the tables written to are known without callers
+        # listing them. Temp tables (e.g. SqliteBulkUpdater staging tables) and sqlite internal tables are ignored
+        written_tables = set()
+        def authorizer(action: int, table: str, column: str, database: str, trigger: str) -> int:
+            if action in cls.WRITE_ACTIONS and database == "main" and table and not table.startswith("sqlite_"):
+                written_tables.add(table)
+            return sqlite3.SQLITE_OK
+        connection.set_authorizer(authorizer)
+        try:
+            yield written_tables
+        finally:
+            # NOTE: set_authorizer(None) is only accepted from python 3.11
+            connection.set_authorizer(cls.allow_statement)
+
+    @staticmethod
+    def allow_statement(action: int, table: str, column: str, database: str, trigger: str) -> int:
+        return sqlite3.SQLITE_OK
+
+    @staticmethod
+    def update_indexes(connection: sqlite3.Connection, tables: Iterable[str]) -> None:
+        # Indexes are only created once a table has been loaded, so the load itself does not maintain them. Only the
+        # loaded tables are analyzed, so small updates do not rescan every table in the database
+        tables = sorted(tables)
+        SqliteSchemaManager.create_indexes(connection, tables)
+        SqliteSchemaManager.analyze(connection, tables)
+
+    @classmethod
+    def close_connections(cls) -> None:
+        for (pid, _), connection in list(cls.connections.items()):
+            if pid == getpid():
+                connection.close()
+        cls.connections.clear()
+
+class SqliteSchemaManager:
+    # Migrations upgrade existing databases in place and are recorded in the schema_versions table. Each migration
+    # only changes tables that already exist, as tables created later by SqliteDbManager already use the latest schema.
+    # Secondary indexes are created by SqliteConnectionManager.bulk_load once a table has been loaded
+    MIGRATIONS = [(1, "Add secondary indexes", "create_indexes"),
+                  (2, "Add rnaSPAdes header metadata to transcripts", "add_transcripts_spades_columns"),
+                  (3, "Add merged_samples table", "create_merged_samples_table"),
+                  (4, "Add containment prefilter columns to ncrna", "add_ncrna_prefilter_columns"),
+                  (5, "Add ncrna_clusters table", "create_ncrna_clusters_table"),
+                  (6, "Add stage_metrics table", "create_stage_metrics_table")]
+    TRANSCRIPTS_SPADES_COLUMNS = [("coverage", "REAL"), ("node_id", "INTEGER"),
+                                  ("isoform_group", "INTEGER"), ("isoform", "INTEGER")]
+    NCRNA_PREFILTER_COLUMNS = [("prefilter_reason", "TEXT"), ("contained_in", "TEXT")]
+    INDEXES = {"samples": [("idx_samples_transcriptome", "transcriptome")],
+               "transcripts": [("idx_transcripts_sample_uid", "sample_uid"),
+                               ("idx_transcripts_evigene_pass", "evigene_pass")],
+               "cds": [("idx_cds_transcript_uid", "transcript_uid"),
+                       ("idx_cds_core_cds", "core_cds, unambiguous_gene")],
+               "ncrna": [("idx_ncrna_cd_hit_pass", "cd_hit_pass"),
+                         ("idx_ncrna_core_ncrna", "core_ncrna")],
+               "ncrna_clusters": [("idx_ncrna_clusters_representative_uid", "representative_uid")]}
+    # Representative queries run by the pipeline, for checking index usage with explain_queries
+    PIPELINE_QUERIES = {"transcriptome transcripts": ("SELECT t.uid FROM transcripts t "
+                                                      "LEFT OUTER JOIN samples s ON t.sample_uid = s.uid "
+                                                      "WHERE s.transcriptome = 'transcriptome'"),
+                        "transcriptome cds": ("SELECT c.uid FROM cds c "
+                                              "LEFT OUTER JOIN transcripts t ON c.transcript_uid = t.uid "
+                                              "LEFT OUTER JOIN samples s ON t.sample_uid = s.uid "
+                                              "WHERE s.transcriptome = 'transcriptome'"),
+                        "core cds extraction": ("SELECT c.transcript_uid,c.uid,c.start,c.end,c.strand,c.gene_symbol FROM cds c "
+                                                "JOIN transcripts t ON c.transcript_uid = t.uid "
+                                                "JOIN samples s ON t.sample_uid = s.uid "
+                                                "WHERE EXISTS (SELECT 1 FROM transcripts tq WHERE tq.evigene_pass=1 AND tq.uid = c.transcript_uid) "
+                                                "AND s.transcriptome = 'transcriptome' "
+                                                "AND EXISTS (SELECT 1 FROM cds cq WHERE cq.core_cds=1 AND cq.unambiguous_gene=1 AND cq.uid = c.uid) "
+                                                "ORDER BY c.transcript_uid,c.uid"),
+                        "ncrna initial filtering": ("SELECT t.uid FROM transcripts t "
+                                                    "LEFT OUTER JOIN cds c ON t.uid = c.transcript_uid "
+                                                    "LEFT OUTER JOIN samples s ON t.sample_uid = s.uid "
+                                                    "WHERE t.length < 5000 AND c.gene_symbol IS NULL "
+                                                    "AND s.transcriptome = 'transcriptome'"),
+                        "cd-hit passing ncrna": "SELECT uid FROM ncrna WHERE cd_hit_pass = 1",
+                        "transcriptome core ncrna": ("SELECT n.uid FROM ncrna n "
+                                                     "LEFT OUTER JOIN transcripts t ON n.uid = t.uid "
+                                                     "LEFT OUTER JOIN samples s ON t.sample_uid = s.uid "
+                                                     "WHERE s.transcriptome = 'transcriptome' AND n.core_ncrna = 1")}
+
+    @classmethod
+    def migrate(cls, connection: sqlite3.Connection) -> None:
+        if cls.extract_schema_version(connection) == cls.MIGRATIONS[-1][0]:
+            return
+        # The version is re-checked after taking the write lock, in case another process migrated in the meantime
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("CREATE TABLE IF NOT EXISTS schema_versions "
+                               "(version INTEGER NOT NULL PRIMARY KEY, description TEXT, applied TEXT)")
+            schema_version = cls.extract_schema_version(connection)
+            for version, description, method_name in cls.MIGRATIONS:
+                if version <= schema_version:
+                    continue
+                print(f"Migrating sqlite db to schema version {version}: {description}")
+                getattr(cls, method_name)(connection)
+                connection.execute("INSERT INTO schema_versions VALUES (?, ?, datetime('now'))", (version, description))
+
+    @classmethod
+    def extract_schema_version(cls, connection: sqlite3.Connection) -> int:
+        if not cls.check_table_exists(connection, "schema_versions"):
+            return 0
+        return connection.execute("SELECT MAX(version) FROM schema_versions").fetchone()[0] or 0
+
+    @staticmethod
+    def check_table_exists(connection: sqlite3.Connection, table: str) -> bool:
+        sql_query = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?"
+        return connection.execute(sql_query, (table,)).fetchone() is not None
+
+    @classmethod
+    def create_indexes(cls, connection: sqlite3.Connection, tables: Union[None, list[str]]=None) -> None:
+        # Empty tables are skipped, so their first bulk load does not have to maintain the indexes as it goes
+        for table, indexes in cls.INDEXES.items():
+            if tables is not None and table not in tables:
+                continue
+            if not cls.check_table_exists(connection, table):
+                continue
+            if connection.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() is None:
+                continue
+            for index_name, columns in indexes:
+                connection.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table} ({columns})")
+
+    @classmethod
+    def add_missing_columns(cls, connection: sqlite3.Connection, table: str, columns: list[tuple[str, str]]) -> None:
+        if not cls.check_table_exists(connection, table):
+            return
+        existing_columns = {row[1] for row in connection.execute(f"PRAGMA table_info({table})")}
+        for column, column_type in columns:
+            if column not in existing_columns:
+                connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+    @classmethod
+    def add_transcripts_spades_columns(cls, connection: sqlite3.Connection) -> None:
+        cls.add_missing_columns(connection, "transcripts", cls.TRANSCRIPTS_SPADES_COLUMNS)
+
+    @classmethod
+    def add_ncrna_prefilter_columns(cls, connection: sqlite3.Connection) -> None:
+        cls.add_missing_columns(connection, "ncrna", cls.NCRNA_PREFILTER_COLUMNS)
+
+    @classmethod
+    def create_merged_samples_table(cls, connection: sqlite3.Connection) -> None:
+        # Samples already in the transcripts table are recorded as merged, without their original fasta file name
+        if not cls.check_table_exists(connection, "transcripts"):
+            return
+        connection.execute('''CREATE TABLE IF NOT EXISTS merged_samples
+                           (sample_uid TEXT NOT NULL PRIMARY KEY,
+                           fasta_file TEXT,
+                           merged TEXT)''')
+        connection.execute("INSERT OR IGNORE INTO merged_samples (sample_uid) SELECT DISTINCT sample_uid FROM transcripts")
+
+    @classmethod
+    def create_ncrna_clusters_table(cls, connection: sqlite3.Connection) -> None:
+        if not cls.check_table_exists(connection, "ncrna"):
+            return
+        connection.execute('''CREATE TABLE IF NOT EXISTS ncrna_clusters
+                           (uid INTEGER NOT NULL PRIMARY KEY,
+                           representative_uid INTEGER NOT NULL,
+                           clustered_with INTEGER,
+                           identity REAL,
+                           strand TEXT)''')
+
+    @staticmethod
+    def create_stage_metrics_table(connection: sqlite3.Connection) -> None:
+        # Unlike the other tables, stage_metrics is always created here, as any stage may be the first to record to it
+        connection.execute('''CREATE TABLE IF NOT EXISTS stage_metrics
+                           (stage TEXT NOT NULL,
+                           sample_uid TEXT NOT NULL,
+                           command TEXT,
+                           started TEXT,
+                           wall_seconds REAL,
+                           cpu_seconds REAL,
+                           peak_rss_bytes INTEGER,
+                           read_bytes INTEGER,
+                           write_bytes INTEGER,
+                           exit_code INTEGER,
+                           PRIMARY KEY (stage, sample_uid))''')
+
+    @staticmethod
+    def analyze(connection: sqlite3.Connection, tables: Union[None, list[str]]=None) -> None:
+        # NOTE: A full ANALYZE is used, as sampling (analysis_limit) badly underestimates the rows per value of low
+        # cardinality columns like evigene_pass, which leads the planner to drive joins from the wrong table
+        if tables is None:
+            connection.execute("ANALYZE")
+            return
+        for table in tables:
+            connection.execute(f"ANALYZE {table}")
+
+    @classmethod
+    def explain_queries(cls, connection: sqlite3.Connection) -> None:
+        for query_name, sql_query in cls.PIPELINE_QUERIES.items():
+            print(f"\n{query_name}:")
+            try:
+                for row in connection.execute(f"EXPLAIN QUERY PLAN {sql_query}"):
+                    print(f"    {row[-1]}")
+            except sqlite3.OperationalError as error:
+                print(f"    Skipped ({error})")
+
+class SqliteBulkUpdater:
+    # Applies many row updates as a single set based UPDATE ... FROM (SQLite >= 3.33) rather than one UPDATE per row.
+    # The new values are bulk inserted into a TEMP staging table sorted by key, so the target table's pages are visited
+    # in order. The staging table deliberately has no primary key, so the planner scans it and looks each key up in the
+    # target table, instead of scanning the whole target table when only a few of its rows change
+    STAGING_TABLE_PREFIX = "staging_"
+
+    @classmethod
+    def update(cls, connection: sqlite3.Connection, table: str, columns: list[str],
+               values: Iterable[tuple], key_column: str="uid") -> None:
+        # Each value is (column values..., key), the same order as "UPDATE table SET column = ? WHERE key = ?"
+        # NOTE: Keys must be unique, as only one of several staging rows with the same key would be applied
+        staging_table = cls.create_staging_table(connection, table, columns, key_column)
+        connection.executemany(cls.set_staging_statement(staging_table, columns), sorted(values, key=itemgetter(-1)))
+
+        set_columns = ", ".join(f"{column} = s.{column}" for column in columns)
+        sql_statement = (f"UPDATE {table} SET {set_columns} "
+                         f"FROM temp.{staging_table} s "
+                         f"WHERE {table}.{key_column} = s.{key_column}")
+        connection.execute(sql_statement)
+        connection.execute(f"DROP TABLE temp.{staging_table}")
+
+    @classmethod
+    @contextmanager
+    def stream_update(cls, connection: sqlite3.Connection, table: str, columns: list[str],
+                      key_column: str="uid") -> Iterator[Callable[[Iterable[tuple]], None]]:
+        # Yields a function that stages values (same order as update) as they are produced, so they never all need to
+        # be held in memory. The staged values are applied in key order once the block exits, and the last value staged
+        # for a key takes precedence, as it would in a dict
+        staging_table = cls.create_staging_table(connection, table, columns, key_column)
+        sql_statement = cls.set_staging_statement(staging_table, columns)
+        yield lambda values: connection.executemany(sql_statement, values)
+
+        staged_columns = ", ".join(columns + [key_column])
+        set_columns = ", ".join(f"{column} = s.{column}" for column in columns)
+        sql_statement = (f"UPDATE {table} SET {set_columns} "
+                         f"FROM (SELECT {staged_columns} FROM temp.{staging_table} "
+                         f"WHERE rowid IN (SELECT MAX(rowid) FROM temp.{staging_table} GROUP BY {key_column}) "
+                         f"ORDER BY {key_column}) s "
+                         f"WHERE {table}.{key_column} = s.{key_column}")
+        connection.execute(sql_statement)
+        connection.execute(f"DROP TABLE temp.{staging_table}")
+
+    @classmethod
+    def create_staging_table(cls, connection: sqlite3.Connection, table: str, columns: list[str], key_column: str) -> str:
+        staging_table = f"{cls.STAGING_TABLE_PREFIX}{table}"
+        connection.execute(f"DROP TABLE IF EXISTS temp.{staging_table}")
+        connection.execute(f"CREATE TEMP TABLE {staging_table} ({', '.join(columns)}, {key_column} INTEGER)")
+        return staging_table
+
+    @staticmethod
+    def set_staging_statement(staging_table: str, columns: list[str]) -> str:
+        placeholders = ", ".join("?" * (len(columns) + 1))
+        return f"INSERT INTO temp.{staging_table} VALUES ({placeholders})"
+
+register(SqliteConnectionManager.close_connections)
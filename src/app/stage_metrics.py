@@ -0,0 +1,55 @@
+from argparse import ArgumentParser, REMAINDER
+from pathlib import Path
+from sqlite_tools import SqliteConnectionManager
+from subprocess_tools import SubprocessRunner
+from typing import Callable, Union
+
+class StageMetricsRecorder:
+    # Records the resources used by an external tool run (see subprocess_tools.ProcessTreeMonitor) in the stage_metrics
+    # table. Rows are keyed by stage and sample uid, so a rerun replaces the previous run's row. Stages run once per
+    # transcriptome (e.g. evigene, cd-hit) use the transcriptome name as the sample uid
+    COLUMNS = ["stage", "sample_uid", "command", "started", "wall_seconds", "cpu_seconds", "peak_rss_bytes",
+               "read_bytes", "write_bytes", "exit_code"]
+
+    def __init__(self, sqlite_db: Path, stage: str, sample_uid: str) -> None:
+        self.sqlite_db = sqlite_db
+        self.stage = stage
+        self.sample_uid = sample_uid
+
+    @classmethod
+    def make_handler(cls, sqlite_db: Union[None, Path], stage: str, sample_uid: str) -> Union[None, Callable[[dict[str]], None]]:
+        # Returns the SubprocessRunner metrics_handler, or None so nothing is recorded if no sqlite db was given
+        if sqlite_db is None:
+            return None
+        return cls(sqlite_db, stage, sample_uid).record
+
+    def record(self, metrics: dict[str]) -> None:
+        self.print_metrics(metrics)
+        row = {"stage": self.stage, "sample_uid": self.sample_uid, **metrics}
+        columns = ", ".join(self.COLUMNS)
+        placeholders = ", ".join("?" for _ in self.COLUMNS)
+        with SqliteConnectionManager.connect(self.sqlite_db) as connection:
+            connection.execute(f"INSERT OR REPLACE INTO stage_metrics ({columns}) VALUES ({placeholders})",
+                               [row.get(column) for column in self.COLUMNS])
+
+    def print_metrics(self, metrics: dict[str]) -> None:
+        io = ""
+        if metrics["read_bytes"] is not None:
+            io = f", read {metrics['read_bytes'] / 1024**3:.2f} GB, written {metrics['write_bytes'] / 1024**3:.2f} GB"
+        print(f"{self.stage} ({self.sample_uid}): wall time {metrics['wall_seconds']:,.0f} s, "
+              f"CPU time {metrics['cpu_seconds']:,.0f} s, peak RSS {metrics['peak_rss_bytes'] / 1024**3:.2f} GB{io}")
+
+if __name__ == "__main__":
+    # Runs any other command (e.g. blastn) and records its metrics, e.g.
+    # python3 stage_metrics.py -sqlite_db tatat.db -stage blastn_cds -sample_uid transcriptome blastn -db ...
+    parser = ArgumentParser()
+    parser.add_argument("-sqlite_db", type=str, required=True)
+    parser.add_argument("-stage", type=str, required=True)
+    parser.add_argument("-sample_uid", type=str, required=True)
+    parser.add_argument("command", nargs=REMAINDER)
+    args = parser.parse_args()
+
+    if not args.command:
+        raise Exception("No command given to run")
+    metrics_handler = StageMetricsRecorder.make_handler(Path(args.sqlite_db), args.stage, args.sample_uid)
+    SubprocessRunner(args.stage, echo_stderr=True, metrics_handler=metrics_handler).run(args.command)
@@ -0,0 +1,166 @@
+from collections import deque
+from datetime import datetime, timezone
+import os
+from re import Pattern
+import resource
+import subprocess
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Callable, Union
+
+class SubprocessRunner:
+    # Runs a command with stderr drained by a reader thread while stdout is read, so a chatty stream can never fill its
+    # pipe and stall the command while the other is being read. Reads block, so nothing is polled. Lines matching a
+    # progress pattern are printed at most once per PROGRESS_INTERVAL seconds, and the last STDERR_TAIL_SIZE stderr
+    # lines are kept so they can be shown if the command fails
+    # The resources used by the command and its descendants are measured (see ProcessTreeMonitor), and passed to
+    # metrics_handler before the exit code is checked, so failed runs are recorded too
+    PROGRESS_INTERVAL = 30
+    STDERR_TAIL_SIZE = 50
+
+    def __init__(self, name: str, progress_pattern: Union[None, Pattern]=None, echo_stderr: bool=False,
+                 stdout_handler: Union[None, Callable[[str], None]]=None, report_exit_code: bool=True,
+                 metrics_handler: Union[None, Callable[[dict[str]], None]]=None) -> None:
+        # stdout lines are passed to stdout_handler if given, otherwise printed
+        self.name = name
+        self.progress_pattern = progress_pattern
+        self.echo_stderr = echo_stderr
+        self.stdout_handler = stdout_handler
+        self.report_exit_code = report_exit_code
+        self.metrics_handler = metrics_handler
+        self.stderr_tail = deque(maxlen=self.STDERR_TAIL_SIZE)
+        self.print_lock = Lock()
+        self.last_progress_time = None
+
+    def run(self, command: list) -> None:
+        monitor = ProcessTreeMonitor()
+        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        monitor.start(p.pid)
+        stderr_thread = Thread(target=self.drain_stderr, args=(p.stderr,), daemon=True)
+        stderr_thread.start()
+        try:
+            for line in p.stdout:
+                if self.stdout_handler:
+                    self.stdout_handler(line)
+                else:
+                    self.print_line(line)
+        except BaseException:
+            # e.g. the handler failing, in which case the command is stopped rather than left blocked on a full pipe
+            p.kill()
+            raise
+        finally:
+            # The command is reaped here rather than by p.wait, so its resource usage is returned with its status
+            p.returncode = monitor.wait(p.pid)
+            stderr_thread.join()
+            p.stdout.close()
+            p.stderr.close()
+
+        if self.metrics_handler:
+            self.metrics_handler({"command": " ".join(map(str, command)), "exit_code": p.returncode, **monitor.metrics})
+        if self.report_exit_code:
+            print(f"Exit code: {p.returncode}")
+        if p.returncode != 0:
+            if not self.echo_stderr:
+                print("".join(self.stderr_tail).rstrip())
+            raise Exception(f"{self.name} did not complete successfully")
+
+    def drain_stderr(self, stderr) -> None:
+        for line in stderr:
+            self.stderr_tail.append(line)
+            if self.echo_stderr:
+                self.print_line(line)
+
+    def print_line(self, line: str) -> None:
+        line = line.strip()
+        with self.print_lock:
+            if self.progress_pattern and self.progress_pattern.search(line):
+                now = monotonic()
+                if self.last_progress_time is not None and now - self.last_progress_time < self.PROGRESS_INTERVAL:
+                    return
+                self.last_progress_time = now
+            print(line)
+
+class ProcessTreeMonitor:
+    # Measures the wall time, CPU time, peak RSS and storage I/O of a command and all of its descendants.
+    # CPU time and I/O come from the kernel's accounting when the command is reaped (os.wait4 and /proc/self/io), which
+    # include every descendant the command itself waited for. The RSS of the whole process tree is sampled from /proc
+    # every SAMPLE_INTERVAL seconds, as wait4 only reports the largest single process
+    # NOTE: I/O is the change in this process's totals while the command ran, so is overstated if other threads of
+    # this process read or write files meanwhile. RSS sums count pages shared between processes more than once
+    SAMPLE_INTERVAL = 2
+    PAGE_SIZE = resource.getpagesize()
+
+    def __init__(self) -> None:
+        self.metrics = dict()
+        self.peak_tree_rss = 0
+        self.stop_sampling = Event()
+        self.sampler_thread = None
+        self.start_time = None
+        self.start_io = None
+
+    def start(self, pid: int) -> None:
+        self.metrics["started"] = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        self.start_time = monotonic()
+        self.start_io = self.read_self_io()
+        self.sampler_thread = Thread(target=self.sample_tree_rss, args=(pid,), daemon=True)
+        self.sampler_thread.start()
+
+    def wait(self, pid: int) -> int:
+        # Returns the exit code as Popen.returncode would, i.e. negative if killed by a signal
+        _, status, usage = os.wait4(pid, 0)
+        end_time = monotonic()
+        end_io = self.read_self_io()
+        self.stop_sampling.set()
+        self.sampler_thread.join()
+
+        self.metrics["wall_seconds"] = round(end_time - self.start_time, 3)
+        self.metrics["cpu_seconds"] = round(usage.ru_utime + usage.ru_stime, 3)
+        # ru_maxrss is in KiB on linux
+        self.metrics["peak_rss_bytes"] = max(self.peak_tree_rss, usage.ru_maxrss * 1024)
+        for field in ["read_bytes", "write_bytes"]:
+            self.metrics[field] = end_io[field] - self.start_io[field] if self.start_io and end_io else None
+        return os.waitstatus_to_exitcode(status)
+
+    def sample_tree_rss(self, pid: int) -> None:
+        while True:
+            self.peak_tree_rss = max(self.peak_tree_rss, self.calculate_tree_rss(pid))
+            if self.stop_sampling.wait(self.SAMPLE_INTERVAL):
+                return
+
+    @classmethod
+    def calculate_tree_rss(cls, root_pid: int) -> int:
+        # The parent and RSS of every process are read from /proc/<pid>/stat, then summed over the root's descendants
+        children = dict()
+        rss = dict()
+        try:
+            proc_entries = os.listdir("/proc")
+        except OSError:
+            return 0
+        for entry in proc_entries:
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat") as inhandle:
+                    # Fields are counted from the end of the command name, which may itself contain spaces
+                    fields = inhandle.read().rpartition(")")[2].split()
+            except OSError:
+                continue
+            pid = int(entry)
+            children.setdefault(int(fields[1]), []).append(pid)
+            rss[pid] = int(fields[21]) * cls.PAGE_SIZE
+
+        tree_rss = 0
+        pids = [root_pid]
+        while pids:
+            pid = pids.pop()
+            tree_rss += rss.get(pid, 0)
+            pids.extend(children.get(pid, []))
+        return tree_rss
+
+    @staticmethod
+    def read_self_io() -> Union[None, dict[str, int]]:
+        try:
+            with open("/proc/self/io") as inhandle:
+                return {key: int(value) for key, value in (line.split(": ") for line in inhandle)}
+        except OSError:
+            return None
@@ -1,84 +1,291 @@
 from argparse import ArgumentParser
+from contextlib import contextmanager
+from fasta_tools import FastaIndexer, FastaParser
+from itertools import accumulate
+from multiprocessing import Pool
+from os import truncate
 from pathlib import Path
+import re
+from shutil import copyfileobj
 import sqlite3
-from typing import Any, Iterator, TextIO
+from sqlite_tools import SqliteConnectionManager
+from typing import Any, Iterable, Iterator, TextIO, Union
 
 class DeNovoAssemblyManager:
+    COPY_BUFFER_SIZE = 16_777_216
+    # rnaSPAdes headers, e.g. NODE_1_length_2416_cov_27.5_g0_i0 (SPAdes headers lack the isoform group and isoform)
+    SPADES_HEADER_PATTERN = re.compile(r"NODE_(\d+)_length_\d+_cov_([\d.]+)(?:_g(\d+)_i(\d+))?")
+
     def __init__(self, assembly_fasta_dir: Path, merged_path: Path, sqlite_db: Path) -> None:
         self.assembly_fasta_dir = assembly_fasta_dir
         self.merged_path = merged_path
         self.sqlite_db = sqlite_db
 
-    def run(self) -> None:
-        transcript_metadata = self.merge_fastas_and_extract_metadata(self.assembly_fasta_dir, self.merged_path)
+    def run(self, workers: int=1, min_length: Union[None, int]=None, min_cov: Union[None, float]=None,
+            append: True=None) -> None:
+        fasta_files = self.get_file_list(self.assembly_fasta_dir)
+        print(f"A total of {len(fasta_files)} files detected")
+
+        # In append mode, samples already recorded in the merged_samples table are skipped and the new samples are
+        # appended to the merged fasta with uids after the current maximum, so re-running on the same directory is a no-op
+        merged_sample_uids = self.extract_merged_sample_uids(self.sqlite_db)
+        if merged_sample_uids and not append:
+            raise Exception(f"{len(merged_sample_uids)} samples are already merged, use -append to add new samples")
+        fasta_files = [fasta_file for fasta_file in fasta_files if fasta_file.stem not in merged_sample_uids]
+        if not fasta_files:
+            print("No new samples to merge")
+            return
+        print(f"Merging {len(fasta_files)} new samples")
+        appending = bool(merged_sample_uids)
+        append_paths = [self.merged_path, FastaIndexer.set_index_path(self.merged_path)] if appending else []
+
+        # Transcript metadata is streamed into the transcripts table while the merged fasta is written,
+        # so memory use does not grow with the number of transcripts. The transcripts and merged_samples rows are
+        # committed together, and files are only truncated if the merge fails before that commit
+        with self.truncate_on_error(append_paths):
+            with SqliteConnectionManager.bulk_transaction(self.sqlite_db) as connection:
+                first_transcript_id = self.extract_max_transcript_id(connection) + 1
+                if workers > 1:
+                    transcript_metadata = self.pool_merge_fastas_and_extract_metadata(fasta_files, self.merged_path, workers,
+                                                                                      min_length, min_cov, first_transcript_id,
+                                                                                      appending)
+                else:
+                    transcript_metadata = self.merge_fastas_and_extract_metadata(fasta_files, self.merged_path,
+                                                                                 min_length, min_cov, first_transcript_id,
+                                                                                 appending)
+                self.insert_into_transcripts_table(connection, transcript_metadata)
+                self.insert_into_merged_samples_table(connection, fasta_files)
+        SqliteConnectionManager.update_indexes(connection, ["transcripts", "merged_samples"])
+
+    @staticmethod
+    def extract_merged_sample_uids(sqlite_db: Path) -> set[str]:
+        with SqliteConnectionManager.connect(sqlite_db) as connection:
+            cursor = connection.cursor()
+            cursor.execute("SELECT sample_uid FROM merged_samples")
+            return {row[0] for row in cursor.fetchall()}
+
+    @staticmethod
+    def extract_max_transcript_id(connection: sqlite3.Connection) -> int:
+        return connection.execute("SELECT MAX(uid) FROM transcripts").fetchone()[0] or 0
 
-        with sqlite3.connect(self.sqlite_db) as connection:
-            self.insert_into_transcripts_table(connection, transcript_metadata)
+    @staticmethod
+    @contextmanager
+    def truncate_on_error(paths: list[Path]) -> Iterator[None]:
+        # Files being appended to are truncated back to their original size if the merge fails, so the merged fasta
+        # and its index still match the rolled back transcripts table
+        for path in paths:
+            if not path.exists():
+                raise Exception(f"Cannot append new samples, {path} does not exist")
+        original_sizes = {path: path.stat().st_size for path in paths}
+        try:
+            yield
+        except BaseException:
+            for path, size in original_sizes.items():
+                truncate(path, size)
+            raise
 
     @classmethod
-    def merge_fastas_and_extract_metadata(cls, assembly_fasta_dir: Path, merged_path: Path) -> list[tuple[Any]]:
-        fasta_files = cls.get_file_list(assembly_fasta_dir)
-        print(f"A total of {len(fasta_files)} files detected")
+    def merge_fastas_and_extract_metadata(cls, fasta_files: list[Path], merged_path: Path,
+                                          min_length: Union[None, int], min_cov: Union[None, float],
+                                          first_transcript_id: int, append: bool) -> Iterator[tuple[Any]]:
+        # The faidx index is written alongside the merged fasta, so downstream stages can
+        # seek directly to the transcripts they need instead of re-reading the whole file
+        index_path = FastaIndexer.set_index_path(merged_path)
+        mode = "a" if append else "w"
+        offset = merged_path.stat().st_size if append else 0
 
-        transcript_metadata = list()
-        with merged_path.open("w") as merged_outhandle:
-            transcript_id = 0
-            for fasta_file in fasta_files:
-                sample_uid = fasta_file.stem
-                print(f"Starting on sample: {sample_uid}")
-                for fasta_seq in cls.fasta_chunker(fasta_file):
-                    transcript_id += 1
-                    cls.write_renamed_fasta_seq(transcript_id, merged_outhandle, fasta_seq[1:])
+        # The index is opened first so it is closed last, and stays newer than the fasta (see check_index)
+        with index_path.open(mode) as index_outhandle, merged_path.open(mode) as merged_outhandle:
+            yield from cls.write_renamed_fastas(fasta_files, first_transcript_id, merged_outhandle, index_outhandle,
+                                                min_length, min_cov, offset)
 
-                    transcript_len = len("".join(fasta_seq[1:]))
-                    transcript_metadata.append((transcript_id, sample_uid, transcript_len))
-        return transcript_metadata
+    @classmethod
+    def write_renamed_fastas(cls, fasta_files: list[Path], first_transcript_id: int,
+                             merged_outhandle: TextIO, index_outhandle: TextIO,
+                             min_length: Union[None, int], min_cov: Union[None, float], offset: int=0) -> Iterator[tuple[Any]]:
+        transcript_id = first_transcript_id - 1
+        for fasta_file in fasta_files:
+            sample_uid = fasta_file.stem
+            print(f"Starting on sample: {sample_uid}")
+            for sequence, header_metadata in cls.filter_fasta(fasta_file, min_length, min_cov):
+                transcript_id += 1
+                sequence_lines = FastaParser.wrap_sequence(sequence)
+                offset += cls.write_renamed_fasta_seq(transcript_id, merged_outhandle, sequence_lines)
+
+                transcript_len, linebases, linewidth = FastaIndexer.calculate_line_geometry(str(transcript_id), sequence_lines)
+                sequence_offset = offset - transcript_len - len(sequence_lines)
+                index_outhandle.write(FastaIndexer.format_index_entry(str(transcript_id), transcript_len,
+                                                                      sequence_offset, linebases, linewidth))
+                yield transcript_id, sample_uid, transcript_len, *header_metadata
+
+    @classmethod
+    def filter_fasta(cls, fasta_file: Path, min_length: Union[None, int],
+                     min_cov: Union[None, float]) -> Iterator[tuple[str, tuple[Any]]]:
+        # Yields the sequence and header metadata of records passing the length and coverage filters
+        for header, sequence in FastaParser.parse(fasta_file):
+            if min_length and len(sequence) < min_length:
+                continue
+            header_metadata = cls.extract_spades_header_metadata(header)
+            if min_cov:
+                if header_metadata[0] is None:
+                    raise Exception(f"-min_cov requires rnaSPAdes headers with coverage, found: {header}")
+                if header_metadata[0] < min_cov:
+                    continue
+            yield sequence, header_metadata
+
+    @classmethod
+    def extract_spades_header_metadata(cls, header: str) -> tuple[Union[None, float], Union[None, int],
+                                                                  Union[None, int], Union[None, int]]:
+        # Returns coverage, node id, isoform group and isoform, each None if not present in the header
+        header_match = cls.SPADES_HEADER_PATTERN.match(header)
+        if not header_match:
+            return None, None, None, None
+        node_id, coverage, isoform_group, isoform = header_match.groups()
+        return (float(coverage), int(node_id),
+                int(isoform_group) if isoform_group else None,
+                int(isoform) if isoform else None)
+
+    @classmethod
+    def pool_merge_fastas_and_extract_metadata(cls, fasta_files: list[Path], merged_path: Path, workers: int,
+                                               min_length: Union[None, int], min_cov: Union[None, float],
+                                               first_transcript_id: int, append: bool) -> Iterator[tuple[Any]]:
+        # Records passing the filters are pre-counted, so each sample gets the same uid range as a sequential merge and
+        # its file can be renamed independently into a part file. The parts are then concatenated in sample order
+        # NOTE: The part files are written next to the merged fasta, so it temporarily needs twice the disk space
+        print("Counting records per file")
+        with Pool(processes=workers) as pool:
+            input_data = [{"fasta_file": fasta_file, "min_length": min_length, "min_cov": min_cov}
+                          for fasta_file in fasta_files]
+            record_counts = pool.map(cls.count_filtered_records_proxy, input_data)
+            first_transcript_ids = [first_transcript_id] + [first_transcript_id + count for count in accumulate(record_counts)][:-1]
+
+            part_paths = [cls.set_part_path(merged_path, i) for i in range(len(fasta_files))]
+            input_data = [{"fasta_file": fasta_file, "first_transcript_id": first_transcript_id,
+                           "record_count": record_count, "part_path": part_path,
+                           "min_length": min_length, "min_cov": min_cov}
+                          for fasta_file, first_transcript_id, record_count, part_path
+                          in zip(fasta_files, first_transcript_ids, record_counts, part_paths)]
+            pool.map(cls.write_renamed_fasta_part_proxy, input_data)
+
+        print("Concatenating renamed sample fastas")
+        yield from cls.concatenate_fasta_parts(fasta_files, part_paths, merged_path, append)
+
+    @classmethod
+    def count_filtered_records_proxy(cls, data: dict[Any]) -> int:
+        return cls.count_filtered_records(**data)
+
+    @classmethod
+    def count_filtered_records(cls, fasta_file: Path, min_length: Union[None, int], min_cov: Union[None, float]) -> int:
+        if not min_length and not min_cov:
+            return FastaParser.count_records(fasta_file)
+        return sum(1 for _ in cls.filter_fasta(fasta_file, min_length, min_cov))
 
     @staticmethod
-    def get_file_list(directory: Path) -> list[Path]:
-        return sorted([file for file in directory.iterdir()])
+    def set_part_path(merged_path: Path, part_number: int) -> Path:
+        return merged_path.with_name(f"{merged_path.name}.part{part_number}")
 
     @staticmethod
-    def fasta_chunker(fasta_path: Path) -> Iterator[list[str]]:
-        fasta_seq = []
-        first_chunk = True
-        with fasta_path.open() as inhandle:
-            for line in inhandle:
-                line = line.strip()
-                if not line.startswith(">"):
-                    fasta_seq.append(line)
-                else:
-                    if first_chunk:
-                        fasta_seq.append(line)
-                        first_chunk = False
-                        continue
-                    yield fasta_seq
-                    fasta_seq = [line]
-            if fasta_seq:
-                yield fasta_seq
+    def set_part_metadata_path(part_path: Path) -> Path:
+        return part_path.with_name(f"{part_path.name}.tsv")
+
+    @classmethod
+    def write_renamed_fasta_part_proxy(cls, data: dict[Any]) -> None:
+        cls.write_renamed_fasta_part(**data)
+
+    @classmethod
+    def write_renamed_fasta_part(cls, fasta_file: Path, first_transcript_id: int, record_count: int, part_path: Path,
+                                 min_length: Union[None, int], min_cov: Union[None, float]) -> None:
+        # Index offsets of a part are relative to the start of the part, and are shifted during concatenation.
+        # The transcript metadata of a part is written to a tsv file, as only the parent process inserts into sqlite
+        index_path = FastaIndexer.set_index_path(part_path)
+        metadata_path = cls.set_part_metadata_path(part_path)
+        written_count = 0
+        with index_path.open("w") as index_outhandle, part_path.open("w") as part_outhandle:
+            with metadata_path.open("w") as metadata_outhandle:
+                for transcript_metadata in cls.write_renamed_fastas([fasta_file], first_transcript_id, part_outhandle,
+                                                                    index_outhandle, min_length, min_cov):
+                    metadata_outhandle.write("\t".join("" if value is None else str(value) for value in transcript_metadata) + "\n")
+                    written_count += 1
+        if written_count != record_count:
+            raise Exception(f"{fasta_file} changed while merging, {record_count} records counted but {written_count} written")
+
+    @classmethod
+    def concatenate_fasta_parts(cls, fasta_files: list[Path], part_paths: list[Path], merged_path: Path,
+                                append: bool) -> Iterator[tuple[Any]]:
+        # Opening in append mode positions the file at its end, so tell() still gives each part's offset
+        index_path = FastaIndexer.set_index_path(merged_path)
+        with index_path.open("a" if append else "w") as index_outhandle, merged_path.open("ab" if append else "wb") as merged_outhandle:
+            for fasta_file, part_path in zip(fasta_files, part_paths):
+                part_index_path = FastaIndexer.set_index_path(part_path)
+                part_metadata_path = cls.set_part_metadata_path(part_path)
+                offset = merged_outhandle.tell()
+                with part_path.open("rb") as part_inhandle:
+                    copyfileobj(part_inhandle, merged_outhandle, cls.COPY_BUFFER_SIZE)
+
+                with part_index_path.open() as index_inhandle:
+                    for line in index_inhandle:
+                        name, transcript_len, part_offset, linebases, linewidth = line.split("\t")
+                        index_outhandle.write(FastaIndexer.format_index_entry(name, int(transcript_len), int(part_offset) + offset,
+                                                                              int(linebases), int(linewidth)))
+
+                with part_metadata_path.open() as metadata_inhandle:
+                    for line in metadata_inhandle:
+                        yield cls.parse_part_metadata_line(line)
+                part_path.unlink()
+                part_index_path.unlink()
+                part_metadata_path.unlink()
+
+    @staticmethod
+    def parse_part_metadata_line(line: str) -> tuple[Any]:
+        transcript_id, sample_uid, transcript_len, coverage, node_id, isoform_group, isoform = line.rstrip("\n").split("\t")
+        return (int(transcript_id), sample_uid, int(transcript_len),
+                float(coverage) if coverage else None,
+                int(node_id) if node_id else None,
+                int(isoform_group) if isoform_group else None,
+                int(isoform) if isoform else None)
 
     @staticmethod
-    def write_renamed_fasta_seq(seq_id: int, outhandle: TextIO, fasta_seq: list[str]) -> None:
+    def get_file_list(directory: Path) -> list[Path]:
+        return sorted([file for file in directory.iterdir()])
+
+    @staticmethod
+    def write_renamed_fasta_seq(seq_id: int, outhandle: TextIO, fasta_seq: list[str]) -> int:
         # NOTE: fasta_seq should JUST be sequence, not including header
         # Otherwise, new and old header will both be written
+        # Returns the number of bytes written, for tracking fasta index offsets
         new_header = f">{seq_id}"
         outhandle.write(f"{new_header}\n")
+        bytes_written = len(new_header) + 1
         for line in fasta_seq:
             outhandle.write(f"{line}\n")
+            bytes_written += len(line) + 1
+        return bytes_written
 
     @staticmethod
-    def insert_into_transcripts_table(connection: sqlite3.Connection, transcript_metadata: list[tuple[Any]]) -> None:
+    def insert_into_transcripts_table(connection: sqlite3.Connection, transcript_metadata: Iterable[tuple[Any]]) -> None:
+        # executemany consumes the metadata lazily, one row at a time, through a single prepared statement
         cursor = connection.cursor()
-        sql_statement = "INSERT INTO transcripts (uid, sample_uid, length) VALUES (?, ?, ?)"
+        sql_statement = ("INSERT INTO transcripts (uid, sample_uid, length, coverage, node_id, isoform_group, isoform) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?)")
         cursor.executemany(sql_statement, transcript_metadata)
-        connection.commit()
+
+    @staticmethod
+    def insert_into_merged_samples_table(connection: sqlite3.Connection, fasta_files: list[Path]) -> None:
+        cursor = connection.cursor()
+        values = [(fasta_file.stem, fasta_file.name) for fasta_file in fasta_files]
+        sql_statement = "INSERT INTO merged_samples (sample_uid, fasta_file, merged) VALUES (?, ?, datetime('now'))"
+        cursor.executemany(sql_statement, values)
 
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("-assembly_fasta_dir", type=str, required=True)
     parser.add_argument("-merged_path", type=str, required=True)
     parser.add_argument("-sqlite_db", type=str, required=True)
+    parser.add_argument("-workers", type=int, default=1, required=False)
+    parser.add_argument("-min_length", type=int, required=False)
+    parser.add_argument("-min_cov", type=float, required=False)
+    parser.add_argument("-append", action="store_true", required=False)
     args = parser.parse_args()
 
     dnam = DeNovoAssemblyManager(Path(args.assembly_fasta_dir), Path(args.merged_path), Path(args.sqlite_db))
-    dnam.run()
\ No newline at end of file
+    dnam.run(args.workers, args.min_length, args.min_cov, args.append)
\ No newline at end of file